@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, projectRoot)
+sys.path.insert(0, os.path.join(projectRoot, 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fixtures import defaultFixturePath
+from pipelineBenchmark import replayClients, clearMemoryCaches, ensureDataset
+
+# End-to-end calculateQsi latency for materials that are only in OQMD,
+# with MP and OQMD queried one after the other and speculatively at
+# the same time (QSI_SPECULATIVE_FETCH):
+#
+#     python benchmarks/fallbackLatency.py --latency 0.2 --limit 20
+
+def getFallbackFormulas(dataset, limit):
+    oqmdPhases = dataset["oqmd"]["phases"]
+    formulas = [formula for formula, docs in dataset["mp"].items()
+                if not docs and oqmdPhases.get(formula, {}).get("data")]
+
+    return formulas[:limit]
+
+def timeFormulas(formulas, speculative):
+    from src.indexCalc import calculator
+
+    calculator.setSpeculativeFetch(speculative)
+    times = []
+
+    for formula in formulas:
+        clearMemoryCaches()
+        start = time.perf_counter()
+        calculator.calculateQsi(formula)
+        times.append(time.perf_counter() - start)
+
+    return {
+        "medianSeconds": statistics.median(times),
+        "meanSeconds": statistics.mean(times),
+        "maxSeconds": max(times),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare sequential and speculative MP + OQMD lookups for OQMD-only materials.")
+    parser.add_argument("--fixtures", default=defaultFixturePath, help="Replay dataset (generated if it doesn't exist)")
+    parser.add_argument("--limit", type=int, default=20, help="Number of OQMD-only formulas to time")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per request")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    ensureDataset(args.fixtures)
+
+    with replayClients(args.fixtures, latency=args.latency) as transport:
+        formulas = getFallbackFormulas(transport.dataset, args.limit)
+
+        # Warm up the imports so they aren't counted for the first formula
+        timeFormulas(formulas[:1], False)
+
+        results = {
+            "formulas": len(formulas),
+            "latency": args.latency,
+            "sequential": timeFormulas(formulas, False),
+            "speculative": timeFormulas(formulas, True),
+        }
+
+    for name in ("sequential", "speculative"):
+        print(f"{name:<12} median {results[name]['medianSeconds']:.3f}s  mean {results[name]['meanSeconds']:.3f}s  max {results[name]['maxSeconds']:.3f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
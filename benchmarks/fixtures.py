@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, projectRoot)
+sys.path.insert(0, os.path.join(projectRoot, 'src'))
+
+from src.data.replay import replayDatasetVersion, saveReplayDataset
+from utils.debug import logDebug
+
+# Builds the replay datasets the benchmarks run against (see
+# src/data/replay.py for the layout). Two ways to get one:
+#
+#   record   - queries the live MP and OQMD APIs (needs MP_KEY and
+#              network access) and stores the raw responses
+#   generate - builds a deterministic synthetic dataset in the same
+#              format: a few polymorphs per formula, some of them
+#              near-duplicates, a share of formulas only in OQMD and
+#              a share in neither
+#
+#     python benchmarks/fixtures.py generate --output benchmarks/fixtures/pipeline.json.gz
+#     python benchmarks/fixtures.py record --output benchmarks/fixtures/recorded.json.gz
+
+defaultFormulaFile = os.path.join(projectRoot, 'bulkTestData', 'testData.json')
+defaultFixturePath = os.path.join(projectRoot, 'benchmarks', 'fixtures', 'pipeline.json.gz')
+
+spaceGroups = [("P1", 1), ("P-1", 2), ("C2/m", 12), ("Pnma", 62), ("P4/mmm", 123), ("I4/mmm", 139),
+               ("R-3m", 166), ("P6_3/mmc", 194), ("Fm-3m", 225), ("Fd-3m", 227), ("Im-3m", 229)]
+
+maxSitesPerCell = 48
+
+def loadFormulas(path=defaultFormulaFile, limit=None):
+    # Formulas from a bulk input file, spread evenly over the file
+    # when only part of it is used
+    with open(path, 'r') as f:
+        data = json.load(f)
+
+    formulas = [str(formula) for formula in data]
+
+    if limit and limit < len(formulas):
+        step = len(formulas) / limit
+        formulas = [formulas[int(i * step)] for i in range(limit)]
+
+    return formulas
+
+def emptyDataset(source):
+    return {
+        "version": replayDatasetVersion,
+        "source": source,
+        "createdAt": time.time(),
+        "mp": {},
+        "oqmd": {"phases": {}, "structures": {}}
+    }
+
+def makePolymorph(composition, rng):
+    from pymatgen.core import Lattice, Structure
+
+    formulaUnits = int(rng.choice([1, 2, 4]))
+    species = [str(el) for el, amount in composition.items() for _ in range(int(amount) * formulaUnits)]
+    species = species[:maxSitesPerCell]
+
+    volume = len(species) * rng.uniform(12, 22)
+    ratios = rng.uniform(0.7, 1.4, size=3)
+    lengths = ratios * (volume / np.prod(ratios)) ** (1 / 3)
+    angles = rng.uniform(80, 100, size=3)
+
+    lattice = Lattice.from_parameters(*lengths, *angles)
+    return Structure(lattice, species, rng.random((len(species), 3)))
+
+def makeDuplicate(structure, rng):
+    # Same structure as the matcher sees it: slightly distorted,
+    # rescaled, sometimes as a supercell
+    duplicate = structure.copy()
+    duplicate.perturb(0.02)
+    duplicate.scale_lattice(duplicate.volume * rng.uniform(0.97, 1.03))
+
+    if rng.random() < 0.3 and len(duplicate) * 2 <= maxSitesPerCell:
+        duplicate.make_supercell([1, 1, 2])
+
+    return duplicate
+
+def makePolymorphs(composition, rng):
+    structures = []
+
+    for _ in range(int(rng.integers(1, 9))):
+        if structures and rng.random() < 0.4:
+            structures.append(makeDuplicate(structures[int(rng.integers(len(structures)))], rng))
+        else:
+            structures.append(makePolymorph(composition, rng))
+
+    return structures
+
+def makeProperties(rng, isGroundState):
+    symbol, number = spaceGroups[int(rng.integers(len(spaceGroups)))]
+
+    return {
+        "bandGap": 0.0 if rng.random() < 0.3 else float(rng.uniform(0.1, 6)),
+        "hullDistance": 0.0 if isGroundState else float(rng.exponential(0.05)),
+        "formationEnergy": float(rng.uniform(-3, 0.5)),
+        "spaceGroupSymbol": symbol,
+        "spaceGroupNumber": number,
+    }
+
+def generateFixtures(formulas, seed=0, mpShare=0.7, oqmdShare=0.2):
+    from pymatgen.core import Composition
+    from src.data.oqmd.oqmdRetriever import getReducedFormula
+
+    dataset = emptyDataset("synthetic")
+    nextId = 1
+
+    for formula in formulas:
+        # Seeded per formula so the data for a formula doesn't depend
+        # on which other formulas are in the list
+        rng = np.random.default_rng([seed, zlib.crc32(formula.encode())])
+
+        try:
+            composition = Composition(formula, strict=True).reduced_composition
+        except Exception:
+            continue
+
+        draw = rng.random()
+        inMp = draw < mpShare
+        inOqmd = draw < mpShare + oqmdShare
+
+        structures = makePolymorphs(composition, rng) if inOqmd else []
+        reducedFormula = composition.reduced_formula
+
+        dataset["mp"][formula] = []
+        dataset["oqmd"]["phases"][formula] = {"data": []}
+
+        if inMp:
+            for i, structure in enumerate(structures):
+                properties = makeProperties(rng, i == 0)
+                dataset["mp"][formula].append({
+                    "material_id": f"mp-{nextId}",
+                    "deprecated": bool(i > 0 and rng.random() < 0.05),
+                    "formula_pretty": reducedFormula,
+                    "band_gap": properties["bandGap"],
+                    "energy_above_hull": properties["hullDistance"],
+                    "formation_energy_per_atom": properties["formationEnergy"],
+                    "symmetry": {"number": properties["spaceGroupNumber"]},
+                    "structure": structure.as_dict(),
+                })
+                nextId += 1
+
+        # Every formula that is in MP is in OQMD as well, so forced
+        # OQMD runs have the same coverage
+        if inOqmd:
+            optimadeFormula = getReducedFormula(formula)
+            items = dataset["oqmd"]["structures"].setdefault(optimadeFormula, [])
+
+            for i, structure in enumerate(structures):
+                properties = makeProperties(rng, i == 0)
+                dataset["oqmd"]["phases"][formula]["data"].append({
+                    "entry_id": nextId,
+                    "name": reducedFormula,
+                    "band_gap": properties["bandGap"],
+                    "stability": properties["hullDistance"],
+                    "delta_e": properties["formationEnergy"],
+                    "unit_cell": None,
+                    "spacegroup": properties["spaceGroupSymbol"],
+                })
+                items.append({
+                    "id": str(nextId),
+                    "type": "structures",
+                    "attributes": {
+                        "_oqmd_entry_id": nextId,
+                        "lattice_vectors": structure.lattice.matrix.tolist(),
+                        "species_at_sites": [str(site.specie) for site in structure],
+                        "cartesian_site_positions": structure.cart_coords.tolist(),
+                    }
+                })
+                nextId += 1
+
+    return dataset
+
+def mpDocToDict(doc):
+    return {
+        "material_id": str(doc.material_id),
+        "deprecated": doc.deprecated,
+        "formula_pretty": doc.formula_pretty,
+        "band_gap": doc.band_gap,
+        "energy_above_hull": doc.energy_above_hull,
+        "formation_energy_per_atom": doc.formation_energy_per_atom,
+        "symmetry": {"number": doc.symmetry.number},
+        "structure": doc.structure.as_dict() if doc.structure is not None else None,
+    }
+
+def recordFixtures(formulas, pageSize=100):
+    from mp_api.client import MPRester
+    from qmpy_rester import QMPYRester
+    from src.data.mp.mpRetriever import mpFields, mpKey
+    from src.data.oqmd.oqmdRetriever import getReducedFormula
+
+    dataset = emptyDataset("recorded")
+
+    with MPRester(mpKey) as mpr, QMPYRester() as oqmdr:
+        for i, formula in enumerate(formulas):
+            logDebug("Recording %s (%d/%d)", formula, i + 1, len(formulas))
+
+            try:
+                docs = mpr.materials.summary.search(formula=formula, fields=mpFields)
+                dataset["mp"][formula] = [mpDocToDict(doc) for doc in docs]
+            except Exception as e:
+                logDebug("MP lookup for %s failed: %s", formula, e)
+
+            try:
+                phases = oqmdr.get_oqmd_phases(verbose=False, composition=formula)
+                dataset["oqmd"]["phases"][formula] = phases
+
+                if phases.get("data"):
+                    optimadeFormula = getReducedFormula(formula)
+                    items = []
+                    offset = 0
+
+                    while True:
+                        page = oqmdr.get_optimade_structures(verbose=False, filter=f'chemical_formula_reduced="{optimadeFormula}"', limit=pageSize, offset=offset)
+                        items.extend(page.get("data") or [])
+                        offset += pageSize
+
+                        if not (page.get("meta") or {}).get("more_data_available"):
+                            break
+
+                    dataset["oqmd"]["structures"][optimadeFormula] = items
+            except Exception as e:
+                logDebug("OQMD lookup for %s failed: %s", formula, e)
+
+    return dataset
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or generate replay datasets for the benchmarks.")
+    parser.add_argument("mode", choices=["record", "generate"])
+    parser.add_argument("--formulas", default=defaultFormulaFile, help="Bulk input file to take the formulas from")
+    parser.add_argument("--limit", type=int, help="Only use this many formulas (spread over the file)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=defaultFixturePath)
+    args = parser.parse_args()
+
+    formulas = loadFormulas(args.formulas, args.limit)
+    dataset = recordFixtures(formulas) if args.mode == "record" else generateFixtures(formulas, args.seed)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    saveReplayDataset(dataset, args.output)
+
+    print(f"Wrote {len(dataset['mp'])} formulas to {args.output}")
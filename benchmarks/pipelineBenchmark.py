@@ -0,0 +1,210 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from unittest import mock
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, projectRoot)
+sys.path.insert(0, os.path.join(projectRoot, 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fixtures import loadFormulas, generateFixtures, defaultFixturePath, defaultFormulaFile
+from src.data.replay import saveReplayDataset, configureReplay, disableReplay
+from utils.debug import logDebug
+
+# Times every stage of retrieve -> filter -> score against a replay
+# dataset, so the numbers don't depend on the network and can be
+# compared between commits:
+#
+#     python benchmarks/pipelineBenchmark.py --limit 100 --output results.json
+#
+# Without --fixtures a synthetic dataset for the formulas in
+# bulkTestData/testData.json is generated (and kept) first.
+
+resultsVersion = 1
+
+@contextlib.contextmanager
+def replayClients(path, **options):
+    # Points the clients at the dataset (see src/data/replay.py) and
+    # turns off the persistent and in-memory retrieval caches so
+    # every run does the full work. Yields the replay transport.
+    with mock.patch("src.data.retrievalCache.cacheEnabled", False):
+        try:
+            transport = configureReplay(path, **options)
+            clearMemoryCaches()
+            yield transport
+        finally:
+            disableReplay()
+            clearMemoryCaches()
+
+def clearMemoryCaches():
+    from src.data.mp import mpRetriever
+    from src.data.oqmd import oqmdRetriever
+    from src.data import structureGrouping
+    from data import structureGrouping as cleanerGrouping
+    from src.indexCalc import calculator
+
+    mpRetriever.retrieveMpData.cache_clear()
+    oqmdRetriever.retrieveOqmdData.cache_clear()
+    calculator.getFinalCandidate.cache_clear()
+    structureGrouping.groupCache.clear()
+    cleanerGrouping.groupCache.clear()
+
+def timeStage(function, repeat, items):
+    # Runs the stage repeat times and keeps the output of the last
+    # run for the next stage
+    times = []
+    output = None
+
+    for _ in range(repeat):
+        clearMemoryCaches()
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+
+    median = statistics.median(times)
+
+    return output, {
+        "seconds": median,
+        "minSeconds": min(times),
+        "items": items,
+        "msPerItem": 1000 * median / items if items else None,
+    }
+
+def runBenchmark(fixturePath, formulas, repeat=3, baseline=False):
+    from src.data.mp import mpRetriever, mpCleaner
+    from src.data.oqmd import oqmdRetriever, oqmdCleaner
+    from src.data.structureGrouping import groupStructures
+    from src.data.candidateSelection import selectBestOfGroups, toMatDataObj
+    from src.data.materialTable import MaterialTable
+    from src.indexCalc.subscores import getTotalIndex
+    from src.bulkTest.bulkTester import runBulkTest
+
+    stages = {}
+
+    with replayClients(fixturePath) as transport:
+        def retrieve():
+            gathered = {}
+
+            for formula in formulas:
+                data = mpRetriever.retrieveMpData(formula)
+                if data[0].get("dataFound"):
+                    gathered[formula] = ("mp", data)
+                    continue
+
+                data = oqmdRetriever.retrieveOqmdData(formula)
+                if data[0].get("dataFound"):
+                    gathered[formula] = ("oqmd", data)
+
+            return gathered
+
+        gathered, stages["retrieval"] = timeStage(retrieve, repeat, len(formulas))
+        _, stages["retrievalBatchMp"] = timeStage(lambda: mpRetriever.retrieveMpDataBatch(formulas), repeat, len(formulas))
+
+        def build():
+            return {formula: (source, data, (mpCleaner if source == "mp" else oqmdCleaner).buildStructures(data))
+                    for formula, (source, data) in gathered.items()}
+
+        built, stages["structureConstruction"] = timeStage(build, repeat, len(gathered))
+        structureCount = sum(len(structures) for _, _, structures in built.values())
+
+        def group():
+            return {formula: groupStructures(structures, data[0].get("formula"))
+                    for formula, (_, data, structures) in built.items()}
+
+        grouped, stages["grouping"] = timeStage(group, repeat, structureCount)
+
+        if baseline:
+            from pymatgen.analysis.structure_matcher import StructureMatcher
+
+            _, stages["groupingBaseline"] = timeStage(
+                lambda: [StructureMatcher().group_structures(structures) for _, _, structures in built.values()],
+                repeat, structureCount)
+
+        def select():
+            candidates = []
+
+            for formula, (source, data, _) in built.items():
+                final = selectBestOfGroups(data, grouped[formula], "mpId" if source == "mp" else "oqmdId")
+                symmetry = final.get("symmetry") if source == "mp" else oqmdCleaner.getSpaceGroupNumber(final.get("symmetry"))
+                candidates.append(toMatDataObj(final, symmetry=symmetry))
+
+            return candidates
+
+        candidates, stages["candidateSelection"] = timeStage(select, repeat, len(built))
+
+        _, stages["scoring"] = timeStage(lambda: [getTotalIndex(c) for c in candidates], repeat, len(candidates))
+        _, stages["scoringBatch"] = timeStage(lambda: MaterialTable.fromMaterials(candidates).getTotalIndices(), repeat, len(candidates))
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(formulas, f)
+
+            def writeOutput():
+                from src.bulkTest.checkpoint import openCheckpoint, makeRecord, writeRecord
+                from src.bulkTest.bulkTester import writeSummaryFiles
+
+                checkpoint, _ = openCheckpoint(tempDir, 'prediction', resume=False)
+                with checkpoint:
+                    for candidate in candidates:
+                        result = getTotalIndex(candidate)
+                        writeRecord(checkpoint, makeRecord(candidate.formula, None, {'index': result['index'], 'candidate': candidate.toDict()}))
+
+                return writeSummaryFiles(tempDir, False, 0.7)
+
+            _, stages["outputWriting"] = timeStage(writeOutput, repeat, len(candidates))
+
+            _, stages["endToEnd"] = timeStage(lambda: runBulkTest(inputPath, tempDir, resume=False), repeat, len(formulas))
+
+    return {
+        "resultsVersion": resultsVersion,
+        "createdAt": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "fixture": {
+            "source": transport.dataset.get("source"),
+            "formulas": len(formulas),
+            "found": len(gathered),
+            "structures": structureCount,
+        },
+        "repeat": repeat,
+        "stages": stages,
+    }
+
+def ensureDataset(path):
+    if os.path.exists(path):
+        return
+
+    logDebug("No replay dataset at %s, generating a synthetic one", path)
+    dataset = generateFixtures(loadFormulas(defaultFormulaFile))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    saveReplayDataset(dataset, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the retrieve -> filter -> score pipeline against a replay dataset.")
+    parser.add_argument("--fixtures", default=defaultFixturePath, help="Replay dataset (generated if it doesn't exist)")
+    parser.add_argument("--formulas", default=defaultFormulaFile, help="Bulk input file with the formulas to run")
+    parser.add_argument("--limit", type=int, default=100, help="Number of formulas (spread over the file), 0 for all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", action="store_true", help="Also time pymatgen's plain group_structures")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    formulas = loadFormulas(args.formulas, args.limit or None)
+    ensureDataset(args.fixtures)
+    results = runBenchmark(args.fixtures, formulas, args.repeat, args.baseline)
+
+    for name, stage in results["stages"].items():
+        print(f"{name:<24} {stage['seconds']:8.3f}s  {stage['items']:6d} items  {stage['msPerItem'] or 0:8.3f} ms/item")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Cold start benchmark. Every target is timed in a fresh interpreter
+# (so nothing is already imported) and the heavy dependencies that
+# ended up loaded are reported next to the time.
+#
+#     python benchmarks/startupTime.py --repeat 5 --output startup.json
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+heavyModules = ["pymatgen", "mp_api", "qmpy_rester", "gemmi", "mendeleev", "chemparse", "matplotlib", "PyQt6", "numpy"]
+
+targets = {
+    "import src.data": "import src.data",
+    "import src.indexCalc": "import src.indexCalc",
+    "import src.bulkTest": "import src.bulkTest",
+    "score a cached candidate": (
+        "from src.indexCalc import getTotalIndex\n"
+        "from src.data import matDataObj\n"
+        "getTotalIndex(matDataObj('MoS2', 1.2, 0.0, -0.9, 194))"
+    ),
+    "import src.ui": "import src.ui.__main__",
+    "open the UI window": (
+        "from PyQt6.QtWidgets import QApplication\n"
+        "import src.ui.__main__ as ui\n"
+        "app = QApplication([])\n"
+        "window = ui.MainWindow()\n"
+        "window.show()"
+    ),
+}
+
+timerTemplate = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def timeTarget(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([projectRoot, os.path.join(projectRoot, "src"), env.get("PYTHONPATH", "")])
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+    output = subprocess.run(
+        [sys.executable, "-c", timerTemplate.format(code=code, heavy=heavyModules)],
+        cwd=projectRoot, env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+    # The result is the last line, anything before it is log output
+    return json.loads(output.strip().splitlines()[-1])
+
+def runBenchmark(repeat=3):
+    results = {}
+
+    for name, code in targets.items():
+        runs = [timeTarget(code) for _ in range(repeat)]
+        results[name] = {
+            "medianSeconds": statistics.median(run["seconds"] for run in runs),
+            "minSeconds": min(run["seconds"] for run in runs),
+            "loaded": runs[-1]["loaded"],
+        }
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time cold imports of the QSI packages and the UI.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    results = runBenchmark(args.repeat)
+
+    for name, result in results.items():
+        print(f"{name:<28} {result['medianSeconds']:7.3f}s  {', '.join(result['loaded']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
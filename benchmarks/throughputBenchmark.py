@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, projectRoot)
+sys.path.insert(0, os.path.join(projectRoot, 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fixtures import loadFormulas, defaultFixturePath, defaultFormulaFile
+from pipelineBenchmark import replayClients, ensureDataset
+
+# Throughput of the bulk pipeline against a replay dataset that acts
+# like the live APIs: every request takes some time, a share of them
+# fail and too many requests per second get rate limited. Runs the
+# same formulas once per worker count:
+#
+#     python benchmarks/throughputBenchmark.py --workers 1,4,8 --latency 0.2 --error-rate 0.02 --rate-limit 20
+
+resultsVersion = 1
+
+def countRecords(outputDir):
+    from src.bulkTest.checkpoint import iterLatestRecords
+
+    records = list(iterLatestRecords(outputDir))
+    return {
+        "records": len(records),
+        "errors": sum(1 for record in records if record.get("error")),
+        "transientErrors": sum(1 for record in records if record.get("errorType") == "transient"),
+    }
+
+def runThroughput(fixturePath, formulas, workerCounts, **transportOptions):
+    from src.bulkTest.bulkTester import runBulkTest
+
+    runs = []
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        inputPath = os.path.join(tempDir, "input.json")
+        with open(inputPath, 'w') as f:
+            json.dump(formulas, f)
+
+        for workers in workerCounts:
+            outputDir = os.path.join(tempDir, f"workers{workers}")
+            os.makedirs(outputDir)
+
+            # A fresh transport per run so the request counts and the
+            # rate limit window start from zero
+            with replayClients(fixturePath, **transportOptions) as transport:
+                start = time.perf_counter()
+                runBulkTest(inputPath, outputDir, maxWorkers=workers, resume=False)
+                seconds = time.perf_counter() - start
+
+                runs.append({
+                    "workers": workers,
+                    "seconds": seconds,
+                    "formulasPerSecond": len(formulas) / seconds if seconds else None,
+                    "transport": transport.stats(),
+                    **countRecords(outputDir),
+                })
+
+    return {
+        "resultsVersion": resultsVersion,
+        "createdAt": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "formulas": len(formulas),
+        "transportOptions": transportOptions,
+        "runs": runs,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure bulk pipeline throughput against a replay dataset with simulated API behavior.")
+    parser.add_argument("--fixtures", default=defaultFixturePath, help="Replay dataset (generated if it doesn't exist)")
+    parser.add_argument("--formulas", default=defaultFormulaFile, help="Bulk input file with the formulas to run")
+    parser.add_argument("--limit", type=int, default=100, help="Number of formulas (spread over the file), 0 for all")
+    parser.add_argument("--workers", default="1,4,8", help="Comma separated worker counts to run")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Latency varies by +- this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with a 503")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Requests per second before 429s, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    formulas = loadFormulas(args.formulas, args.limit or None)
+    ensureDataset(args.fixtures)
+
+    results = runThroughput(
+        args.fixtures, formulas, [int(w) for w in args.workers.split(",")],
+        latency=args.latency, jitter=args.jitter, errorRate=args.error_rate, rateLimit=args.rate_limit, seed=args.seed
+    )
+
+    for run in results["runs"]:
+        transport = run["transport"]
+        print(f"{run['workers']:3d} workers  {run['seconds']:8.2f}s  {run['formulasPerSecond']:7.2f} formulas/s  "
+              f"{transport['requests']:5d} requests  {transport['errors']:4d} errors  {transport['rateLimited']:4d} rate limited  "
+              f"{run['errors']:4d} failed formulas ({run['transientErrors']} transient)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -1,5 +1,18 @@
+import importlib
+
 from utils.debug import logDebug
-from .bulkTester import runBulkTest
-from .confusionMatrixUi import ConfusionMatrixWindow
 
-logDebug("Bulk Tester Results Imported")
\ No newline at end of file
+# Imported on first use, the confusion matrix window needs PyQt6 and
+# the bulk tester the whole calculation pipeline
+lazyNames = {
+    "runBulkTest": ".bulkTester",
+    "rescoreBulkTest": ".rescorer",
+    "ConfusionMatrixWindow": ".confusionMatrixUi",
+}
+
+def __getattr__(name):
+    if name in lazyNames:
+        return getattr(importlib.import_module(lazyNames[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+logDebug("Bulk Tester Results Imported")
@@ -1,79 +1,219 @@
+import itertools
 import json
 import os
 import sys
+from collections import deque
 
 projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, projectRoot)
 
-from indexCalc.calculator import calculateQsi
-from src.bulkTest.confusionMatrixUi import ConfusionMatrixWindow
+from src.bulkTest.pipeline import iterQsiResults
+from src.bulkTest.checkpoint import openCheckpoint, iterLatestRecords, makeRecord, writeRecord, markFinished, getInputIdentity, flushInterval
+from src.data.requestPolicy import errorTransient
+from src.data.formulas import getFormulaKey
+from src.indexCalc.subscores import getQsiUpperBound
+from src.bulkTest.inputReader import readInput, countInputItems, InputFileError
 from utils.debug import logDebug
+from utils.profiling import span, profiled, isProfiling, resetStageStats, writeStageStats
 
-def runBulkTest(inputFilePath, outputDir, threshold=0.7, progressCallback=None):
-    logDebug(f"Starting bulk test with input file: {inputFilePath}")
+# With pruning on, formulas whose QSI can't reach the threshold no
+# matter what MP or OQMD say (see getQsiUpperBound) are recorded as
+# pruned without being looked up
+pruneDefault = os.getenv("QSI_PRUNE", "").lower() in ("1", "true", "yes")
+
+def runBulkTest(inputFilePath, outputDir, threshold=0.7, progressCallback=None, maxWorkers=1, resume=None, prune=None):
+    # Materials are streamed from the input file through the pipeline
+    # and into the checkpoint, so memory doesn't grow with the size
+    # of the input (apart from a set of formula keys). progressCallback
+    # gets the position of the material in the input and the number of
+    # materials, counted in a quick first pass over the file.
+    #
+    # With profiling on (see utils/profiling.py) the per-stage timings
+    # of the run are written to timings.json next to the results.
+    #
+    # prune defaults to QSI_PRUNE, see pruneDefault.
+    #
+    # By default (resume=None) an unfinished run on the same input
+    # file is picked up where it stopped, and anything else in
+    # outputDir is started over. resume=True picks up the checkpoint
+    # even if the input changed or the run had finished, resume=False
+    # always starts over.
+    if prune is None:
+        prune = pruneDefault
+
+    with profiled("bulkTest"):
+        return runStages(inputFilePath, outputDir, threshold, progressCallback, maxWorkers, resume, prune)
+
+def prunedResult(upperBound, threshold):
+    return {'index': None, 'subScores': None, 'candidate': None, 'upperBound': upperBound,
+            'error': f"Pruned, the QSI can be at most {upperBound:.4f} which is below the threshold of {threshold}"}
+
+def runStages(inputFilePath, outputDir, threshold, progressCallback, maxWorkers, resume, prune=False):
+    logDebug("Starting bulk test with input file: %s", inputFilePath)
     try:
-        with open(inputFilePath, 'r') as f:
-            data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logDebug(f"Error reading input file: {e}")
+        mode, inputItems = readInput(inputFilePath)
+        firstItem = next(inputItems, None)
+    except (FileNotFoundError, ValueError) as e:
+        logDebug("Error reading input file: %s", e)
         return None
 
-    isValidationMode = isinstance(data, dict)
-    isPredictionMode = isinstance(data, list)
-
-    if not isValidationMode and not isPredictionMode:
-        logDebug(f"Error: Input file must be a JSON object (for validation) or a JSON array of formulas (for prediction).")
+    if firstItem is None:
+        logDebug("No materials found to process.")
         return None
 
-    materialItemsToProcess = []
-    inconclusiveMaterials = []
+    isValidationMode = mode == 'validation'
 
-    if isValidationMode:
-        for formula, isTrulySuitable in data.items():
-            if isinstance(isTrulySuitable, bool):
-                materialItemsToProcess.append((formula, isTrulySuitable))
-            else:
-                logDebug(f"Invalid format for '{formula}': value must be a boolean. Adding to inconclusive.")
-                inconclusiveMaterials.append(formula)
-    else: 
-        for i, item in enumerate(data):
-            if isinstance(item, str):
-                materialItemsToProcess.append((item, None))
-            else:
-                logDebug(f"Invalid item in array at index {i}: not a string formula. Adding to inconclusive.")
-                inconclusiveMaterials.append(str(item))
+    if isProfiling():
+        resetStageStats()
 
-    if not materialItemsToProcess and not inconclusiveMaterials:
-        logDebug("No materials found to process.")
+    # Every finished material is appended to results.jsonl as soon as
+    # it is scored. A restarted run picks the file back up and only
+    # processes the materials that aren't in it yet.
+    checkpoint, completed = openCheckpoint(outputDir, mode, resume, getInputIdentity(inputFilePath), threshold, prune)
+
+    if completed:
+        logDebug("Resuming bulk test, %d materials already done", len(completed))
+
+    transientFailures = 0
+    duplicates = 0
+    prunedCount = 0
+
+    totalCount = countInputItems(inputFilePath) if progressCallback else 0
+
+    # Keys of every formula in this input, so the summary only covers
+    # this input even when a resumed checkpoint holds other materials
+    inputKeys = set()
+
+    # Truths and input positions of the formulas handed to the
+    # pipeline that haven't come back yet. Results come back in input
+    # order, so this never holds more than the pipeline's window.
+    pendingTruths = deque()
+    processedCount = len(completed)
+
+    def iterFormulas():
+        nonlocal duplicates, prunedCount
+
+        for position, (formula, isTrulySuitable, isValid) in enumerate(itertools.chain([firstItem], inputItems), 1):
+            # Equivalent spellings ("FeS2", "S2Fe", "Fe2S4") are the
+            # same material, only the first one is processed
+            key = getFormulaKey(formula)
+            inputKeys.add(key)
+
+            if key in completed:
+                duplicates += 1
+                continue
+            completed.add(key)
+
+            if not isValid:
+                logDebug("Invalid input entry '%s'. Adding to inconclusive.", formula)
+                writeRecord(checkpoint, makeRecord(formula, None, {'error': "Invalid input entry"}))
+                continue
+
+            if prune:
+                with span("pruning"):
+                    upperBound = getQsiUpperBound(formula)
+
+                if upperBound is not None and upperBound < threshold:
+                    prunedCount += 1
+                    writeRecord(checkpoint, makeRecord(formula, isTrulySuitable, prunedResult(upperBound, threshold)))
+                    continue
+
+            pendingTruths.append((isTrulySuitable, position))
+            yield formula
+
+    try:
+        for formula, result in iterQsiResults(iterFormulas(), maxWorkers):
+            isTrulySuitable, position = pendingTruths.popleft()
+            processedCount += 1
+
+            logDebug("Processing %s (%d)", formula, processedCount)
+            if progressCallback:
+                progressCallback(position, totalCount, formula)
+
+            if result.get('error') or result.get('index') is None:
+                logDebug("Could not process %s: %s", formula, result.get('error', 'QSI is None'))
+
+            if result.get('errorType') == errorTransient:
+                transientFailures += 1
+
+            with span("outputWriting"):
+                writeRecord(checkpoint, makeRecord(formula, isTrulySuitable, result))
+
+            if processedCount % flushInterval == 0:
+                checkpoint.flush()
+
+        if not transientFailures:
+            markFinished(checkpoint)
+    except InputFileError as e:
+        # A malformed input file only shows up once the reader gets
+        # there, everything before it is kept in the checkpoint
+        logDebug("Error reading input file: %s", e)
         return None
+    finally:
+        checkpoint.close()
+
+    with span("summaryWriting"):
+        summary = writeSummaryFiles(outputDir, isValidationMode, threshold, inputKeys)
 
-    chunkSize = 50
-    totalMaterials = len(materialItemsToProcess)
-    
+    if isProfiling():
+        writeStageStats(os.path.join(outputDir, 'timings.json'))
+
+    if prunedCount:
+        logDebug("Pruned %d materials whose QSI can't reach the threshold without looking them up", prunedCount)
+
+    if duplicates:
+        logDebug("Skipped %d input entries that were already done or repeated an earlier (possibly differently written) formula", duplicates)
+
+    if transientFailures:
+        logDebug("%d materials failed on temporary API errors and are listed as inconclusive, run the bulk test again on '%s' to retry them", transientFailures, outputDir)
+
+    logDebug("Bulk test finished. Results saved in '%s' directory.", outputDir)
+
+    return summary
+
+def writeSummaryFiles(outputDir, isValidationMode, threshold, inputKeys=None):
+    # The summary files are only built once, from the checkpoint, so
+    # their cost doesn't grow with every chunk. Only the indices are
+    # held in memory, the candidates are streamed to disk. With
+    # inputKeys only the records of those formulas are included.
     allIndices = {}
+    prunedMaterials = {}
+    inconclusiveMaterials = []
     truePositives, trueNegatives, falsePositives, falseNegatives = {}, {}, {}, {}
 
-    for i in range(0, totalMaterials, chunkSize):
-        chunk = materialItemsToProcess[i:i+chunkSize]
-        
-        for processedCount, (formula, isTrulySuitable) in enumerate(chunk, start=i):
-            logDebug(f"Processing {formula} ({processedCount + 1}/{totalMaterials})")
-            if progressCallback:
-                progressCallback(processedCount + 1, totalMaterials, formula)
+    with open(os.path.join(outputDir, 'candidates.json'), 'w') as candidatesFile:
+        mode = 'validation' if isValidationMode else 'prediction'
+        candidatesFile.write(f'{{\n    "mode": {json.dumps(mode)},\n    "materials": {{')
+        separator = "\n"
 
-            result = calculateQsi(formula)
-            
-            if result.get('error') or result.get('index') is None:
-                logDebug(f"Could not process {formula}: {result.get('error', 'QSI is None')}")
-                if formula not in inconclusiveMaterials:
-                    inconclusiveMaterials.append(formula)
+        for record in iterLatestRecords(outputDir):
+            formula = record['formula']
+
+            if inputKeys is not None and getFormulaKey(formula) not in inputKeys:
                 continue
+            isTrulySuitable = record.get('isTrulySuitable')
 
-            qsi = result['index']
-            allIndices[formula] = qsi
+            # Kept so the run can be rescored later without fetching
+            entry = {"isTrulySuitable": isTrulySuitable, "candidate": record.get('candidate')}
+            candidatesFile.write(f"{separator}        {json.dumps(formula)}: {json.dumps(entry)}")
+            separator = ",\n"
 
-            if isValidationMode:
+            if record.get('upperBound') is not None:
+                # Pruned materials were never scored. They are listed
+                # with their upper bound and always count as predicted
+                # unsuitable, with no QSI.
+                prunedMaterials[formula] = record['upperBound']
+                qsi = None
+                isPredictedSuitable = False
+            elif record.get('error') or record.get('index') is None:
+                inconclusiveMaterials.append(formula)
+                continue
+            else:
+                qsi = record['index']
+                allIndices[formula] = qsi
                 isPredictedSuitable = qsi >= threshold
+
+            if isValidationMode:
                 if isTrulySuitable and isPredictedSuitable:
                     truePositives[formula] = qsi
                 elif not isTrulySuitable and not isPredictedSuitable:
@@ -82,13 +222,17 @@ def runBulkTest(inputFilePath, outputDir, threshold=0.7, progressCallback=None):
                     falsePositives[formula] = qsi
                 elif isTrulySuitable and not isPredictedSuitable:
                     falseNegatives[formula] = qsi
-        
-        writeChunkResults(outputDir, isValidationMode, allIndices,
-                             truePositives, trueNegatives, falsePositives, falseNegatives,
-                             inconclusiveMaterials)
 
-    logDebug(f"Bulk test finished. Results saved in '{outputDir}' directory.")
-    
+        candidatesFile.write("\n    }\n}\n")
+
+    writeChunkResults(outputDir, isValidationMode, allIndices,
+                         truePositives, trueNegatives, falsePositives, falseNegatives,
+                         inconclusiveMaterials)
+
+    if prunedMaterials or os.path.exists(os.path.join(outputDir, 'pruned.json')):
+        with open(os.path.join(outputDir, 'pruned.json'), 'w') as f:
+            json.dump(prunedMaterials, f, indent=4)
+
     if isValidationMode:
         return ('validation', (len(truePositives), len(trueNegatives), len(falsePositives), len(falseNegatives), len(allIndices), len(inconclusiveMaterials)))
     else:
@@ -108,4 +252,4 @@ def writeChunkResults(outputDir, isValidationMode, allIndices, tp, tn, fp, fn, i
         with open(os.path.join(outputDir, 'falsePositives.json'), 'w') as f:
             json.dump(fp, f, indent=4)
         with open(os.path.join(outputDir, 'falseNegatives.json'), 'w') as f:
-            json.dump(fn, f, indent=4)
\ No newline at end of file
+            json.dump(fn, f, indent=4)
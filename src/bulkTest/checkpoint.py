@@ -0,0 +1,176 @@
+import json
+import os
+
+from utils.debug import logDebug
+from src.data.requestPolicy import errorTransient
+from src.data.formulas import getFormulaKey
+
+checkpointFileName = 'results.jsonl'
+checkpointVersion = 2
+
+# Records are flushed to disk every flushInterval results, so at most
+# that many finished materials are lost if the process is killed
+flushInterval = 10
+
+def getCheckpointPath(outputDir):
+    return os.path.join(outputDir, checkpointFileName)
+
+def getInputIdentity(inputFilePath):
+    # Path, size and modification time of the input file, stored in
+    # the header so a rerun can tell whether it got the same input
+    # (cheaper than hashing a huge file)
+    stat = os.stat(inputFilePath)
+    return {"path": os.path.abspath(inputFilePath), "size": stat.st_size, "mtime": stat.st_mtime}
+
+def isRecord(entry):
+    # Lines after the header are material records or the marker a
+    # finished run appends
+    return "formula" in entry
+
+def iterCheckpointLines(outputDir):
+    # Yields (entry, lineLength) for every complete, readable line of
+    # the checkpoint. A run that was killed mid-write leaves a partial
+    # last line, which ends the iteration (and is later truncated) so
+    # that material is simply redone.
+    path = getCheckpointPath(outputDir)
+
+    if not os.path.exists(path):
+        return
+
+    with open(path, 'rb') as f:
+        for lineNumber, line in enumerate(f):
+            if not line.endswith(b"\n"):
+                logDebug("Dropping incomplete last line of %s", path)
+                return
+
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logDebug("Dropping unreadable line %d of %s", lineNumber + 1, path)
+                return
+
+            yield entry, len(line)
+
+def isPruned(entry):
+    return entry.get("upperBound") is not None
+
+def readCheckpoint(outputDir, mode, inputIdentity=None, resume=None, threshold=None, prune=False):
+    # Returns the canonical keys (see formulas.py) of the formulas a
+    # previous run already finished and the byte offset where the
+    # last complete line ends. Only the keys are kept so memory stays
+    # small for huge runs.
+    #
+    # With resume=None a checkpoint is only picked up if it was left
+    # by an unfinished run on the same input file, resume=True picks
+    # up any checkpoint of the same mode.
+    #
+    # Pruned materials only count as finished if this run prunes too
+    # and their bound is still below its threshold, otherwise they are
+    # looked up now.
+    completed = set()
+    validLength = 0
+    finished = False
+
+    for lineNumber, (entry, lineLength) in enumerate(iterCheckpointLines(outputDir)):
+        if lineNumber == 0:
+            if entry.get("checkpointVersion") != checkpointVersion or entry.get("mode") != mode:
+                logDebug("Checkpoint in '%s' is from a different kind of run, starting over", outputDir)
+                return set(), 0
+            if resume is None and inputIdentity is not None and entry.get("input") != inputIdentity:
+                logDebug("Checkpoint in '%s' is from a different input file, starting over", outputDir)
+                return set(), 0
+            if entry.get("prune") and (not prune or entry.get("threshold") != threshold):
+                logDebug("Checkpoint in '%s' was pruned at a threshold of %s, pruned materials that may now pass are looked up",
+                         outputDir, entry.get("threshold"))
+        elif not isRecord(entry):
+            finished = entry.get("finished", False)
+        else:
+            finished = False
+
+            # Materials that failed on a rate limit, timeout or outage
+            # are done again by the next run
+            isTransient = entry.get("errorType") == errorTransient
+            isStillPruned = prune and isPruned(entry) and entry["upperBound"] < threshold
+
+            if not isTransient and (not isPruned(entry) or isStillPruned):
+                completed.add(getFormulaKey(entry["formula"]))
+
+        validLength += lineLength
+
+    if finished and resume is None:
+        logDebug("Checkpoint in '%s' is from a finished run, starting over", outputDir)
+        return set(), 0
+
+    return completed, validLength
+
+def iterCheckpointRecords(outputDir):
+    # Every record in the checkpoint (skipping the header), in the
+    # order they were written
+    for lineNumber, (entry, _) in enumerate(iterCheckpointLines(outputDir)):
+        if lineNumber > 0 and isRecord(entry):
+            yield entry
+
+def openCheckpoint(outputDir, mode, resume=None, inputIdentity=None, threshold=None, prune=False):
+    # Opens the checkpoint for appending and returns the file along
+    # with the keys of the formulas that are already in it. resume is
+    # None (pick up an unfinished run on the same input), True or
+    # False (always start over). The threshold and prune setting are
+    # kept in the header next to the input.
+    path = getCheckpointPath(outputDir)
+
+    if resume is False:
+        completed, validLength = set(), 0
+    else:
+        completed, validLength = readCheckpoint(outputDir, mode, inputIdentity, resume, threshold, prune)
+
+    if validLength == 0:
+        f = open(path, 'w')
+        writeRecord(f, {"checkpointVersion": checkpointVersion, "mode": mode, "input": inputIdentity,
+                        "threshold": threshold, "prune": prune})
+        return f, completed
+
+    f = open(path, 'r+')
+    f.truncate(validLength)
+    f.seek(validLength)
+
+    return f, completed
+
+def writeRecord(f, record):
+    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+def markFinished(f):
+    # Written when a run got through its whole input with nothing left
+    # to retry, a rerun then starts over instead of resuming
+    writeRecord(f, {"finished": True})
+
+def makeRecord(formula, isTrulySuitable, result):
+    record = {
+        "formula": formula,
+        "isTrulySuitable": isTrulySuitable,
+        "index": result.get('index'),
+        "candidate": result.get('candidate'),
+        "error": result.get('error')
+    }
+
+    if result.get('errorType'):
+        record["errorType"] = result['errorType']
+    if result.get('upperBound') is not None:
+        record["upperBound"] = result['upperBound']
+
+    return record
+
+def iterLatestRecords(outputDir):
+    # Like iterCheckpointRecords, but a material that was redone after
+    # a transient failure or pruning only shows up with its last
+    # record, even if it was redone under another spelling. Only the
+    # materials that can be redone are tracked, so this stays small.
+    latest = {}
+
+    for i, record in enumerate(iterCheckpointRecords(outputDir)):
+        key = getFormulaKey(record["formula"])
+        if record.get("errorType") == errorTransient or isPruned(record) or key in latest:
+            latest[key] = i
+
+    for i, record in enumerate(iterCheckpointRecords(outputDir)):
+        if latest.get(getFormulaKey(record["formula"]), i) == i:
+            yield record
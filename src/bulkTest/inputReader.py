@@ -0,0 +1,287 @@
+import csv
+import json
+import os
+
+# Bulk input files are read lazily, one material at a time, so the
+# size of the input doesn't matter and the first materials can be
+# processed before the rest of the file has been read.
+#
+# Supported formats:
+#   .json           - the original object ({"Si": true, ...}) for
+#                     validation or array (["Si", ...]) for prediction
+#   .jsonl / .ndjson - one material per line, either a formula string
+#                     (prediction) or an object like
+#                     {"formula": "Si", "isTrulySuitable": true} or
+#                     {"Si": true} (validation)
+#   .csv            - a header row with a "formula" column and, for
+#                     validation, an "isTrulySuitable" column
+#
+# Every reader yields (formula, isTrulySuitable, isValid) tuples.
+# isTrulySuitable is None in prediction mode and isValid is False
+# for entries that should be reported as inconclusive.
+
+readChunkSize = 1 << 16
+
+truthValues = {"true": True, "1": True, "yes": True, "false": False, "0": False, "no": False}
+
+class InputFileError(ValueError):
+    pass
+
+def getInputFormat(inputFilePath):
+    extension = os.path.splitext(inputFilePath)[1].lower()
+
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    return "json"
+
+def readInput(inputFilePath):
+    # Returns the mode ('validation' or 'prediction') and a generator
+    # over the materials. Only the start of the file is read here, so
+    # errors further into the file are raised (as InputFileError)
+    # while the generator is consumed.
+    inputFormat = getInputFormat(inputFilePath)
+
+    try:
+        if inputFormat == "jsonl":
+            mode, items = readJsonLines(inputFilePath)
+        elif inputFormat == "csv":
+            mode, items = readCsv(inputFilePath)
+        else:
+            mode, items = readJson(inputFilePath)
+    except ValueError as e:
+        raise InputFileError(str(e)) from e
+
+    return mode, guardItems(items)
+
+def countInputItems(inputFilePath):
+    # Number of materials in the file, from a separate streaming pass
+    # (for progress reporting), 0 if the file can't be read through
+    try:
+        _, items = readInput(inputFilePath)
+        return sum(1 for _ in items)
+    except (OSError, ValueError):
+        return 0
+
+def guardItems(items):
+    # Tells errors in the file apart from errors in whatever is
+    # consuming the generator
+    try:
+        yield from items
+    except ValueError as e:
+        raise InputFileError(str(e)) from e
+
+def parseTruth(value):
+    if isinstance(value, bool):
+        return value, True
+    if isinstance(value, str) and value.strip().lower() in truthValues:
+        return truthValues[value.strip().lower()], True
+    return None, False
+
+def readJson(inputFilePath):
+    f = open(inputFilePath, 'r')
+    stream = JsonStream(f)
+
+    try:
+        opening = stream.peek()
+    except ValueError:
+        f.close()
+        raise
+
+    if opening == "{":
+        return 'validation', iterJsonObject(f, stream)
+    if opening == "[":
+        return 'prediction', iterJsonArray(f, stream)
+
+    f.close()
+    raise ValueError("Input file must be a JSON object (for validation) or a JSON array of formulas (for prediction).")
+
+def iterJsonObject(f, stream):
+    with f:
+        for formula, value in stream.iterObject():
+            isTrulySuitable, isValid = (value, True) if isinstance(value, bool) else (None, False)
+            yield formula, isTrulySuitable, isValid
+
+def iterJsonArray(f, stream):
+    with f:
+        for item in stream.iterArray():
+            if isinstance(item, str):
+                yield item, None, True
+            else:
+                yield str(item), None, False
+
+def readJsonLines(inputFilePath):
+    lines = iterJsonLines(inputFilePath)
+    first = next(lines, None)
+
+    if first is None:
+        return 'prediction', iter(())
+
+    # An object on the first line means the file carries known
+    # suitabilities
+    mode = 'validation' if isinstance(first, dict) else 'prediction'
+
+    def iterItems():
+        yield parseJsonLine(first, mode)
+        for item in lines:
+            yield parseJsonLine(item, mode)
+
+    return mode, iterItems()
+
+def iterJsonLines(inputFilePath):
+    with open(inputFilePath, 'r') as f:
+        for lineNumber, line in enumerate(f):
+            if not line.strip():
+                continue
+
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON on line {lineNumber + 1} of {inputFilePath}: {e}")
+
+def parseJsonLine(item, mode):
+    if mode == 'prediction':
+        return (item, None, True) if isinstance(item, str) else (str(item), None, False)
+
+    if not isinstance(item, dict):
+        return str(item), None, False
+
+    if "formula" in item:
+        formula = item["formula"]
+        value = item.get("isTrulySuitable")
+    elif len(item) == 1:
+        formula, value = next(iter(item.items()))
+    else:
+        return json.dumps(item), None, False
+
+    if not isinstance(formula, str):
+        return str(formula), None, False
+
+    isTrulySuitable, isValid = (value, True) if isinstance(value, bool) else (None, False)
+    return formula, isTrulySuitable, isValid
+
+def readCsv(inputFilePath):
+    f = open(inputFilePath, 'r', newline='')
+    reader = csv.reader(f)
+    header = [column.strip() for column in next(reader, [])]
+
+    if "formula" not in header:
+        f.close()
+        raise ValueError(f"CSV input {inputFilePath} needs a header row with a 'formula' column.")
+
+    formulaColumn = header.index("formula")
+    truthColumn = header.index("isTrulySuitable") if "isTrulySuitable" in header else None
+    mode = 'validation' if truthColumn is not None else 'prediction'
+
+    def iterRows():
+        with f:
+            for row in reader:
+                if not row or not any(cell.strip() for cell in row):
+                    continue
+
+                formula = row[formulaColumn].strip() if formulaColumn < len(row) else ""
+                if truthColumn is None:
+                    yield formula, None, bool(formula)
+                    continue
+
+                isTrulySuitable, isValid = parseTruth(row[truthColumn] if truthColumn < len(row) else None)
+                yield formula, isTrulySuitable, isValid and bool(formula)
+
+    return mode, iterRows()
+
+class JsonStream:
+    # Minimal incremental reader for a single top level JSON object
+    # or array. Keeps only a small window of the file in memory and
+    # decodes one member at a time with json's raw_decode.
+
+    def __init__(self, f, chunkSize=None):
+        self.f = f
+        self.chunkSize = chunkSize or readChunkSize
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(self.chunkSize)
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        # Drop the part that has already been consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def expect(self, characters):
+        character = self.peek()
+
+        if character not in characters:
+            raise ValueError(f"Expected one of '{characters}' in JSON input but found '{character}'")
+
+        self.pos += 1
+        return character
+
+    def decode(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Most likely cut off at the end of the window
+                if self.fill():
+                    continue
+                raise
+
+            # A number or literal at the very end of the window might
+            # continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def iterObject(self):
+        self.expect("{")
+
+        if self.peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.decode()
+            if not isinstance(key, str):
+                raise ValueError("JSON object keys must be strings")
+
+            self.expect(":")
+            yield key, self.decode()
+
+            if self.expect(",}") == "}":
+                return
+
+    def iterArray(self):
+        self.expect("[")
+
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        while True:
+            yield self.decode()
+
+            if self.expect(",]") == "]":
+                return
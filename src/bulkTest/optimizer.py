@@ -0,0 +1,252 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, projectRoot)
+
+from src.bulkTest.rescorer import loadCandidates, getConfusionMatrix
+from src.indexCalc.subscores import weightsDefault
+from src.indexCalc.batchScores import subscoreNames, getIndexSweep, weightsToVector
+from utils.debug import logDebug
+
+metrics = ["accuracy", "f1"]
+
+# Number of weight vectors scored per matrix product, keeps the
+# M x N index matrix to a few tens of MB for large validation sets
+sweepChunkSize = 2000
+
+def getThresholdCurves(truths, indices):
+    # Every useful threshold for one set of indices. Sorting the
+    # scores in descending order, a threshold equal to the k-th
+    # score predicts the top k materials as suitable, so the
+    # confusion matrix for every threshold comes from cumulative
+    # sums. Works on M rows of indices at once (M x N input).
+    #
+    # Column 0 is a threshold above every score (highest score + 1),
+    # which predicts nothing as suitable, the (0, 0) end of the ROC
+    # curve.
+    truths = np.asarray(truths, dtype=bool)
+    indices = np.atleast_2d(indices)
+    count = indices.shape[1]
+
+    order = np.argsort(-indices, axis=1, kind="stable")
+    sortedIndices = np.take_along_axis(indices, order, axis=1)
+    sortedTruths = truths[order]
+
+    sortedIndices = np.concatenate([sortedIndices[:, :1] + 1, sortedIndices], axis=1)
+    truePositives = np.zeros(sortedIndices.shape, dtype=np.int64)
+    np.cumsum(sortedTruths, axis=1, out=truePositives[:, 1:])
+    falsePositives = np.arange(count + 1) - truePositives
+    positives = np.count_nonzero(truths)
+    negatives = count - positives
+
+    # Tied scores can't be split by a threshold, only the last
+    # position of each run of equal scores is a real option
+    isRunEnd = np.ones_like(sortedIndices, dtype=bool)
+    isRunEnd[:, :-1] = sortedIndices[:, :-1] != sortedIndices[:, 1:]
+
+    return {
+        'thresholds': sortedIndices,
+        'truePositives': truePositives,
+        'falsePositives': falsePositives,
+        'trueNegatives': negatives - falsePositives,
+        'falseNegatives': positives - truePositives,
+        'isRunEnd': isRunEnd,
+        'positives': positives,
+        'negatives': negatives,
+    }
+
+def getMetric(curves, metric):
+    tp = curves['truePositives']
+    fp = curves['falsePositives']
+    tn = curves['trueNegatives']
+    fn = curves['falseNegatives']
+
+    if metric == "accuracy":
+        values = (tp + tn) / (tp + tn + fp + fn)
+    elif metric == "f1":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    else:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {metrics}")
+
+    return np.where(curves['isRunEnd'], values, -np.inf)
+
+def getRocCurve(truths, indices):
+    curves = getThresholdCurves(truths, indices)
+    keep = curves['isRunEnd'][0]
+
+    tp = curves['truePositives'][0][keep]
+    fp = curves['falsePositives'][0][keep]
+    positives = max(curves['positives'], 1)
+    negatives = max(curves['negatives'], 1)
+
+    tpr = tp / positives
+    fpr = fp / negatives
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp > 0, tp / (tp + fp), 1.0)
+
+    return {
+        'thresholds': curves['thresholds'][0][keep].tolist(),
+        'truePositiveRate': tpr.tolist(),
+        'falsePositiveRate': fpr.tolist(),
+        'precision': precision.tolist(),
+        'accuracy': getMetric(curves, "accuracy")[0][keep].tolist(),
+        'f1': getMetric(curves, "f1")[0][keep].tolist(),
+        'auc': float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)),
+    }
+
+def getBestThresholds(truths, indices, metric="accuracy"):
+    # Best threshold for each of the M rows of indices
+    curves = getThresholdCurves(truths, indices)
+    values = getMetric(curves, metric)
+    best = np.argmax(values, axis=1)
+    rows = np.arange(values.shape[0])
+
+    # Report the midpoint to the next lower score rather than the
+    # score itself, so rounding differences when the indices are
+    # recomputed can't flip a material across the threshold
+    sortedIndices = curves['thresholds']
+    nextLower = sortedIndices[rows, np.minimum(best + 1, sortedIndices.shape[1] - 1)]
+    thresholds = np.where(best + 1 < sortedIndices.shape[1], (sortedIndices[rows, best] + nextLower) / 2, sortedIndices[rows, best])
+
+    return thresholds, values[rows, best]
+
+def getGridWeightVectors(step=0.05):
+    # Every weight vector on the simplex with components that are
+    # multiples of step
+    units = int(round(1 / step))
+    vectors = []
+
+    for cuts in itertools.combinations(range(units + len(subscoreNames) - 1), len(subscoreNames) - 1):
+        parts = np.diff(np.concatenate([[-1], cuts, [units + len(subscoreNames) - 1]])) - 1
+        vectors.append(parts / units)
+
+    return np.array(vectors)
+
+def getRandomWeightVectors(count, rng, center=None, concentration=1.0):
+    # Uniform samples on the simplex, or samples clustered around
+    # center when it is given (higher concentration = tighter)
+    alpha = np.ones(len(subscoreNames)) if center is None else np.maximum(center * concentration, 1e-3)
+    return rng.dirichlet(alpha, size=count)
+
+def evaluateWeightVectors(loaded, weightVectors, metric="accuracy"):
+    thresholds = []
+    values = []
+
+    for start in range(0, len(weightVectors), sweepChunkSize):
+        indices = getIndexSweep(loaded['subScores'], weightVectors[start:start + sweepChunkSize])
+        chunkThresholds, chunkValues = getBestThresholds(loaded['truths'], indices, metric)
+        thresholds.append(chunkThresholds)
+        values.append(chunkValues)
+
+    return np.concatenate(thresholds), np.concatenate(values)
+
+def searchWeights(loaded, metric="accuracy", method="random", samples=20000, step=0.05, refineRounds=5, seed=0):
+    # method is one of:
+    #   grid   - every weight vector on a simplex grid with the given step
+    #   random - uniform random samples on the simplex
+    #   refine - random samples followed by rounds of sampling
+    #            around the best vector found so far
+    rng = np.random.default_rng(seed)
+
+    if method == "grid":
+        weightVectors = getGridWeightVectors(step)
+    elif method in ("random", "refine"):
+        weightVectors = getRandomWeightVectors(samples, rng)
+    else:
+        raise ValueError(f"Unknown search method '{method}'")
+
+    # Always consider the current default weights
+    weightVectors = np.vstack([weightsToVector(weightsDefault), weightVectors])
+
+    thresholds, values = evaluateWeightVectors(loaded, weightVectors, metric)
+    best = int(np.argmax(values))
+    bestVector, bestThreshold, bestValue = weightVectors[best], thresholds[best], values[best]
+    evaluated = len(weightVectors)
+
+    if method == "refine":
+        for refineRound in range(refineRounds):
+            concentration = 50 * (2 ** refineRound)
+            localVectors = getRandomWeightVectors(max(samples // refineRounds, 1), rng, bestVector, concentration)
+            localThresholds, localValues = evaluateWeightVectors(loaded, localVectors, metric)
+            evaluated += len(localVectors)
+
+            localBest = int(np.argmax(localValues))
+            if localValues[localBest] > bestValue:
+                bestVector, bestThreshold, bestValue = localVectors[localBest], localThresholds[localBest], localValues[localBest]
+
+    return bestVector, float(bestThreshold), float(bestValue), evaluated
+
+def describeConfiguration(loaded, weightVector, threshold):
+    weights = {name: float(w) for name, w in zip(subscoreNames, weightVector)}
+    indices = getIndexSweep(loaded['subScores'], [weightVector])[0]
+    tp, tn, fp, fn = getConfusionMatrix(loaded['truths'], indices, threshold)
+    total = max(tp + tn + fp + fn, 1)
+
+    return {
+        'weights': weights,
+        'threshold': float(threshold),
+        'accuracy': (tp + tn) / total,
+        'f1': 2 * tp / (2 * tp + fp + fn) if tp > 0 else 0.0,
+        'confusionMatrix': {'truePositives': tp, 'trueNegatives': tn, 'falsePositives': fp, 'falseNegatives': fn},
+        'roc': getRocCurve(loaded['truths'], indices),
+    }
+
+def optimizeBulkTest(outputDir, metric="accuracy", method="refine", samples=20000, step=0.05, seed=0, threshold=0.7, writeResults=True):
+    # Searches weights and threshold over the candidates stored by a
+    # validation run and reports the best configuration found next
+    # to the current default one. Writes optimization.json into the
+    # output directory unless writeResults is False.
+    loaded = loadCandidates(outputDir)
+
+    if not loaded['isValidationMode']:
+        logDebug("Optimization needs a validation run (known suitability for every material)")
+        return None
+
+    start = time.perf_counter()
+    bestVector, bestThreshold, bestValue, evaluated = searchWeights(loaded, metric, method, samples, step, seed=seed)
+    elapsed = time.perf_counter() - start
+
+    logDebug("Evaluated %d weight configurations in %.2fs, best %s: %.4f", evaluated, elapsed, metric, bestValue)
+
+    report = {
+        'metric': metric,
+        'method': method,
+        'evaluatedConfigurations': evaluated,
+        'seconds': elapsed,
+        'materials': len(loaded['formulas']),
+        'inconclusive': len(loaded['inconclusive']),
+        'default': describeConfiguration(loaded, weightsToVector(weightsDefault), threshold),
+        'best': describeConfiguration(loaded, bestVector, bestThreshold),
+    }
+
+    if writeResults:
+        with open(os.path.join(outputDir, 'optimization.json'), 'w') as f:
+            json.dump(report, f, indent=4)
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search QSI weights and threshold over a finished validation run.")
+    parser.add_argument("outputDir", help="Output directory of a validation bulk test (must contain candidates.json)")
+    parser.add_argument("--metric", choices=metrics, default="accuracy")
+    parser.add_argument("--method", choices=["grid", "random", "refine"], default="refine")
+    parser.add_argument("--samples", type=int, default=20000)
+    parser.add_argument("--step", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = optimizeBulkTest(args.outputDir, args.metric, args.method, args.samples, args.step, args.seed)
+
+    if report:
+        best = report['best']
+        print(f"Best {args.metric}: {best[args.metric]:.4f} at threshold {best['threshold']:.4f}")
+        print(json.dumps(best['weights'], indent=4))
@@ -0,0 +1,130 @@
+import os
+import shutil
+import multiprocessing
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from indexCalc.calculator import gatherCandidates, packStructures, selectFinalCandidate, scoreCandidate, transientErrorResult
+from src.data.mp.mpRetriever import retrieveMpDataBatch
+from src.data.requestPolicy import TransientRetrievalError
+from src.data.snapshot import getSnapshotPath
+from src.data.structureStore import ScratchStore, StructureRef
+from utils.debug import logDebug
+from utils.profiling import span, isProfiling, runWithSpans, addSamples
+
+# The matching processes are started by a fork server (spawned where
+# there is none) instead of being forked from this process. The first
+# one only starts when an I/O thread submits work, and forking then
+# would copy locks other threads hold mid HTTP request, SQLite write
+# or log call into the worker.
+processStartMethod = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def iterBatchedMpData(formulas, batchSize):
+    # Pulls MP data for batchSize formulas at a time in a single
+    # request and hands it out one formula at a time
+    batch = []
+
+    for formula in formulas:
+        batch.append(formula)
+
+        if len(batch) >= batchSize:
+            yield from splitBatch(batch)
+            batch = []
+
+    if batch:
+        yield from splitBatch(batch)
+
+def splitBatch(batch):
+    with span("retrievalBatch"):
+        dataByFormula = retrieveMpDataBatch(batch)
+
+    for formula in batch:
+        yield formula, dataByFormula.get(formula)
+
+def iterQsiResults(formulas, maxWorkers=1, batchSize=100):
+    # Yields (formula, result) pairs in the same order as the
+    # input, no matter which formula finishes first.
+    if getSnapshotPath() is not None:
+        # Offline, gatherCandidates reads MP from the snapshot
+        mpData = ((formula, None) for formula in formulas)
+    else:
+        mpData = iterBatchedMpData(formulas, batchSize)
+
+    if maxWorkers is None or maxWorkers <= 1:
+        for formula, dataMP in mpData:
+            logDebug("Calculating QSI for %s...", formula)
+
+            try:
+                gathered = gatherCandidates(formula, dataMP=dataMP)
+            except TransientRetrievalError as e:
+                yield formula, transientErrorResult(e)
+                continue
+
+            yield formula, scoreCandidate(selectFinalCandidate(gathered))
+        return
+
+    processWorkers = min(maxWorkers, os.cpu_count() or 1)
+    logDebug("Running bulk pipeline with %d I/O workers and %d matching processes", maxWorkers, processWorkers)
+
+    profiling = isProfiling()
+
+    # Structures go to the matching processes through a ScratchStore,
+    # the workers map it instead of unpickling them
+    storePath = tempfile.mkdtemp(prefix="qsiStructures")
+    store = ScratchStore(storePath)
+
+    try:
+        yield from runStages(mpData, maxWorkers, processWorkers, profiling, store)
+    finally:
+        shutil.rmtree(storePath, ignore_errors=True)
+
+def runStages(mpData, maxWorkers, processWorkers, profiling, store):
+    with ThreadPoolExecutor(max_workers=maxWorkers) as ioPool, ProcessPoolExecutor(max_workers=processWorkers, mp_context=multiprocessing.get_context(processStartMethod)) as cpuPool:
+        def runIoStage(formula, dataMP):
+            # Hands the gathered data straight to the process pool
+            # so the thread is free for the next network request.
+            gathered = packStructures(gatherCandidates(formula, dataMP=dataMP), store)
+            if profiling:
+                future = cpuPool.submit(runWithSpans, selectFinalCandidate, gathered)
+            else:
+                future = cpuPool.submit(selectFinalCandidate, gathered)
+
+            # The stored structures can go once the worker is done
+            packed = gathered.get('packed')
+            if isinstance(packed, StructureRef):
+                future.add_done_callback(lambda _: store.release(packed))
+
+            return future
+
+        # Only a bounded window of formulas is in flight at once so
+        # memory stays flat for long input lists.
+        windowSize = maxWorkers * 2
+        pending = deque()
+
+        for formula, dataMP in mpData:
+            pending.append((formula, ioPool.submit(runIoStage, formula, dataMP)))
+
+            if len(pending) >= windowSize:
+                yield finishNext(pending, profiling)
+
+        while pending:
+            yield finishNext(pending, profiling)
+
+def finishNext(pending, profiling=False):
+    formula, ioFuture = pending.popleft()
+
+    try:
+        cpuFuture = ioFuture.result()
+    except TransientRetrievalError as e:
+        return formula, transientErrorResult(e)
+
+    finalCandidate = cpuFuture.result()
+
+    if profiling:
+        # Spans timed in the worker process come back with the result
+        finalCandidate, workerSamples = finalCandidate
+        addSamples(workerSamples)
+
+    logDebug("Calculating QSI for %s...", formula)
+    return formula, scoreCandidate(finalCandidate)
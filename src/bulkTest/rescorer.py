@@ -0,0 +1,103 @@
+import json
+import os
+
+import numpy as np
+
+from src.bulkTest.bulkTester import writeChunkResults
+from src.indexCalc.subscores import weightsDefault
+from src.indexCalc.batchScores import getIndicesFromSubscores
+from src.data.materialTable import MaterialTable
+from utils.debug import logDebug
+
+def loadCandidates(outputDir):
+    # Reads the candidates stored by runBulkTest and precomputes the
+    # subscore matrix once, so any number of weight/threshold
+    # configurations can be scored from it without touching the
+    # network (or recomputing subscores).
+    with open(os.path.join(outputDir, 'candidates.json'), 'r') as f:
+        stored = json.load(f)
+
+    formulas = []
+    truths = []
+    candidates = MaterialTable()
+    inconclusive = []
+
+    for formula, entry in stored["materials"].items():
+        if entry.get("candidate") is None:
+            inconclusive.append(formula)
+            continue
+
+        formulas.append(formula)
+        truths.append(bool(entry.get("isTrulySuitable")))
+        candidates.append(entry["candidate"])
+
+    subScores = candidates.getSubscoreMatrix()
+
+    return {
+        'isValidationMode': stored["mode"] == 'validation',
+        'formulas': formulas,
+        'truths': np.array(truths, dtype=bool),
+        'subScores': subScores,
+        'inconclusive': inconclusive,
+    }
+
+def getConfusionMatrix(truths, indices, threshold):
+    predicted = indices >= threshold
+
+    return (
+        int(np.count_nonzero(truths & predicted)),
+        int(np.count_nonzero(~truths & ~predicted)),
+        int(np.count_nonzero(~truths & predicted)),
+        int(np.count_nonzero(truths & ~predicted)),
+    )
+
+def rescoreCandidates(loaded, weights=weightsDefault, threshold=0.7):
+    # Returns the same summary tuple as runBulkTest along with the
+    # recomputed indices
+    indices = getIndicesFromSubscores(loaded['subScores'], weights)
+    calculatedCount = len(loaded['formulas'])
+    inconclusiveCount = len(loaded['inconclusive'])
+
+    if loaded['isValidationMode']:
+        tp, tn, fp, fn = getConfusionMatrix(loaded['truths'], indices, threshold)
+        return ('validation', (tp, tn, fp, fn, calculatedCount, inconclusiveCount)), indices
+
+    return ('prediction', (calculatedCount, inconclusiveCount)), indices
+
+def rescoreBulkTest(outputDir, weights=weightsDefault, threshold=0.7, writeResults=True):
+    # Recomputes the indices and confusion matrix of a finished bulk
+    # run for new weights or a new threshold from candidates.json
+    # alone. Rewrites the result files unless writeResults is False.
+    logDebug("Rescoring bulk test results in '%s'", outputDir)
+
+    try:
+        loaded = loadCandidates(outputDir)
+    except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+        logDebug("Error reading stored candidates: %s", e)
+        return None
+
+    summary, indices = rescoreCandidates(loaded, weights, threshold)
+
+    if writeResults:
+        allIndices = {}
+        truePositives, trueNegatives, falsePositives, falseNegatives = {}, {}, {}, {}
+
+        for formula, isTrulySuitable, qsi in zip(loaded['formulas'], loaded['truths'], indices.tolist()):
+            allIndices[formula] = qsi
+
+            if loaded['isValidationMode']:
+                isPredictedSuitable = qsi >= threshold
+                if isTrulySuitable and isPredictedSuitable:
+                    truePositives[formula] = qsi
+                elif not isTrulySuitable and not isPredictedSuitable:
+                    trueNegatives[formula] = qsi
+                elif not isTrulySuitable and isPredictedSuitable:
+                    falsePositives[formula] = qsi
+                else:
+                    falseNegatives[formula] = qsi
+
+        writeChunkResults(outputDir, loaded['isValidationMode'], allIndices,
+                             truePositives, trueNegatives, falsePositives, falseNegatives,
+                             loaded['inconclusive'])
+
+    return summary
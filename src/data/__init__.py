@@ -1,3 +1,5 @@
 from utils.debug import logDebug
 from .matDataObj import matDataObj
+from .materialTable import MaterialTable
+from .materialIndex import MaterialIndex
 logDebug("Successfully imported data module")
\ No newline at end of file
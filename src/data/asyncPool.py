@@ -0,0 +1,50 @@
+import os
+import asyncio
+import weakref
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared plumbing for the async retrieval functions. MPRester and
+# QMPYRester only have blocking methods, so an awaited lookup runs the
+# regular retriever (with its caches, pooled clients, rate limits and
+# retries) on a dedicated thread pool. A semaphore per source bounds
+# how many of those run at once, everything beyond that waits on the
+# event loop as a plain coroutine, so thousands of lookups can be in
+# flight without a thread each.
+
+asyncLimits = {
+    "mp": int(os.getenv("QSI_ASYNC_MP_CONCURRENCY", 16)),
+    "oqmd": int(os.getenv("QSI_ASYNC_OQMD_CONCURRENCY", 8)),
+    "cpu": int(os.getenv("QSI_ASYNC_CPU_CONCURRENCY", os.cpu_count() or 1)),
+}
+
+# Semaphores belong to the loop they are first used on
+_semaphores = weakref.WeakKeyDictionary()
+
+_executor = None
+_executorLock = threading.Lock()
+
+def getExecutor():
+    global _executor
+
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=sum(asyncLimits.values()), thread_name_prefix="qsiAsync")
+        return _executor
+
+def getSemaphore(source):
+    loop = asyncio.get_running_loop()
+    semaphores = _semaphores.setdefault(loop, {})
+
+    if source not in semaphores:
+        semaphores[source] = asyncio.Semaphore(asyncLimits[source])
+
+    return semaphores[source]
+
+async def runLimited(source, function, *args, **kwargs):
+    # Runs function(*args, **kwargs) on the shared thread pool once
+    # one of the source's slots is free
+    async with getSemaphore(source):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(getExecutor(), functools.partial(function, *args, **kwargs))
@@ -0,0 +1,49 @@
+from data.matDataObj import matDataObj
+
+# Candidate selection shared by the MP and OQMD cleaners. Within each
+# group of duplicate structures the best entry is the most stable one
+# (lowest hull distance) with the band gap closest to 1 eV, and the
+# final candidate is the best of those group winners.
+
+def getSelectionKey(dataPoint):
+    return (dataPoint['hullDistance'], abs(dataPoint['bandGap'] - 1))
+
+def indexById(data, idKey):
+    # First data point for every id, so each structure is joined to
+    # its data point with a dict lookup instead of a scan
+    index = {}
+
+    for d in data:
+        index.setdefault(d.get(idKey), d)
+
+    return index
+
+def selectBestOfGroups(data, groups, idKey):
+    # Single pass over every structure in every group. Taking the
+    # first strict minimum in group order gives the same result as
+    # sorting each group, then sorting the group winners.
+    index = indexById(data, idKey)
+    best = None
+    bestKey = None
+
+    for group in groups:
+        for entry in group:
+            dataPoint = index[entry.label]
+            key = getSelectionKey(dataPoint)
+
+            if best is None or key < bestKey:
+                best, bestKey = dataPoint, key
+
+    return best
+
+def toMatDataObj(dataPoint, **overrides):
+    values = {
+        "formula": dataPoint.get("formula"),
+        "bandGap": dataPoint.get("bandGap"),
+        "hullDistance": dataPoint.get("hullDistance"),
+        "formationEnergy": dataPoint.get("formationEnergy"),
+        "symmetry": dataPoint.get("symmetry")
+    }
+    values.update(overrides)
+
+    return matDataObj(**values)
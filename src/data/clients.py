@@ -0,0 +1,41 @@
+# Lazy stand-ins for the database clients. mp_api alone takes several
+# seconds to import, so it (and qmpy_rester) is only imported the
+# first time a client is actually opened. Both work as context
+# managers like the originals and hand out an opened client from a
+# shared pool (see requestPolicy.py), so sessions are reused between
+# formulas instead of being opened for every request.
+#
+# When QSI_REPLAY_DATASET is set they return replay clients that
+# answer from a recorded dataset instead (see replay.py). replay and
+# requestPolicy are imported through src. so both import paths of
+# this module share one transport and one set of pools.
+
+def openMpRester(*args, **kwargs):
+    from mp_api.client import MPRester
+    return MPRester(*args, **kwargs)
+
+def openQmpyRester(*args, **kwargs):
+    from qmpy_rester import QMPYRester
+    return QMPYRester(*args, **kwargs)
+
+def MPRester(*args, **kwargs):
+    from src.data.replay import getReplayTransport
+    from src.data.requestPolicy import getClientPool, PooledClient
+
+    transport = getReplayTransport()
+    if transport is not None:
+        return transport.MPRester(*args, **kwargs)
+
+    pool = getClientPool(("mp", args, tuple(sorted(kwargs.items()))), lambda: openMpRester(*args, **kwargs))
+    return PooledClient(pool)
+
+def QMPYRester(*args, **kwargs):
+    from src.data.replay import getReplayTransport
+    from src.data.requestPolicy import getClientPool, PooledClient
+
+    transport = getReplayTransport()
+    if transport is not None:
+        return transport.QMPYRester(*args, **kwargs)
+
+    pool = getClientPool(("oqmd", args, tuple(sorted(kwargs.items()))), lambda: openQmpyRester(*args, **kwargs))
+    return PooledClient(pool)
@@ -0,0 +1,73 @@
+import math
+import functools
+
+import chemparse
+
+# Canonical form of a formula, so that equivalent spellings ("FeS2",
+# "S2Fe", "Fe2S4", " FeS2 ") share cache entries and are only looked
+# up once. The key is the reduced composition with the elements in
+# alphabetical order, the same convention as OPTIMADE's
+# chemical_formula_reduced: all of the above become "FeS2", and
+# repeated elements are merged ("S6S10" -> "S").
+#
+# Parsing goes through chemparse once per distinct string, the parsed
+# counts are memoized for the scoring code as well.
+#
+# Imported as src.data.formulas everywhere so there is one set of
+# memoized parses per process.
+
+parseCacheSize = 65536
+
+# In order of atomic number
+elementsByNumber = tuple("""
+    H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr
+    Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb
+    Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr
+    Rf Db Sg Bh Hs Mt Ds Rg Cn Nh Fl Mc Lv Ts Og
+""".split())
+
+elementSymbols = frozenset(elementsByNumber)
+
+@functools.lru_cache(maxsize=parseCacheSize)
+def getElementCounts(formula):
+    # (element, count) pairs as chemparse parses them, with repeated
+    # elements already added up. A tuple so the memoized value can't
+    # be changed by the caller.
+    return tuple(chemparse.parse_formula(formula).items())
+
+def formatAmount(amount):
+    if float(amount).is_integer():
+        amount = int(amount)
+        return "" if amount == 1 else str(amount)
+
+    return f"{amount:.6g}"
+
+@functools.lru_cache(maxsize=parseCacheSize)
+def getCanonicalFormula(formula):
+    # Reduced, alphabetically ordered formula, or None if the string
+    # isn't a formula made of real elements
+    formula = "".join(str(formula).split())
+
+    try:
+        counts = getElementCounts(formula)
+    except Exception:
+        return None
+
+    if not counts or any(el not in elementSymbols or amount <= 0 for el, amount in counts):
+        return None
+
+    amounts = [amount for _, amount in counts]
+
+    # Only whole number compositions are reduced, fractional ones
+    # (doped or disordered inputs) are kept as they are
+    if all(float(amount).is_integer() for amount in amounts):
+        divisor = math.gcd(*(int(amount) for amount in amounts))
+        amounts = [amount / divisor for amount in amounts]
+
+    return "".join(f"{el}{formatAmount(amount)}" for el, amount in sorted(zip((el for el, _ in counts), amounts)))
+
+def getFormulaKey(formula):
+    # Key to cache and deduplicate formulas on. Strings that don't
+    # parse are only stripped of whitespace, so they still reach the
+    # retrievers and fail there like before.
+    return getCanonicalFormula(formula) or "".join(str(formula).split())
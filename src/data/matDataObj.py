@@ -1,4 +1,7 @@
 class matDataObj:
+    # No per-instance __dict__, bulk runs keep a lot of these around
+    __slots__ = ("formula", "bandGap", "hullDistance", "formationEnergy", "symmetry")
+
     def __init__(self, formula, bandGap, hullDistance, formationEnergy, symmetry):
         self.formula = formula
         self.bandGap = bandGap
@@ -16,6 +19,25 @@ class matDataObj:
             symmetry=None
         )
 
+    @classmethod
+    def fromDict(cls, data):
+        return cls(
+            formula=data.get("formula"),
+            bandGap=data.get("bandGap"),
+            hullDistance=data.get("hullDistance"),
+            formationEnergy=data.get("formationEnergy"),
+            symmetry=data.get("symmetry")
+        )
+
+    def toDict(self):
+        return {
+            "formula": self.formula,
+            "bandGap": self.bandGap,
+            "hullDistance": self.hullDistance,
+            "formationEnergy": self.formationEnergy,
+            "symmetry": self.symmetry
+        }
+
     def __str__(self):
         return f"""matDataObj(    
         formula= {self.formula}    
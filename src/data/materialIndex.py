@@ -0,0 +1,174 @@
+import numpy as np
+
+from src.data.formulas import getElementCounts
+
+# Query engine for chemical space screening over a MaterialTable (the
+# candidates of a bulk run, or every entry of a snapshot). An inverted
+# index from element to the sorted rows containing it answers element
+# questions with a few set operations, and the properties and QSI are
+# filtered as whole columns:
+#
+#     index = MaterialIndex.fromSnapshot(openSnapshot())
+#     index.query(within={"Si", "C", "O"}, maxElementSpin=0.05, minQsi=0.7, maxHullDistance=0.05)
+#
+# Rows are individual entries, a snapshot has a row for every
+# polymorph of a composition (onePerFormula keeps the best scoring
+# one). The QSI comes from batchScores, the vectorized version of
+# subscores.py, and is computed once per set of weights.
+
+class MaterialIndex:
+    def __init__(self, table, ids=None):
+        self.table = table
+        self.ids = ids
+        self.scores = {}
+
+        formulaColumn = table.column("formula")
+        self.rows = np.arange(len(table))
+
+        # Rows of every unique formula
+        order = np.argsort(formulaColumn, kind="stable")
+        bounds = np.searchsorted(formulaColumn[order], np.arange(len(table.formulas) + 1))
+        rowsByFormula = [order[bounds[code]:bounds[code + 1]] for code in range(len(table.formulas))]
+
+        formulasByElement = {}
+        elementCounts = np.zeros(len(table.formulas) + 1, dtype=np.int16)
+
+        for code, formula in enumerate(table.formulas):
+            try:
+                elements = {el for el, amount in getElementCounts(formula) if amount > 0}
+            except Exception:
+                elements = set()
+
+            elementCounts[code] = len(elements)
+            for el in elements:
+                formulasByElement.setdefault(el, []).append(code)
+
+        self.elementRows = {
+            el: np.sort(np.concatenate([rowsByFormula[code] for code in codes]))
+            for el, codes in formulasByElement.items()
+        }
+
+        # Distinct elements per row, 0 for rows without a material
+        # (code -1 picks the extra 0 at the end)
+        self.rowElementCounts = elementCounts[formulaColumn]
+
+    @classmethod
+    def fromMaterials(cls, materials, ids=None):
+        from src.data.materialTable import MaterialTable
+
+        return cls(MaterialTable.fromMaterials(materials), ids)
+
+    @classmethod
+    def fromSnapshot(cls, store):
+        return cls(store.getTable(), store.columns["ids"])
+
+    def __len__(self):
+        return len(self.table)
+
+    def getElements(self):
+        return sorted(self.elementRows)
+
+    def getRowsWith(self, el):
+        return self.elementRows.get(el, self.rows[:0])
+
+    def getScores(self, weights=None):
+        # QSI and subscores of every row, kept per set of weights
+        key = None if weights is None else tuple(sorted(weights.items()))
+
+        if key not in self.scores:
+            self.scores[key] = self.table.getTotalIndices(weights)
+
+        return self.scores[key]
+
+    def getSpinActiveElements(self, maxElementSpin=0):
+        # Elements in the index whose abundance weighted nuclear spin
+        # is above maxElementSpin
+        from src.indexCalc.spinTable import getAverageNuclearSpin
+
+        return {el for el in self.elementRows if getAverageNuclearSpin(el) > maxElementSpin}
+
+    def queryRows(self, within=None, containing=None, excluding=None, maxElementSpin=None,
+                  minQsi=None, maxHullDistance=None, minBandGap=None, maxBandGap=None,
+                  weights=None, onePerFormula=False):
+        # Rows matching every given condition, best QSI first:
+        #
+        #   within          only elements from this set ({Si, C, O}
+        #                   matches Si, SiC, SiO2, ... but not SiN)
+        #   containing      every element of this set
+        #   excluding       none of the elements of this set
+        #   maxElementSpin  no element with a higher average nuclear
+        #                   spin (0 leaves only spin free elements)
+        #   minQsi, maxHullDistance, minBandGap, maxBandGap
+        found = self.rowElementCounts > 0
+
+        if within is not None:
+            # A row is within the set when every one of its elements
+            # is, i.e. it turns up in as many of the set's element
+            # lists as it has elements
+            lists = [self.getRowsWith(el) for el in set(within)]
+            hits = np.bincount(np.concatenate(lists), minlength=len(self)) if lists else np.zeros(len(self), dtype=np.int64)
+            found &= hits == self.rowElementCounts
+
+        if containing:
+            rows = None
+            for el in set(containing):
+                rows = self.getRowsWith(el) if rows is None else np.intersect1d(rows, self.getRowsWith(el), assume_unique=True)
+
+            mask = np.zeros(len(self), dtype=bool)
+            mask[rows] = True
+            found &= mask
+
+        excluded = set(excluding or ())
+        if maxElementSpin is not None:
+            excluded |= self.getSpinActiveElements(maxElementSpin)
+
+        for el in excluded:
+            found[self.getRowsWith(el)] = False
+
+        if any(value is not None for value in (minBandGap, maxBandGap, maxHullDistance)):
+            bandGaps = self.table.column("bandGap")
+            hullDistances = self.table.column("hullDistance")
+
+            # NaN fails every comparison, so rows missing a filtered
+            # property are dropped
+            if minBandGap is not None:
+                found &= bandGaps >= minBandGap
+            if maxBandGap is not None:
+                found &= bandGaps <= maxBandGap
+            if maxHullDistance is not None:
+                found &= hullDistances <= maxHullDistance
+
+        rows = np.flatnonzero(found)
+        indices = self.getScores(weights)['index']
+
+        if minQsi is not None:
+            rows = rows[indices[rows] >= minQsi]
+
+        # Best first, ties in row order
+        rows = rows[np.argsort(-indices[rows], kind="stable")]
+
+        if onePerFormula:
+            _, first = np.unique(self.table.column("formula")[rows], return_index=True)
+            rows = rows[np.sort(first)]
+
+        return rows
+
+    def getRecord(self, row, weights=None):
+        scores = self.getScores(weights)
+        record = self.table[int(row)].toDict()
+
+        record["qsi"] = float(scores['index'][row])
+        if self.ids is not None:
+            record["id"] = str(self.ids[row])
+
+        return record
+
+    def query(self, limit=None, weights=None, **conditions):
+        # Same as queryRows, with the matching rows as dicts (the
+        # material's properties, its QSI and its id if known)
+        rows = self.queryRows(weights=weights, **conditions)
+
+        if limit is not None:
+            rows = rows[:limit]
+
+        return [self.getRecord(row, weights) for row in rows]
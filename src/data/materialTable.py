@@ -0,0 +1,184 @@
+import numpy as np
+
+from .matDataObj import matDataObj
+
+# Column-oriented container for many selected candidates. Every
+# property is a NumPy column and formulas are stored once in a list
+# of unique formulas with an int32 code per row, so a row costs about
+# 30 bytes instead of a few hundred for a matDataObj or dict. Missing
+# values are NaN (floats), 0 (symmetry) or -1 (formula code).
+
+floatColumns = ["bandGap", "hullDistance", "formationEnergy"]
+
+class MaterialTable:
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.formulas = []
+        self.formulaCodes = {}
+
+        self.formulaColumn = np.full(capacity, -1, dtype=np.int32)
+        self.columns = {name: np.full(capacity, np.nan) for name in floatColumns}
+        self.symmetryColumn = np.zeros(capacity, dtype=np.int16)
+
+    @classmethod
+    def fromColumns(cls, formulas, formulaColumn, symmetryColumn, columns):
+        # Table over already columnar data (a saved table, a snapshot).
+        # The columns are copied, so memory mapped input is fine.
+        size = len(formulaColumn)
+
+        table = cls(max(size, 1))
+        table.formulas = list(formulas)
+        table.formulaCodes = {formula: code for code, formula in enumerate(table.formulas)}
+        table.size = size
+
+        table.formulaColumn[:size] = formulaColumn
+        table.symmetryColumn[:size] = symmetryColumn
+        for name in floatColumns:
+            table.columns[name][:size] = columns[name]
+
+        return table
+
+    @classmethod
+    def fromMaterials(cls, materials):
+        materials = list(materials)
+        table = cls(max(len(materials), 1))
+        table.extend(materials)
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, required):
+        capacity = len(self.formulaColumn)
+        if required <= capacity:
+            return
+
+        newCapacity = max(required, capacity * 2)
+        self.formulaColumn = np.concatenate([self.formulaColumn, np.full(newCapacity - capacity, -1, dtype=np.int32)])
+        self.symmetryColumn = np.concatenate([self.symmetryColumn, np.zeros(newCapacity - capacity, dtype=np.int16)])
+
+        for name in floatColumns:
+            self.columns[name] = np.concatenate([self.columns[name], np.full(newCapacity - capacity, np.nan)])
+
+    def getFormulaCode(self, formula):
+        if formula is None:
+            return -1
+
+        code = self.formulaCodes.get(formula)
+
+        if code is None:
+            code = len(self.formulas)
+            self.formulas.append(formula)
+            self.formulaCodes[formula] = code
+
+        return code
+
+    def append(self, material):
+        # Takes a matDataObj or a retriever data point (dict with the
+        # same keys, symmetry as a space group number)
+        values = material if isinstance(material, dict) else material.toDict()
+
+        self.grow(self.size + 1)
+        row = self.size
+
+        self.formulaColumn[row] = self.getFormulaCode(values.get("formula"))
+        for name in floatColumns:
+            value = values.get(name)
+            self.columns[name][row] = np.nan if value is None else value
+
+        symmetry = values.get("symmetry")
+        self.symmetryColumn[row] = 0 if symmetry is None else int(symmetry)
+
+        self.size += 1
+        return row
+
+    def extend(self, materials):
+        for material in materials:
+            self.append(material)
+
+    def column(self, name):
+        if name == "formula":
+            return self.formulaColumn[:self.size]
+        if name == "symmetry":
+            return self.symmetryColumn[:self.size]
+        return self.columns[name][:self.size]
+
+    def getFormula(self, row):
+        code = self.formulaColumn[row]
+        return None if code < 0 else self.formulas[code]
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.size
+        if not 0 <= row < self.size:
+            raise IndexError("MaterialTable index out of range")
+
+        if self.formulaColumn[row] < 0:
+            return matDataObj.materialNotFound()
+
+        def value(name):
+            v = self.columns[name][row]
+            return None if np.isnan(v) else float(v)
+
+        return matDataObj(
+            formula=self.getFormula(row),
+            bandGap=value("bandGap"),
+            hullDistance=value("hullDistance"),
+            formationEnergy=value("formationEnergy"),
+            symmetry=int(self.symmetryColumn[row]) or None
+        )
+
+    def __iter__(self):
+        for row in range(self.size):
+            yield self[row]
+
+    def getFoundMask(self):
+        return self.column("formula") >= 0
+
+    def getNuclearSpins(self):
+        # Spins are worked out once per unique formula and then
+        # spread over the rows
+        from src.indexCalc.batchScores import getFormulaNuclearSpins
+
+        # The extra NaN at the end is what code -1 (no formula) picks
+        spins = np.append(getFormulaNuclearSpins(self.formulas), np.nan)
+        return spins[self.column("formula")]
+
+    def getSubscoreMatrix(self):
+        from src.indexCalc.batchScores import getSubscoreMatrix
+
+        return getSubscoreMatrix(
+            self.column("bandGap"),
+            self.column("hullDistance"),
+            self.column("formationEnergy"),
+            self.column("symmetry"),
+            self.getNuclearSpins(),
+        ).reshape(self.size, 5)
+
+    def getTotalIndices(self, weights=None):
+        # Same result as batchScores.getTotalIndices over the rows,
+        # weights default to subscores.weightsDefault
+        from src.indexCalc.batchScores import getIndicesFromSubscores
+
+        subScores = self.getSubscoreMatrix()
+        if weights is None:
+            return {'index': getIndicesFromSubscores(subScores), 'subScores': subScores}
+
+        return {'index': getIndicesFromSubscores(subScores, weights), 'subScores': subScores}
+
+    def nbytes(self):
+        return (self.formulaColumn.nbytes + self.symmetryColumn.nbytes
+                + sum(column.nbytes for column in self.columns.values()))
+
+    def save(self, path):
+        np.savez(path,
+                 formulas=np.array(self.formulas, dtype=str),
+                 formula=self.column("formula"),
+                 symmetry=self.column("symmetry"),
+                 **{name: self.column(name) for name in floatColumns})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            return cls.fromColumns(stored["formulas"].tolist(), stored["formula"], stored["symmetry"],
+                                   {name: stored[name] for name in floatColumns})
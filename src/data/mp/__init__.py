@@ -1,5 +1,19 @@
-from .mpRetriever import retrieveMpData
-from .mpCleaner import filter
+import importlib
 
 from utils.debug import logDebug
-logDebug("Successfully imported MP data module")
\ No newline at end of file
+
+# The retriever and cleaner are only imported on first use, the
+# cleaner pulls in pymatgen's structure matching
+lazyNames = {
+    "retrieveMpData": ".mpRetriever",
+    "retrieveMpDataAsync": ".mpRetriever",
+    "retrieveMpDataBatchAsync": ".mpRetriever",
+    "filter": ".mpCleaner",
+}
+
+def __getattr__(name):
+    if name in lazyNames:
+        return getattr(importlib.import_module(lazyNames[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+logDebug("Successfully imported MP data module")
@@ -1,72 +1,78 @@
-from pymatgen.analysis.structure_matcher import StructureMatcher
 from pymatgen.core import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
 import os
 from dotenv import load_dotenv
-from mp_api.client import MPRester
 
 from utils.debug import logDebug
+from utils.profiling import span
 from data.matDataObj import matDataObj
+from data.clients import MPRester
+from data.structureGrouping import groupStructures
+from data.candidateSelection import selectBestOfGroups, toMatDataObj
+from src.data.requestPolicy import getPolicy
 
 load_dotenv()
 mpKey = os.getenv("MP_KEY")
 
 
-def filter(data):
-    if data[0].get("dataFound"):
-        logDebug("Filtering...")
+def hasStructures(data):
+    return all(d.get("structure") is not None for d in data if not d.get("deprecated"))
+
+def buildStructures(data):
+    structures = []
+
+    logDebug("Constructing Structure Objects...")
 
-        with MPRester(mpKey) as mpr:
-            ids = []
-            matcher = StructureMatcher()
+    for d in data:
+        if(not d.get("deprecated")):
+            struct = Structure.from_dict(d.get("structure"))
+            struct.label = d.get("mpId")
+            structures.append(struct)
 
-            for i in range(len(data)):
-                if(not data[i].get("deprecated")):
-                    ids.append(data[i].get("mpId"))
+    return structures
 
-            docs = mpr.materials.summary.search(material_ids=ids, fields=["material_id", "structure"])
-            structures = []
+def fetchStructures(data):
+    # Structures normally come along with the search results, only
+    # go back to MP when they are missing
+    if hasStructures(data):
+        return buildStructures(data)
 
-            for doc in docs:
-                struct = doc.structure
-                struct.label = str(doc.material_id) 
-                structures.append(struct)
+    with MPRester(mpKey) as mpr:
+        ids = []
 
-            logDebug("Identifying and grouping dupes...")
-            groups = matcher.group_structures(structures)
+        for i in range(len(data)):
+            if(not data[i].get("deprecated")):
+                ids.append(data[i].get("mpId"))
 
-            sortedGroups = []
+        docs = getPolicy("mp").call(mpr.materials.summary.search, material_ids=ids, fields=["material_id", "structure"])
+        structures = []
 
-            logDebug(f"Found these many unique results from MP: {len(groups)}")
-            logDebug("Sorting groups of duplicates...")
-            for group in groups:
-                subgroup = []
+        for doc in docs:
+            struct = doc.structure
+            struct.label = str(doc.material_id) 
+            structures.append(struct)
 
-                for entry in group:
-                    correspondingDataPoint = [d for d in data if d.get("mpId") == entry.label]
-                    subgroup.append(correspondingDataPoint)
-                
-                sortedSubgroup = sorted(subgroup, key=lambda x: (x[0]['hullDistance'], abs(x[0]['bandGap'] - 1)))
-                sortedGroups.append(sortedSubgroup)
+    return structures
 
-            finalizedCandidates = []
+def selectCandidate(data, structures):
+    logDebug("Identifying and grouping dupes...")
+    with span("grouping"):
+        groups = groupStructures(structures, data[0].get("formula"))
 
-            logDebug("Finalizing candidates...")
-            for group in sortedGroups:
-                finalizedCandidates.append(group[0])
+    logDebug("Found these many unique results from MP: %d", len(groups))
+    logDebug("Finalizing candidates...")
+    with span("candidateSelection"):
+        final = selectBestOfGroups(data, groups, "mpId")
 
-            finalizedSorted = sorted(finalizedCandidates, key=lambda x: (x[0]['hullDistance'], abs(x[0]['bandGap'] - 1)))
-            final = finalizedSorted[0]
+    logDebug("Finalized MP candidate")
 
-            logDebug("Finalized MP candidate")
+    return toMatDataObj(final)
+
+def filter(data):
+    if data[0].get("dataFound"):
+        logDebug("Filtering...")
 
-            return matDataObj(
-                formula=final[0].get("formula"), 
-                bandGap=final[0].get("bandGap"), 
-                hullDistance=final[0].get("hullDistance"), 
-                formationEnergy=final[0].get("formationEnergy"), 
-                symmetry=final[0].get("symmetry")
-            )
+        return selectCandidate(data, fetchStructures(data))
     else:
         return matDataObj.materialNotFound()
\ No newline at end of file
@@ -1,63 +1,167 @@
 import os
-from mp_api.client import MPRester
 from dotenv import load_dotenv
 from utils.debug import logDebug, logError
+from ..retrievalCache import cachedRetrieval, memoryCached, getCache, readCache, writeCache
+from ..clients import MPRester
+from src.data.requestPolicy import getPolicy, TransientRetrievalError, isTransientError, transientErrorData, errorParse
+from src.data.asyncPool import runLimited
+from src.data.formulas import getFormulaKey, getCanonicalFormula
 
 import traceback;
-import functools
 
 load_dotenv()
 mpKey = os.getenv("MP_KEY")
 
-@functools.cache
+mpFields = [
+    "material_id",
+    "deprecated",
+    "formula_pretty",
+    "band_gap",
+    "energy_above_hull",
+    "formation_energy_per_atom",
+    "structure",
+    "symmetry", #Number -> number
+]
+
+# MP caps the number of formulas per request, larger batches are
+# split into several requests over the same session
+batchChunkSize = 100
+
+def docToDataPoint(d):
+    return {
+        "mpId": str(d.material_id),
+        "deprecated": d.deprecated,
+        "formula": d.formula_pretty,
+        "bandGap": d.band_gap,
+        "hullDistance": d.energy_above_hull,
+        "formationEnergy": d.formation_energy_per_atom,
+        "symmetry": d.symmetry.number,
+        "structure": d.structure.as_dict() if d.structure is not None else None,
+        "dataFound": True
+    }
+
+def notFoundData():
+    return [{
+        "message": "No data found in MP, switching to OQMD",
+        "dataFound": False
+    }]
+
+def errorData():
+    return [{
+        "message": "Error occurred, most likely trying to parse the formula",
+        "dataFound": False,
+        "error": True,
+        "errorType": errorParse
+    }]
+
+@memoryCached()
+@cachedRetrieval("mp", mpFields)
 def retrieveMpData(formula):
     try:
         with MPRester(mpKey) as mpr:
             logDebug("Retrieving entries from MP...")
 
-            docs = mpr.materials.summary.search(
+            docs = getPolicy("mp").call(
+                mpr.materials.summary.search,
                 formula=formula,
-                fields=[
-                    "material_id", 
-                    "deprecated",
-                    "formula_pretty",
-                    "band_gap", 
-                    "energy_above_hull",
-                    "formation_energy_per_atom",
-                    "structure",
-                    "symmetry", #Number -> number
-                ],
+                fields=mpFields,
             )
-            
+
             logDebug("Retrieved data from MP. Putting into dictionary...")
 
             data = []
 
             if len(docs) != 0:
                 for d in docs:
-                    data.append({
-                        "mpId": d.material_id,
-                        "deprecated": d.deprecated,
-                        "formula": d.formula_pretty,
-                        "bandGap": d.band_gap,
-                        "hullDistance": d.energy_above_hull,
-                        "formationEnergy": d.formation_energy_per_atom,
-                        "symmetry": d.symmetry.number,
-                        "dataFound": True
-                    })
+                    data.append(docToDataPoint(d))
             else:
-                data.append({
-                    "message": "No data found in MP, switching to OQMD",
-                    "dataFound": False
-                })
+                data = notFoundData()
 
-            logDebug(f"Found these many results from MP: {len(data) if data[0].get("dataFound") else "None"}")
+            logDebug("Found these many results from MP: %s", len(data) if data[0].get("dataFound") else "None")
 
             return data
+    except TransientRetrievalError as e:
+        logDebug("MP lookup for %s failed: %s", formula, e)
+        return transientErrorData("MP", e)
+    except Exception as e:
+        logError()
+
+        return transientErrorData("MP", e) if isTransientError(e) else errorData()
+
+def retrieveMpDataBatch(formulas):
+    # Fetches many formulas with as few requests as possible and
+    # splits the documents back per formula by canonical formula, so
+    # equivalent spellings are only requested once. Returns a dict of
+    # formula -> data in the same format as retrieveMpData.
+    results = {}
+    spellings = {}
+    cache = getCache()
+
+    for formula in dict.fromkeys(formulas):
+        spellings.setdefault(getFormulaKey(formula), []).append(formula)
+
+    toFetch = []
+
+    for key, group in spellings.items():
+        cached = readCache(cache, "mp", key, mpFields)
+
+        if cached is not None:
+            results.update((formula, cached) for formula in group)
+        elif getCanonicalFormula(key) is None:
+            logDebug("Could not parse %s, skipping it in the MP batch", group[0])
+            results.update((formula, errorData()) for formula in group)
+        else:
+            toFetch.append(key)
+
+    if not toFetch:
+        return results
+
+    try:
+        with MPRester(mpKey) as mpr:
+            for i in range(0, len(toFetch), batchChunkSize):
+                chunk = toFetch[i:i+batchChunkSize]
+                logDebug("Retrieving a batch of %d formulas from MP...", len(chunk))
+
+                docs = getPolicy("mp").call(
+                    mpr.materials.summary.search,
+                    formula=chunk,
+                    fields=mpFields,
+                )
+
+                docsByFormula = {}
+                for d in docs:
+                    docsByFormula.setdefault(getFormulaKey(d.formula_pretty), []).append(d)
+
+                for key in chunk:
+                    matches = docsByFormula.get(key, [])
+                    data = [docToDataPoint(d) for d in matches] if matches else notFoundData()
+                    results.update((formula, data) for formula in spellings[key])
+                    writeCache(cache, "mp", key, mpFields, data)
+    except TransientRetrievalError as e:
+        # Retrying one formula at a time would only run into the same
+        # rate limit or outage
+        logDebug("MP batch lookup failed: %s", e)
+
+        for key in toFetch:
+            for formula in spellings[key]:
+                results.setdefault(formula, transientErrorData("MP", e))
     except Exception:
         logError()
 
-        return [{
-            "message": "Error occurred, most likely trying to parse the formula",
-            "dataFound": False
-        }]
\ No newline at end of file
+        # Anything the batch did not get to is looked up one at a
+        # time so a single bad formula doesn't sink the whole batch
+        for key in toFetch:
+            if spellings[key][0] not in results:
+                data = retrieveMpData(key)
+                results.update((formula, data) for formula in spellings[key])
+
+    logDebug("Retrieved %d formulas from MP in one batch", len(results))
+
+    return results
+
+async def retrieveMpDataAsync(formula):
+    # Awaitable versions of the two lookups, see asyncPool.py
+    return await runLimited("mp", retrieveMpData, formula)
+
+async def retrieveMpDataBatchAsync(formulas):
+    return await runLimited("mp", retrieveMpDataBatch, list(formulas))
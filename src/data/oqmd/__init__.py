@@ -1,5 +1,18 @@
-from .oqmdRetriever import retrieveOqmdData
-from .oqmdCleaner import filter
+import importlib
 
 from utils.debug import logDebug
-logDebug("Successfully imported OQMD data module")
\ No newline at end of file
+
+# The retriever and cleaner are only imported on first use, the
+# cleaner pulls in pymatgen's structure matching
+lazyNames = {
+    "retrieveOqmdData": ".oqmdRetriever",
+    "retrieveOqmdDataAsync": ".oqmdRetriever",
+    "filter": ".oqmdCleaner",
+}
+
+def __getattr__(name):
+    if name in lazyNames:
+        return getattr(importlib.import_module(lazyNames[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+logDebug("Successfully imported OQMD data module")
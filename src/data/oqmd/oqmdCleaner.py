@@ -1,4 +1,3 @@
-from pymatgen.analysis.structure_matcher import StructureMatcher
 from pymatgen.core import Structure
 from pymatgen.symmetry.groups import SpaceGroup
 
@@ -6,69 +5,56 @@ import gemmi
 import numpy as np
 
 from data.matDataObj import matDataObj
+from data.structureGrouping import groupStructures
+from data.candidateSelection import selectBestOfGroups, toMatDataObj
 from utils.debug import logDebug
+from utils.profiling import span
 
-def filter(data):
-    if data[0].get("dataFound"):
-        logDebug("Filtering...")
-
-        ids = []
-        structures = []
-        matcher = StructureMatcher()
-
-        logDebug("Constructing Structure Objects...")
+def buildStructures(data):
+    structures = []
 
-        for d in data:
-            ids.append(d.get("oqmdId"))
+    logDebug("Constructing Structure Objects...")
 
-            lattice = d.get("structureData").get("data")[0].get("attributes").get("lattice_vectors")
-            species = d.get("structureData").get("data")[0].get("attributes").get("species_at_sites")
-            coords = d.get("structureData").get("data")[0].get("attributes").get("cartesian_site_positions")
+    for d in data:
+        lattice = d.get("structureData").get("data")[0].get("attributes").get("lattice_vectors")
+        species = d.get("structureData").get("data")[0].get("attributes").get("species_at_sites")
+        coords = d.get("structureData").get("data")[0].get("attributes").get("cartesian_site_positions")
 
-            struct = Structure(lattice, species, coords, coords_are_cartesian=True)
+        struct = Structure(lattice, species, coords, coords_are_cartesian=True)
 
-            struct.label = d.get("oqmdId")
-            structures.append(struct)
+        struct.label = d.get("oqmdId")
+        structures.append(struct)
 
-        logDebug("Sorting groups of duplicates...")
-        groups = matcher.group_structures(structures)
+    return structures
 
-        sortedGroups = []
+def getSpaceGroupNumber(symmetry):
+    # OQMD gives space groups as Hermann-Mauguin symbols
+    if type(symmetry) is int:
+        return symmetry
 
-        logDebug(f"Found these many unique results from OQMD: {len(groups)}")
-        logDebug("Sorting groups of duplicates...")
-        for group in groups:
-            subgroup = []
+    return gemmi.find_spacegroup_by_name(symmetry).number
 
-            for entry in group:
-                correspondingDataPoint = [d for d in data if d.get("oqmdId") == entry.label]
+def selectCandidate(data, structures):
+    logDebug("Sorting groups of duplicates...")
+    with span("grouping"):
+        groups = groupStructures(structures, data[0].get("formula"))
 
-                if not type(correspondingDataPoint[0].get("symmetry")) is int:
-                    sg = gemmi.find_spacegroup_by_name(correspondingDataPoint[0].get("symmetry"))
-                    correspondingDataPoint[0]["symmetry"] = sg.number
+    logDebug("Found these many unique results from OQMD: %d", len(groups))
+    logDebug("Finalizing candidates...")
+    with span("candidateSelection"):
+        final = selectBestOfGroups(data, groups, "oqmdId")
 
-                subgroup.append(correspondingDataPoint)
-            
-            sortedSubgroup = sorted(subgroup, key=lambda x: (x[0]['hullDistance'], (abs(x[0]['bandGap'] - 1))))
-            sortedGroups.append(sortedSubgroup)
+    logDebug("Finalized OQMD candidate")
 
-        finalizedCandidates = []
+    return toMatDataObj(final, symmetry=getSpaceGroupNumber(final.get("symmetry")))
 
-        logDebug("Finalizing candidates...")
-        for group in sortedGroups:
-            finalizedCandidates.append(group[0])
-
-        finalizedSorted = sorted(finalizedCandidates, key=lambda x: (x[0]['hullDistance'], (abs(x[0]['bandGap'] - 1))))
-        final = finalizedSorted[0]
+def filter(data):
+    if data[0].get("dataFound"):
+        logDebug("Filtering...")
 
-        logDebug("Finalized OQMD candidate")
+        with span("structureBuilding"):
+            structures = buildStructures(data)
 
-        return matDataObj(
-            formula=final[0].get("formula"), 
-            bandGap=final[0].get("bandGap"), 
-            hullDistance=final[0].get("hullDistance"), 
-            formationEnergy=final[0].get("formationEnergy"), 
-            symmetry=final[0].get("symmetry")
-        )
+        return selectCandidate(data, structures)
     else:
         return matDataObj.materialNotFound()
\ No newline at end of file
@@ -1,38 +1,119 @@
-from qmpy_rester import QMPYRester
 from utils.debug import logDebug, logError
+from ..retrievalCache import cachedRetrieval, memoryCached
+from ..clients import QMPYRester
+from src.data.requestPolicy import getPolicy, TransientRetrievalError, isTransientError, transientErrorData, errorParse
+from src.data.asyncPool import runLimited
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 
-import functools
+oqmdFields = ["phases", "optimadeStructures"]
 
-@functools.cache
+structurePageSize = 100
+maxPageWorkers = 4
+
+def getReducedFormula(formula):
+    # OPTIMADE's chemical_formula_reduced lists the elements in
+    # alphabetical order with the counts divided by their gcd
+    from pymatgen.core import Composition
+
+    composition = Composition(formula, strict=True).reduced_composition
+    parts = []
+
+    for el, amount in sorted(composition.items(), key=lambda x: str(x[0])):
+        amount = int(amount) if float(amount).is_integer() else amount
+        parts.append(f"{el}{amount if amount != 1 else ''}")
+
+    return "".join(parts)
+
+def fetchStructurePage(formulaFilter, offset, oqmdr=None):
+    kwargs = {
+        "filter": formulaFilter,
+        "limit": structurePageSize,
+        "offset": offset,
+    }
+
+    if oqmdr is not None:
+        return getPolicy("oqmd").call(oqmdr.get_optimade_structures, verbose=False, **kwargs)
+
+    # Each concurrent page gets its own session
+    with QMPYRester() as pageRester:
+        return getPolicy("oqmd").call(pageRester.get_optimade_structures, verbose=False, **kwargs)
+
+def fetchCompositionStructures(oqmdr, formula):
+    # Pulls every structure for the composition in one OPTIMADE
+    # query (plus concurrent follow up pages if there are more
+    # than fit on one page) and indexes them by OQMD entry id
+    formulaFilter = f'chemical_formula_reduced="{getReducedFormula(formula)}"'
+    firstPage = fetchStructurePage(formulaFilter, 0, oqmdr)
+
+    pages = [firstPage]
+    meta = firstPage.get("meta") or {}
+    total = meta.get("data_returned") or 0
+
+    if meta.get("more_data_available") and total > structurePageSize:
+        offsets = range(structurePageSize, total, structurePageSize)
+        logDebug("Retrieving %d more pages of OQMD structures...", len(offsets))
+
+        with ThreadPoolExecutor(max_workers=maxPageWorkers) as pool:
+            pages.extend(pool.map(lambda offset: fetchStructurePage(formulaFilter, offset), offsets))
+
+    structuresByEntry = {}
+
+    for page in pages:
+        for item in page.get("data") or []:
+            entryId = item.get("attributes", {}).get("_oqmd_entry_id")
+
+            if entryId is not None:
+                structuresByEntry.setdefault(str(entryId), {"data": [item]})
+
+    return structuresByEntry
+
+def fetchStructureByProperties(oqmdr, d):
+    # Old lookup that matches a phase to its structure through its
+    # band gap, stability and formation energy. Only used for
+    # phases the composition query didn't return a structure for.
+    structKwargs = {
+        "_oqmd_band_gap": str(d.get("band_gap")),
+        "_oqmd_stability": str(d.get("stability")),
+        "_oqmd_delta_e": str(d.get("delta_e"))
+    }
+
+    return getPolicy("oqmd").call(oqmdr.get_optimade_structures, verbose=False, **structKwargs)
+
+@memoryCached()
+@cachedRetrieval("oqmd", oqmdFields)
 def retrieveOqmdData(formula):
     try:
         logDebug("Retrieving OQMD data...")
         with QMPYRester() as oqmdr:
             kwargs = {
-                "composition": formula,  
+                "composition": formula,
             }
 
-            dataFromOqmd = oqmdr.get_oqmd_phases(verbose=False, **kwargs)
+            dataFromOqmd = getPolicy("oqmd").call(oqmdr.get_oqmd_phases, verbose=False, **kwargs)
             logDebug("Retrieved data from OQMD. Putting into dictionary...")
-            logDebug(f"Found these many results from OQMD: {len(dataFromOqmd.get("data")) if len(dataFromOqmd.get("data")) != 0 else "None"}")
+            logDebug("Found these many results from OQMD: %s", len(dataFromOqmd.get("data")) or "None")
 
 
             data = []
 
             if len(dataFromOqmd.get("data")) != 0:
-                item = 1
-                for d in dataFromOqmd.get("data"):
-                    logDebug("Retrieving Structure: " + (" " if item < 10 else "") + str(item) + "/" + str(len(dataFromOqmd.get("data"))))
-                    item += 1
+                logDebug("Retrieving Structures...")
+
+                try:
+                    structuresByEntry = fetchCompositionStructures(oqmdr, formula)
+                except TransientRetrievalError:
+                    raise
+                except Exception:
+                    logError()
+                    structuresByEntry = {}
 
-                    structKwargs = { 
-                        "_oqmd_band_gap": str(d.get("band_gap")),
-                        "_oqmd_stability": str(d.get("stability")),
-                        "_oqmd_delta_e": str(d.get("delta_e"))
-                    }
+                for d in dataFromOqmd.get("data"):
+                    structureData = structuresByEntry.get(str(d.get("entry_id")))
 
-                    structureData = oqmdr.get_optimade_structures(verbose=False, **structKwargs)
+                    if structureData is None:
+                        logDebug("No structure for OQMD entry %s in the composition query, looking it up directly", d.get("entry_id"))
+                        structureData = fetchStructureByProperties(oqmdr, d)
 
                     data.append({
                         "oqmdId": d.get("entry_id"),
@@ -52,10 +133,22 @@ def retrieveOqmdData(formula):
                 })
 
             return data
-    except Exception:
+    except TransientRetrievalError as e:
+        logDebug("OQMD lookup for %s failed: %s", formula, e)
+        return transientErrorData("OQMD", e)
+    except Exception as e:
         logError()
 
+        if isTransientError(e):
+            return transientErrorData("OQMD", e)
+
         return [{
             "message": "Error occurred, most likely trying to parse the formula",
-            "dataFound": False
-        }]
\ No newline at end of file
+            "dataFound": False,
+            "error": True,
+            "errorType": errorParse
+        }]
+
+async def retrieveOqmdDataAsync(formula):
+    # Awaitable version of the lookup, see asyncPool.py
+    return await runLimited("oqmd", retrieveOqmdData, formula)
@@ -0,0 +1,302 @@
+import os
+import gzip
+import json
+import re
+import time
+import random
+import threading
+from collections import deque
+from types import SimpleNamespace
+
+from src.data.formulas import getFormulaKey
+
+# Replay stand-ins for MPRester and QMPYRester that answer from a
+# recorded dataset instead of the live APIs. They implement only the
+# calls the retrievers and cleaners make:
+#
+#   MPRester:   materials.summary.search(formula=..., material_ids=...)
+#   QMPYRester: get_oqmd_phases(composition=...)
+#               get_optimade_structures(filter=..., limit=..., offset=...)
+#               get_optimade_structures(_oqmd_band_gap=..., ...)
+#
+# Dataset layout (plain or gzipped JSON):
+#
+#   {
+#       "version": 1,
+#       "source": "recorded" | "synthetic",
+#       "mp": {formula: [summary doc, ...]},
+#       "oqmd": {
+#           "phases": {formula: get_oqmd_phases response},
+#           "structures": {reduced formula: [OPTIMADE structure, ...]}
+#       }
+#   }
+#
+# MP summary docs are stored with the fields in mpRetriever.mpFields,
+# the structure as Structure.as_dict() and symmetry as {"number": n}.
+#
+# Setting QSI_REPLAY_DATASET makes the clients in data/clients.py
+# answer from that dataset, so the retrievers and cleaners run against
+# it without any other changes. Every request then goes through a
+# ReplayTransport that can act like the real services:
+#
+#   QSI_REPLAY_LATENCY     seconds each request takes (default 0)
+#   QSI_REPLAY_JITTER      latency varies by +- this fraction (default 0)
+#   QSI_REPLAY_ERROR_RATE  share of requests failing with a 503 (default 0)
+#   QSI_REPLAY_RATE_LIMIT  requests per second before requests fail
+#                          with a 429, 0 for no limit (default 0)
+#   QSI_REPLAY_SEED        seed for the jitter and errors (default 0)
+#
+# The settings are read from the environment when the transport is
+# first used, so worker processes pick them up as well (each process
+# gets its own transport and rate limit window).
+
+replayDatasetVersion = 1
+
+reducedFormulaFilter = re.compile(r'chemical_formula_reduced\s*=\s*"([^"]*)"')
+
+replaySettings = {
+    "QSI_REPLAY_LATENCY": ("latency", float),
+    "QSI_REPLAY_JITTER": ("jitter", float),
+    "QSI_REPLAY_ERROR_RATE": ("errorRate", float),
+    "QSI_REPLAY_RATE_LIMIT": ("rateLimit", float),
+    "QSI_REPLAY_SEED": ("seed", int),
+}
+
+rateLimitWindow = 1.0
+
+class ReplayApiError(Exception):
+    # Raised like the HTTP errors of the real clients, status is the
+    # HTTP status the live service would have answered with
+    def __init__(self, status, message):
+        super().__init__(f"{status} {message}")
+        self.status = status
+
+def loadReplayDataset(path):
+    opener = gzip.open if path.endswith(".gz") else open
+
+    with opener(path, 'rt') as f:
+        dataset = json.load(f)
+
+    if dataset.get("version") != replayDatasetVersion:
+        raise ValueError(f"Replay dataset {path} is version {dataset.get('version')}, expected {replayDatasetVersion}")
+
+    return dataset
+
+def saveReplayDataset(dataset, path):
+    opener = gzip.open if path.endswith(".gz") else open
+
+    with opener(path, 'wt') as f:
+        json.dump(dataset, f)
+
+def docFromDict(doc):
+    # Same attributes as the mp_api summary doc, the structure is
+    # deserialized like mp_api does
+    from pymatgen.core import Structure
+
+    structure = doc.get("structure")
+
+    return SimpleNamespace(
+        material_id=doc.get("material_id"),
+        deprecated=doc.get("deprecated"),
+        formula_pretty=doc.get("formula_pretty"),
+        band_gap=doc.get("band_gap"),
+        energy_above_hull=doc.get("energy_above_hull"),
+        formation_energy_per_atom=doc.get("formation_energy_per_atom"),
+        symmetry=SimpleNamespace(number=(doc.get("symmetry") or {}).get("number")),
+        structure=Structure.from_dict(structure) if structure is not None else None,
+    )
+
+class ReplayTransport:
+    def __init__(self, dataset, latency=0, jitter=0, errorRate=0, rateLimit=0, seed=0):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.rateLimit = rateLimit
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recentRequests = deque()
+        self.counts = {"requests": 0, "errors": 0, "rateLimited": 0}
+        self.endpointCounts = {}
+
+    def request(self, endpoint):
+        # Called before every replayed request. Sleeps for the
+        # simulated latency and raises ReplayApiError for requests
+        # that fail.
+        with self.lock:
+            now = time.monotonic()
+            self.counts["requests"] += 1
+            self.endpointCounts[endpoint] = self.endpointCounts.get(endpoint, 0) + 1
+
+            if self.rateLimit > 0:
+                while self.recentRequests and now - self.recentRequests[0] >= rateLimitWindow:
+                    self.recentRequests.popleft()
+
+                if len(self.recentRequests) >= self.rateLimit * rateLimitWindow:
+                    self.counts["rateLimited"] += 1
+                    raise ReplayApiError(429, f"Too Many Requests ({endpoint})")
+
+                self.recentRequests.append(now)
+
+            delay = self.latency * (1 + self.jitter * self.random.uniform(-1, 1))
+            failed = self.random.random() < self.errorRate
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if failed:
+            with self.lock:
+                self.counts["errors"] += 1
+            raise ReplayApiError(503, f"Service Unavailable ({endpoint})")
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, endpoints=dict(self.endpointCounts))
+
+    def MPRester(self, *args, **kwargs):
+        return ReplayMPRester(self.dataset, transport=self)
+
+    def QMPYRester(self, *args, **kwargs):
+        return ReplayQMPYRester(self.dataset, transport=self)
+
+_transport = None
+_transportKey = None
+_transportLock = threading.Lock()
+
+def getReplayTransport():
+    # The transport for the current QSI_REPLAY_* settings, or None
+    # when no replay dataset is configured
+    global _transport, _transportKey
+
+    path = os.getenv("QSI_REPLAY_DATASET")
+    if not path:
+        return None
+
+    key = (path,) + tuple(os.getenv(name) for name in replaySettings)
+
+    with _transportLock:
+        if _transportKey != key:
+            options = {option: parse(os.environ[name]) for name, (option, parse) in replaySettings.items() if os.getenv(name)}
+            _transport = ReplayTransport(loadReplayDataset(path), **options)
+            _transportKey = key
+
+        return _transport
+
+def configureReplay(path, **options):
+    # Same as setting the QSI_REPLAY_* variables by hand; options use
+    # the ReplayTransport argument names. Always starts a new
+    # transport (fresh counts and rate limit window) and returns it.
+    global _transportKey
+
+    names = {option: name for name, (option, _) in replaySettings.items()}
+
+    os.environ["QSI_REPLAY_DATASET"] = os.path.abspath(path)
+    for option, name in names.items():
+        if option in options:
+            os.environ[name] = str(options[option])
+        else:
+            os.environ.pop(name, None)
+
+    with _transportLock:
+        _transportKey = None
+
+    return getReplayTransport()
+
+def disableReplay():
+    for name in ["QSI_REPLAY_DATASET", *replaySettings]:
+        os.environ.pop(name, None)
+
+def isReplayEnabled():
+    return bool(os.getenv("QSI_REPLAY_DATASET"))
+
+class ReplaySummary:
+    def __init__(self, dataset, transport=None):
+        self.transport = transport
+        self.docsByFormula = {}
+        self.docsById = {}
+
+        # MP matches formulas by composition, so "S2Mo" finds the docs
+        # recorded for "MoS2"
+        for formula, docs in dataset.get("mp", {}).items():
+            self.docsByFormula.setdefault(getFormulaKey(formula), docs)
+
+            for doc in docs:
+                self.docsById.setdefault(str(doc.get("material_id")), doc)
+
+    def search(self, formula=None, material_ids=None, fields=None, **kwargs):
+        if self.transport is not None:
+            self.transport.request("summary.search")
+
+        if material_ids is not None:
+            docs = [self.docsById[str(i)] for i in material_ids if str(i) in self.docsById]
+        else:
+            formulas = [formula] if isinstance(formula, str) else list(formula or [])
+            docs = [doc for f in formulas for doc in self.docsByFormula.get(getFormulaKey(f), [])]
+
+        return [docFromDict(doc) for doc in docs]
+
+class ReplayMPRester:
+    def __init__(self, dataset, *args, transport=None, **kwargs):
+        self.materials = SimpleNamespace(summary=ReplaySummary(dataset, transport))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class ReplayQMPYRester:
+    def __init__(self, dataset, *args, transport=None, **kwargs):
+        self.transport = transport
+        oqmd = dataset.get("oqmd", {})
+        self.phases = {getFormulaKey(formula): response for formula, response in oqmd.get("phases", {}).items()}
+        self.structures = oqmd.get("structures", {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_oqmd_phases(self, verbose=False, composition=None, **kwargs):
+        if self.transport is not None:
+            self.transport.request("get_oqmd_phases")
+
+        return self.phases.get(getFormulaKey(composition), {"data": []})
+
+    def get_optimade_structures(self, verbose=False, filter=None, limit=None, offset=0, **kwargs):
+        if self.transport is not None:
+            self.transport.request("get_optimade_structures")
+
+        if filter is not None:
+            match = reducedFormulaFilter.search(filter)
+            items = self.structures.get(match.group(1), []) if match else []
+        else:
+            items = self.findByProperties(kwargs)
+
+        offset = offset or 0
+        page = items[offset:offset + limit] if limit else items[offset:]
+
+        return {
+            "data": page,
+            "meta": {
+                "data_returned": len(items),
+                "more_data_available": offset + len(page) < len(items),
+            }
+        }
+
+    def findByProperties(self, properties):
+        # The retriever's fallback lookup by band gap, stability and
+        # formation energy of a phase
+        keys = {"_oqmd_band_gap": "band_gap", "_oqmd_stability": "stability", "_oqmd_delta_e": "delta_e"}
+        wanted = {field: properties[key] for key, field in keys.items() if key in properties}
+
+        for response in self.phases.values():
+            for phase in response.get("data", []):
+                if all(str(phase.get(field)) == value for field, value in wanted.items()):
+                    entryId = phase.get("entry_id")
+                    return [item for items in self.structures.values() for item in items
+                            if item.get("attributes", {}).get("_oqmd_entry_id") == entryId]
+
+        return []
@@ -0,0 +1,288 @@
+import os
+import re
+import time
+import queue
+import random
+import atexit
+import threading
+
+from dotenv import load_dotenv
+from utils.debug import logDebug
+
+load_dotenv()
+
+# Shared request handling for the MP and OQMD clients: a token bucket
+# per source so bulk runs stay under the allowed request rate, retries
+# with exponential backoff and full jitter for transient failures, a
+# circuit breaker per source and a pool of open clients so sessions
+# are reused instead of opened for every formula.
+#
+# The retrievers and cleaners are imported under two package paths
+# (src.data and data), so this module is always imported as
+# src.data.requestPolicy to keep one set of buckets, breakers and
+# pools (and one TransientRetrievalError class) per process.
+
+# Error categories of retriever output (the "errorType" key)
+errorNotFound = "notFound"
+errorTransient = "transient"
+errorParse = "parse"
+
+sourceSettings = {
+    "mp": {"rate": float(os.getenv("QSI_MP_RATE_LIMIT", 25)), "burst": int(os.getenv("QSI_MP_BURST", 25))},
+    "oqmd": {"rate": float(os.getenv("QSI_OQMD_RATE_LIMIT", 10)), "burst": int(os.getenv("QSI_OQMD_BURST", 10))},
+}
+
+retryAttempts = int(os.getenv("QSI_RETRY_ATTEMPTS", 5))
+retryBaseDelay = float(os.getenv("QSI_RETRY_BASE_DELAY", 0.5))
+retryMaxDelay = float(os.getenv("QSI_RETRY_MAX_DELAY", 30))
+
+circuitThreshold = int(os.getenv("QSI_CIRCUIT_THRESHOLD", 10))
+circuitResetTime = float(os.getenv("QSI_CIRCUIT_RESET", 30))
+
+clientPoolSize = int(os.getenv("QSI_CLIENT_POOL_SIZE", 8))
+
+transientStatuses = {408, 429, 500, 502, 503, 504}
+transientErrorNames = {"ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout", "ChunkedEncodingError", "ProtocolError"}
+
+# Phrases that only show up in rate limit, timeout and outage messages.
+# A status code only counts when the message says it is one (mp_api's
+# "error status code 503"), so ids like mp-504 or "500 results" in
+# other errors don't make them transient.
+transientMessages = re.compile(
+    r"status(?: code)?:? (?:408|429|500|502|503|504)\b|too many requests|rate limit|timed out|"
+    r"temporarily unavailable|service unavailable|bad gateway|gateway time-?out",
+    re.IGNORECASE)
+
+class TransientRetrievalError(Exception):
+    # A request that kept failing for reasons that have nothing to do
+    # with the formula (rate limits, timeouts, outages). The formula
+    # should be retried later rather than treated as not found.
+    pass
+
+def isTransientError(error):
+    if isinstance(error, (TransientRetrievalError, TimeoutError, ConnectionError)):
+        return True
+
+    # HTTP status as the replay clients (status) and requests
+    # (status_code, response.status_code) report it
+    response = getattr(error, "response", None)
+    statuses = (getattr(error, "status", None), getattr(error, "status_code", None), getattr(response, "status_code", None))
+    if any(status in transientStatuses for status in statuses):
+        return True
+
+    if any(cls.__name__ in transientErrorNames for cls in type(error).__mro__):
+        return True
+
+    return bool(transientMessages.search(str(error)))
+
+def transientErrorData(source, error):
+    return [{
+        "message": f"{source} request failed with a transient error ({error}), try again later",
+        "dataFound": False,
+        "error": True,
+        "errorType": errorTransient
+    }]
+
+def getErrorType(data):
+    # Category of a retriever result, None when data was found
+    if data[0].get("dataFound"):
+        return None
+    if not data[0].get("error"):
+        return errorNotFound
+    return data[0].get("errorType", errorParse)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a request may be sent. A rate of 0 or less
+        # means no limit.
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.rate)
+                self.updatedAt = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+class CircuitBreaker:
+    # Opens after threshold transient failures in a row. While open,
+    # requests fail right away; after resetTime one trial request is
+    # let through and its outcome closes or reopens the circuit.
+    def __init__(self, threshold=circuitThreshold, resetTime=circuitResetTime):
+        self.threshold = threshold
+        self.resetTime = resetTime
+        self.failures = 0
+        self.openedAt = None
+        self.trialRunning = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.openedAt is None:
+                return True
+
+            if time.monotonic() - self.openedAt < self.resetTime or self.trialRunning:
+                return False
+
+            self.trialRunning = True
+            return True
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialRunning = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            self.trialRunning = False
+
+            if self.openedAt is not None or self.failures >= self.threshold:
+                self.openedAt = time.monotonic()
+
+    def isOpen(self):
+        with self.lock:
+            return self.openedAt is not None
+
+class RequestPolicy:
+    def __init__(self, source, rate, burst, attempts=retryAttempts, baseDelay=retryBaseDelay, maxDelay=retryMaxDelay, breaker=None):
+        self.source = source
+        self.bucket = TokenBucket(rate, burst)
+        self.attempts = attempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.breaker = breaker or CircuitBreaker()
+
+    def getDelay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+    def call(self, request, *args, **kwargs):
+        # Sends one request under the rate limit, retrying transient
+        # failures. Raises TransientRetrievalError once the retries
+        # are used up or the circuit is open; any other error is
+        # raised as is.
+        for attempt in range(self.attempts):
+            if not self.breaker.allow():
+                raise TransientRetrievalError(f"{self.source.upper()} circuit is open after repeated failures")
+
+            self.bucket.acquire()
+
+            try:
+                result = request(*args, **kwargs)
+            except Exception as e:
+                if not isTransientError(e):
+                    # The service answered, it just didn't like the
+                    # request
+                    self.breaker.recordSuccess()
+                    raise
+
+                self.breaker.recordFailure()
+
+                if attempt + 1 >= self.attempts:
+                    raise TransientRetrievalError(f"{self.source.upper()} request failed {self.attempts} times: {e}") from e
+
+                delay = self.getDelay(attempt)
+                logDebug("Transient %s error (%s), retrying in %.2fs", self.source.upper(), e, delay)
+                time.sleep(delay)
+                continue
+
+            self.breaker.recordSuccess()
+            return result
+
+        raise TransientRetrievalError(f"{self.source.upper()} request was not attempted")
+
+policies = {}
+policiesLock = threading.Lock()
+
+def getPolicy(source):
+    with policiesLock:
+        if source not in policies:
+            policies[source] = RequestPolicy(source, **sourceSettings[source])
+        return policies[source]
+
+class ClientPool:
+    # Keeps up to size opened clients around for reuse. A client is
+    # only used by one thread at a time and is closed instead of put
+    # back if its block raised, in case its session is broken.
+    def __init__(self, factory, size=clientPoolSize):
+        self.factory = factory
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            client = self.factory()
+            return client.__enter__()
+
+    def release(self, client, failed=False):
+        if not failed:
+            try:
+                self.idle.put_nowait(client)
+                return
+            except queue.Full:
+                pass
+
+        closeClient(client)
+
+    def close(self):
+        while True:
+            try:
+                closeClient(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+def closeClient(client):
+    try:
+        client.__exit__(None, None, None)
+    except Exception:
+        pass
+
+class PooledClient:
+    # Context manager handing out a pooled client, used like the
+    # client itself: with PooledClient(pool) as mpr: ...
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
+
+    def __enter__(self):
+        self.client = self.pool.acquire()
+        return self.client
+
+    def __exit__(self, excType, exc, tb):
+        self.pool.release(self.client, failed=excType is not None)
+        self.client = None
+        return False
+
+pools = {}
+poolsLock = threading.Lock()
+
+def getClientPool(key, factory):
+    with poolsLock:
+        if key not in pools:
+            pools[key] = ClientPool(factory)
+        return pools[key]
+
+@atexit.register
+def closeClientPools():
+    with poolsLock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import functools
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from utils.debug import logDebug, logError
+from src.data.formulas import getFormulaKey
+
+load_dotenv()
+
+# Bump this whenever the shape of the retriever output changes so
+# that stale entries written by an older version are ignored.
+cacheVersion = 2
+
+defaultCachePath = os.path.join(os.path.expanduser("~"), ".qsi", "retrievalCache.sqlite")
+cachePath = os.getenv("QSI_CACHE_PATH", defaultCachePath)
+cacheTtl = float(os.getenv("QSI_CACHE_TTL", 30 * 24 * 60 * 60))
+cacheMaxEntries = int(os.getenv("QSI_CACHE_MAX_ENTRIES", 50000))
+cacheEnabled = os.getenv("QSI_CACHE_DISABLED", "").lower() not in ("1", "true", "yes")
+
+# Number of formulas whose raw retriever output (structures included)
+# is also kept in memory. Bounded so long screens don't accumulate
+# every payload they ever fetched.
+memoryCacheSize = int(os.getenv("QSI_MEMORY_CACHE_SIZE", 256))
+
+
+def normalizeFormula(formula):
+    # Equivalent spellings of a formula share one entry, see formulas.py
+    return getFormulaKey(formula)
+
+def makeKey(source, formula, fields):
+    return f"{source}|{normalizeFormula(formula)}|{','.join(sorted(fields))}"
+
+
+class RetrievalCache:
+    def __init__(self, path=cachePath, ttl=cacheTtl, maxEntries=cacheMaxEntries, version=cacheVersion):
+        self.path = path
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.version = version
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                createdAt REAL NOT NULL,
+                accessedAt REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entriesAccessed ON entries (accessedAt)")
+        self.connection.commit()
+
+    def get(self, source, formula, fields):
+        key = makeKey(source, formula, fields)
+        now = time.time()
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT version, createdAt, payload FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            version, createdAt, payload = row
+
+            if version != self.version or now - createdAt > self.ttl:
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+
+            self.connection.execute("UPDATE entries SET accessedAt = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+
+        return json.loads(payload)
+
+    def put(self, source, formula, fields, data):
+        key = makeKey(source, formula, fields)
+        now = time.time()
+        payload = json.dumps(data)
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (key, version, createdAt, accessedAt, payload) VALUES (?, ?, ?, ?, ?)",
+                (key, self.version, now, now, payload)
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # Drops the least recently used entries once the cache grows
+        # past maxEntries. Expects the lock to already be held.
+        count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        overflow = count - self.maxEntries
+
+        if overflow > 0:
+            self.connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessedAt ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries")
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_sharedCache = None
+_sharedCacheLock = threading.Lock()
+
+def getCache():
+    global _sharedCache
+
+    if not cacheEnabled:
+        return None
+
+    # Replayed responses never go into the default cache, only into
+    # one that was picked explicitly with QSI_CACHE_PATH
+    if os.getenv("QSI_REPLAY_DATASET") and not os.getenv("QSI_CACHE_PATH"):
+        return None
+
+    with _sharedCacheLock:
+        if _sharedCache is None:
+            try:
+                _sharedCache = RetrievalCache()
+            except (sqlite3.Error, OSError):
+                logError()
+                return None
+
+    return _sharedCache
+
+def isCacheable(data):
+    # Errors are never written to disk, otherwise a single network
+    # hiccup would keep a formula "not found" until the TTL expires.
+    return all(not d.get("error") for d in data)
+
+def memoryCached(maxsize=memoryCacheSize):
+    # Like functools.lru_cache, except that errors aren't kept so a
+    # failed lookup is retried on the next call
+    def decorator(retrieve):
+        entries = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(retrieve)
+        def wrapper(formula):
+            # The retriever is called with the canonical formula too,
+            # so inputs like "S6S10" are sent as "S"
+            formula = normalizeFormula(formula)
+
+            with lock:
+                if formula in entries:
+                    entries.move_to_end(formula)
+                    return entries[formula]
+
+            data = retrieve(formula)
+
+            if isCacheable(data):
+                with lock:
+                    entries[formula] = data
+                    if len(entries) > maxsize:
+                        entries.popitem(last=False)
+
+            return data
+
+        wrapper.cache_clear = entries.clear
+        return wrapper
+    return decorator
+
+def readCache(cache, source, formula, fields):
+    # A locked or broken cache counts as a miss instead of failing
+    # the lookup
+    if cache is None:
+        return None
+
+    try:
+        return cache.get(source, formula, fields)
+    except sqlite3.Error:
+        logError()
+        return None
+
+def writeCache(cache, source, formula, fields, data):
+    if cache is None or not isCacheable(data):
+        return
+
+    try:
+        cache.put(source, formula, fields, data)
+    except (sqlite3.Error, TypeError, ValueError):
+        logError()
+
+def cachedRetrieval(source, fields):
+    def decorator(retrieve):
+        @functools.wraps(retrieve)
+        def wrapper(formula):
+            formula = normalizeFormula(formula)
+            cache = getCache()
+
+            cached = readCache(cache, source, formula, fields)
+
+            if cached is not None:
+                logDebug("Loaded %s data for %s from the local cache", source.upper(), formula)
+                return cached
+
+            data = retrieve(formula)
+            writeCache(cache, source, formula, fields, data)
+
+            return data
+        return wrapper
+    return decorator
@@ -0,0 +1,446 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.debug import logDebug, logError
+from src.data.formulas import getCanonicalFormula, getFormulaKey
+from src.data.structureStore import StructureStore, PackedStructures, encodeStructure, openStructureStore, closeStructureStore
+
+load_dotenv()
+
+# Local copy of everything calculateQsi needs from MP and OQMD, so
+# single lookups and whole bulk runs can work without the network.
+#
+# A snapshot is a directory of .npy columns (one value per material
+# row) that are memory mapped when opened, so opening one is instant
+# and only the rows that are actually read are paged in:
+#
+#   ids, source, formulaCode          material id, 0 = MP / 1 = OQMD,
+#                                     index into formulas
+#   bandGap, hullDistance,            float64, NaN when missing
+#   formationEnergy
+#   symmetry                          space group number, 0 when missing
+#   compositionKeys,                  composition index: rows are sorted
+#   compositionOffsets                by canonical formula (formulas.py),
+#                                     key i owns rows offsets[i]:offsets[i + 1]
+#
+# plus meta.json and the structures, packed in a StructureStore keyed
+# by material id (structures/, see structureStore.py) in the same
+# order as the rows. Disordered structures can't be packed and are
+# kept as Structure dicts in disordered.json instead. Like the live
+# lookups, a composition's MP rows are used when there are any and
+# its OQMD rows otherwise.
+#
+# Build one from a bulk input file with
+#
+#     python -m src.data.snapshot build bulkTestData/testData.json --output ~/.qsi/snapshot
+#
+# (an existing --output directory is only replaced if it holds a
+# snapshot or is empty) and switch to it with QSI_DATA_SOURCE=snapshot (QSI_SNAPSHOT_PATH
+# picks the directory) or setDataSource("snapshot", path).
+#
+# Imported as src.data.snapshot everywhere so there is one data
+# source setting per process.
+
+snapshotVersion = 3
+
+sourceMp = 0
+sourceOqmd = 1
+
+defaultSnapshotPath = os.path.join(os.path.expanduser("~"), ".qsi", "snapshot")
+
+dataSource = os.getenv("QSI_DATA_SOURCE", "live").lower()
+snapshotPath = os.getenv("QSI_SNAPSHOT_PATH", defaultSnapshotPath)
+
+dataSources = ("live", "snapshot")
+
+floatColumns = ["bandGap", "hullDistance", "formationEnergy"]
+
+# Formulas looked up per MP batch while building
+buildChunkSize = 1000
+
+def setDataSource(source, path=None):
+    global dataSource, snapshotPath
+
+    if source not in dataSources:
+        raise ValueError(f"Unknown data source '{source}', expected one of {', '.join(dataSources)}")
+
+    dataSource = source
+    if path is not None:
+        snapshotPath = path
+
+def getSnapshotPath():
+    # Path of the snapshot to read from, None when the live databases
+    # are used
+    if dataSource == "snapshot":
+        return snapshotPath
+    return None
+
+def checkOutputPath(path):
+    # Building replaces the whole directory, so refuse anything that
+    # isn't a previous snapshot or empty
+    if not os.path.exists(path):
+        return
+
+    if not os.path.isdir(path) or (os.listdir(path) and not os.path.exists(os.path.join(path, "meta.json"))):
+        raise FileExistsError(f"{path} exists and is not a snapshot, pick an empty or new directory for --output")
+
+def loadColumn(path, name):
+    columnPath = os.path.join(path, f"{name}.npy")
+
+    try:
+        return np.load(columnPath, mmap_mode='r')
+    except ValueError:
+        # Empty columns can't be memory mapped
+        return np.load(columnPath)
+
+class Snapshot:
+    columnNames = ["ids", "source", "formulaCode", "formulas", *floatColumns, "symmetry",
+                   "compositionKeys", "compositionOffsets"]
+
+    def __init__(self, path):
+        metaPath = os.path.join(path, "meta.json")
+
+        if not os.path.exists(metaPath):
+            raise FileNotFoundError(f"No snapshot at {path}. Build one with 'python -m src.data.snapshot build <input file> --output {path}'.")
+
+        with open(metaPath, 'r') as f:
+            self.meta = json.load(f)
+
+        if self.meta.get("version") != snapshotVersion:
+            raise ValueError(f"Snapshot at {path} is version {self.meta.get('version')}, expected {snapshotVersion}. Rebuild it with 'python -m src.data.snapshot build'.")
+
+        self.path = path
+        self.columns = {name: loadColumn(path, name) for name in self.columnNames}
+        self.structures = openStructureStore(os.path.join(path, "structures"))
+
+        with open(os.path.join(path, "disordered.json"), 'r') as f:
+            self.disordered = json.load(f)
+
+    def __len__(self):
+        return len(self.columns["ids"])
+
+    def getFormulas(self):
+        # Canonical formula of every composition in the snapshot
+        return self.columns["compositionKeys"].tolist()
+
+    def getTable(self):
+        # Properties of every row as a MaterialTable, for scoring or
+        # querying the whole snapshot at once (see materialIndex.py)
+        from src.data.materialTable import MaterialTable
+
+        columns = self.columns
+        return MaterialTable.fromColumns(columns["formulas"].tolist(), columns["formulaCode"], columns["symmetry"],
+                                         {name: columns[name] for name in floatColumns})
+
+    def getRows(self, formula):
+        key = getCanonicalFormula(formula)
+        keys = self.columns["compositionKeys"]
+
+        if key is None or len(keys) == 0:
+            return range(0)
+
+        i = int(np.searchsorted(keys, key))
+
+        if i >= len(keys) or keys[i] != key:
+            return range(0)
+
+        offsets = self.columns["compositionOffsets"]
+        return range(int(offsets[i]), int(offsets[i + 1]))
+
+    def getDataPoint(self, row):
+        columns = self.columns
+        source = int(columns["source"][row])
+
+        def value(name):
+            v = float(columns[name][row])
+            return None if np.isnan(v) else v
+
+        dataPoint = {
+            "mpId" if source == sourceMp else "oqmdId": str(columns["ids"][row]),
+            "formula": str(columns["formulas"][columns["formulaCode"][row]]),
+            "bandGap": value("bandGap"),
+            "hullDistance": value("hullDistance"),
+            "formationEnergy": value("formationEnergy"),
+            "symmetry": int(columns["symmetry"][row]) or None,
+            "snapshotRow": row,
+            "dataFound": True
+        }
+
+        if source == sourceMp:
+            dataPoint["deprecated"] = False
+
+        return dataPoint
+
+    def getData(self, formula, source):
+        # Rows of one source for the formula, in the same format as
+        # the retrievers return
+        sourceCode = sourceMp if source == "mp" else sourceOqmd
+        sources = self.columns["source"]
+        data = [self.getDataPoint(row) for row in self.getRows(formula) if sources[row] == sourceCode]
+
+        if data:
+            return data
+
+        return [{
+            "message": f"No data found in the {source.upper()} part of the snapshot",
+            "dataFound": False
+        }]
+
+    def getStructures(self, data):
+        # PackedStructures for data points from getData, labelled with
+        # their ids like the cleaners do. Rows stored without a
+        # structure are left out. If any of them is disordered this is
+        # a list of Structures in the order of data instead.
+        from pymatgen.core import Structure
+
+        ids = [d.get("mpId", d.get("oqmdId")) for d in data]
+        packed = self.structures.get(ids)
+
+        if not any(materialId in self.disordered for materialId in ids):
+            return packed
+
+        packedById = {entry.label: entry for entry in packed.getEntries()}
+        structures = []
+
+        for materialId in ids:
+            if materialId in self.disordered:
+                structure = Structure.from_dict(self.disordered[materialId])
+                structure.label = materialId
+                structures.append(structure)
+            elif materialId in packedById:
+                structures.append(packedById[materialId].structure)
+
+        return structures
+
+_openSnapshots = {}
+_openSnapshotsLock = threading.Lock()
+
+def openSnapshot(path=None):
+    path = path or snapshotPath
+
+    with _openSnapshotsLock:
+        if path not in _openSnapshots:
+            _openSnapshots[path] = Snapshot(path)
+        return _openSnapshots[path]
+
+class SnapshotWriter:
+    def __init__(self):
+        self.rows = []
+        self.failed = []
+
+    def add(self, key, source, materialId, dataPoint, structure, symmetry):
+        encoded = encodeStructure(structure)
+
+        self.rows.append({
+            "key": key,
+            "source": source,
+            "id": str(materialId),
+            "formula": dataPoint.get("formula"),
+            "values": [dataPoint.get(name) for name in floatColumns],
+            "symmetry": symmetry or 0,
+            "structure": encoded,
+            "disordered": structure.as_dict() if encoded is None and structure is not None else None,
+        })
+
+    def addMp(self, key, data, structures):
+        structuresById = {s.label: s for s in structures}
+
+        for d in data:
+            if not d.get("deprecated"):
+                self.add(key, sourceMp, d.get("mpId"), d, structuresById.get(d.get("mpId")), d.get("symmetry"))
+
+    def addOqmd(self, key, data, structures):
+        from src.data.oqmd.oqmdCleaner import getSpaceGroupNumber
+
+        structuresById = {s.label: s for s in structures}
+
+        for d in data:
+            try:
+                symmetry = getSpaceGroupNumber(d.get("symmetry"))
+            except Exception:
+                symmetry = None
+
+            self.add(key, sourceOqmd, d.get("oqmdId"), d, structuresById.get(d.get("oqmdId")), symmetry)
+
+    def write(self, path, **meta):
+        # Rows are sorted by composition (MP before OQMD within one)
+        # so every composition is one contiguous block. Written next
+        # to the destination first so a failed build doesn't leave a
+        # half written snapshot behind.
+        checkOutputPath(path)
+
+        rows = sorted(self.rows, key=lambda r: (r["key"], r["source"]))
+        count = len(rows)
+
+        formulas = list(dict.fromkeys(r["formula"] for r in rows))
+        formulaCodes = {formula: code for code, formula in enumerate(formulas)}
+
+        keys = np.array([r["key"] for r in rows], dtype=str)
+        compositionKeys = np.unique(keys)
+        compositionOffsets = np.append(np.searchsorted(keys, compositionKeys), count)
+
+        columns = {
+            "ids": np.array([r["id"] for r in rows], dtype=str),
+            "source": np.array([r["source"] for r in rows], dtype=np.int8),
+            "formulaCode": np.array([formulaCodes[r["formula"]] for r in rows], dtype=np.int32),
+            "formulas": np.array(formulas, dtype=str),
+            "symmetry": np.array([r["symmetry"] for r in rows], dtype=np.int16),
+            "compositionKeys": compositionKeys,
+            "compositionOffsets": compositionOffsets.astype(np.int64),
+        }
+
+        for i, name in enumerate(floatColumns):
+            columns[name] = np.array([np.nan if r["values"][i] is None else r["values"][i] for r in rows], dtype=float)
+
+        tempPath = f"{path}.partial"
+        shutil.rmtree(tempPath, ignore_errors=True)
+        os.makedirs(tempPath)
+
+        for name, column in columns.items():
+            np.save(os.path.join(tempPath, f"{name}.npy"), column)
+
+        stored = [r for r in rows if r["structure"] is not None]
+        structures = StructureStore(os.path.join(tempPath, "structures"))
+        structures.add(PackedStructures.fromEncoded([r["id"] for r in stored], [r["structure"] for r in stored]))
+        structures.flush()
+
+        with open(os.path.join(tempPath, "disordered.json"), 'w') as f:
+            json.dump({r["id"]: r["disordered"] for r in rows if r["disordered"] is not None}, f)
+
+        metaData = {
+            "version": snapshotVersion,
+            "createdAt": time.time(),
+            "materials": count,
+            "compositions": len(compositionKeys),
+            "failed": self.failed,
+            **meta
+        }
+
+        with open(os.path.join(tempPath, "meta.json"), 'w') as f:
+            json.dump(metaData, f, indent=4)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tempPath, path)
+
+        with _openSnapshotsLock:
+            _openSnapshots.pop(path, None)
+        closeStructureStore(os.path.join(path, "structures"))
+
+        return metaData
+
+def getMpHits(dataMP):
+    # Data points of an MP lookup that would be used (none for errors,
+    # nothing found or only deprecated entries)
+    if not dataMP or not dataMP[0].get("dataFound"):
+        return []
+    return [d for d in dataMP if not d.get("deprecated")]
+
+def buildSnapshot(formulas, path=None, chunkSize=buildChunkSize, progressCallback=None):
+    # Looks every formula up the same way calculateQsi does (MP in
+    # batches, OQMD for what MP doesn't have) and writes the results
+    # to a snapshot at path. Formulas that failed on temporary API
+    # errors are listed in meta.json under "failed", building again
+    # retries them (the retrieval cache keeps everything else).
+    from src.data.mp.mpRetriever import retrieveMpDataBatch
+    from src.data.oqmd.oqmdRetriever import retrieveOqmdData
+    from src.data.mp import mpCleaner
+    from src.data.oqmd import oqmdCleaner
+    from src.data.requestPolicy import getErrorType, errorTransient
+
+    path = path or snapshotPath
+    checkOutputPath(path)
+
+    writer = SnapshotWriter()
+    done = 0
+
+    keys = dict.fromkeys(getFormulaKey(formula) for formula in formulas)
+    pending = list(keys)
+
+    for i in range(0, len(pending), chunkSize):
+        chunk = pending[i:i + chunkSize]
+        dataByFormula = retrieveMpDataBatch(chunk)
+
+        # The batch normally brings the structures along. The few
+        # compositions without them are fetched together, one request
+        # per chunk instead of one per composition.
+        missing = [d for formula in chunk for d in getMpHits(dataByFormula.get(formula)) if not mpCleaner.hasStructures([d])]
+        fetched = {}
+
+        if missing:
+            try:
+                fetched = {s.label: s for s in mpCleaner.fetchStructures(missing)}
+            except Exception:
+                logError()
+                fetched = None
+
+        for formula in chunk:
+            dataMP = dataByFormula.get(formula)
+
+            try:
+                if getErrorType(dataMP) == errorTransient:
+                    writer.failed.append(formula)
+                elif getMpHits(dataMP):
+                    if mpCleaner.hasStructures(dataMP):
+                        writer.addMp(formula, dataMP, mpCleaner.buildStructures(dataMP))
+                    elif fetched is None:
+                        writer.failed.append(formula)
+                    else:
+                        structures = mpCleaner.buildStructures([d for d in dataMP if d.get("structure") is not None])
+                        structures += [fetched[d.get("mpId")] for d in getMpHits(dataMP) if d.get("mpId") in fetched]
+                        writer.addMp(formula, dataMP, structures)
+                else:
+                    dataOQMD = retrieveOqmdData(formula)
+
+                    if getErrorType(dataOQMD) == errorTransient:
+                        writer.failed.append(formula)
+                    elif dataOQMD[0].get("dataFound"):
+                        writer.addOqmd(formula, dataOQMD, oqmdCleaner.buildStructures(dataOQMD))
+            except Exception:
+                logError()
+                writer.failed.append(formula)
+
+            done += 1
+            if progressCallback:
+                progressCallback(done, len(pending), formula)
+
+    meta = writer.write(path, formulas=len(pending))
+
+    logDebug("Wrote snapshot of %d materials in %d compositions to %s", meta["materials"], meta["compositions"], path)
+    if writer.failed:
+        logDebug("%d formulas could not be retrieved, build the snapshot again to retry them", len(writer.failed))
+
+    return meta
+
+def main():
+    from src.bulkTest.inputReader import readInput
+
+    parser = argparse.ArgumentParser(description="Build or inspect a local snapshot of MP and OQMD data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Look up every formula of a bulk input file and store the results")
+    build.add_argument("input", help="Bulk input file (.json, .jsonl or .csv)")
+    build.add_argument("--output", default=snapshotPath, help="Snapshot directory")
+
+    formulas = commands.add_parser("formulas", help="Write every composition in a snapshot as a bulk input file")
+    formulas.add_argument("snapshot", help="Snapshot directory")
+    formulas.add_argument("output", help="JSON file to write")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        _, items = readInput(args.input)
+        meta = buildSnapshot([formula for formula, _, isValid in items if isValid], args.output)
+        print(f"{meta['materials']} materials in {meta['compositions']} compositions, {len(meta['failed'])} failed")
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(Snapshot(args.snapshot).getFormulas(), f)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import threading
+from collections import OrderedDict
+
+from pymatgen.analysis.structure_matcher import StructureMatcher
+
+from utils.debug import logDebug, logError
+from src.data.structureStore import PackedStructures
+
+# Drop-in replacement for StructureMatcher().group_structures used by
+# both cleaners. Gives exactly the same groups in the same order, but
+# only runs the (expensive) matcher on structures that can actually
+# match each other.
+#
+# group_structures already splits structures by the hash of their
+# composition. With the default matcher settings (no supercells, no
+# subsets) two structures also can't match unless their reduced
+# (primitive + Niggli) cells hold the same number of sites, so that
+# count is used as a second bucket key. Cheaper fingerprints like the
+# space group, volume per atom or lattice parameters are deliberately
+# not used: the matcher rescales volumes and allows length/angle
+# tolerances, so structures that differ in those can still match and
+# bucketing on them would change the groups.
+#
+# The bucketing relies on StructureMatcher internals (_comparator,
+# _process_species, _get_reduced_structure, _primitive_cell). With a
+# pymatgen version that doesn't have them, or changed how they are
+# called, grouping falls back to group_structures itself.
+#
+# Structures can also come as PackedStructures (structureStore.py).
+# Those are only turned into Structures when the matcher has to run,
+# cached groups and lookups with a single structure don't need them.
+
+groupCacheSize = 256
+
+matcher = StructureMatcher()
+
+matcherInternals = ("_comparator", "_process_species", "_get_reduced_structure", "_primitive_cell")
+canBucket = all(hasattr(matcher, name) for name in matcherInternals)
+
+groupCache = OrderedDict()
+groupCacheLock = threading.Lock()
+
+def getCacheKey(formula, structures):
+    labels = tuple(s.label for s in structures)
+
+    # Without unique labels the cached groups couldn't be mapped back
+    # to the structures
+    if formula is None or None in labels or len(set(labels)) != len(labels):
+        return None
+
+    return (formula, labels)
+
+def getBucketKey(reduced):
+    return (matcher._comparator.get_hash(reduced.composition), len(reduced))
+
+def matchBucket(bucket):
+    # Same greedy matching as group_structures: the first unmatched
+    # structure takes every later one that fits onto it
+    groups = []
+    unmatched = list(bucket)
+
+    while unmatched:
+        i, reference = unmatched.pop(0)
+        matches = [i]
+        remaining = []
+
+        for j, other in unmatched:
+            if matcher.fit(reference, other, skip_structure_reduction=True):
+                matches.append(j)
+            else:
+                remaining.append((j, other))
+
+        unmatched = remaining
+        groups.append(matches)
+
+    return groups
+
+def groupStructureIndices(structures):
+    processed = matcher._process_species(structures)
+    reducedStructures = [matcher._get_reduced_structure(s, matcher._primitive_cell, niggli=True) for s in processed]
+
+    buckets = {}
+    for i, reduced in enumerate(reducedStructures):
+        buckets.setdefault(getBucketKey(reduced), []).append((i, reduced))
+
+    groups = []
+    for bucket in buckets.values():
+        groups.extend(matchBucket(bucket))
+
+    # group_structures emits groups ordered by composition hash and
+    # then by the position of their first structure
+    groups.sort(key=lambda group: (getBucketKey(reducedStructures[group[0]])[0], group[0]))
+
+    logDebug("Grouped %d structures in %d buckets into %d groups", len(structures), len(buckets), len(groups))
+
+    return groups
+
+def groupStructureIndicesSafely(structures):
+    global canBucket
+
+    if canBucket:
+        try:
+            return groupStructureIndices(structures)
+        except (AttributeError, TypeError):
+            logError()
+            logDebug("StructureMatcher internals changed, grouping without buckets from now on")
+            canBucket = False
+
+    # group_structures hands back the structures it was given
+    positions = {id(s): i for i, s in enumerate(structures)}
+    return [[positions[id(s)] for s in group] for group in matcher.group_structures(structures)]
+
+def groupStructures(structures, formula=None):
+    # Results are cached per (formula, structure labels) so the same
+    # set of structures is only matched once per process. Groups of
+    # PackedStructures hold its StructureEntries, which carry the
+    # label and build the Structure on demand.
+    if isinstance(structures, PackedStructures):
+        entries = structures.getEntries()
+        buildStructures = structures.toStructures
+    else:
+        entries = list(structures)
+        buildStructures = lambda: entries
+
+    cacheKey = getCacheKey(formula, entries)
+
+    if cacheKey is not None:
+        with groupCacheLock:
+            cached = groupCache.get(cacheKey)
+            if cached is not None:
+                groupCache.move_to_end(cacheKey)
+
+        if cached is not None:
+            return [[entries[i] for i in group] for group in cached]
+
+    if len(entries) <= 1:
+        # Nothing to match, group_structures gives the same
+        groups = [[0]] if entries else []
+    else:
+        groups = groupStructureIndicesSafely(buildStructures())
+
+    if cacheKey is not None:
+        with groupCacheLock:
+            groupCache[cacheKey] = groups
+            while len(groupCache) > groupCacheSize:
+                groupCache.popitem(last=False)
+
+    return [[entries[i] for i in group] for group in groups]
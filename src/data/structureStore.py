@@ -0,0 +1,466 @@
+import os
+import threading
+
+import numpy as np
+
+from src.data.formulas import elementsByNumber
+
+# Structures in packed form: the lattices, fractional coordinates and
+# atomic numbers of a set of ordered structures as flat NumPy arrays
+# (a 3x3 lattice per structure, structure i owns the sites
+# siteOffsets[i]:siteOffsets[i + 1]).
+#
+# The cleaners used to get their structures as pymatgen Structures
+# built from MP's structure dicts or OQMD's OPTIMADE attributes, and
+# bulk runs pickled those nested dicts over to the matching processes.
+# PackedStructures is read straight from the dicts without pymatgen,
+# pickles as a handful of arrays, and only builds a Structure when
+# duplicate grouping actually has to match it (not for cached groups
+# or a lookup with a single structure, see structureGrouping.py).
+#
+# StructureStore keeps packed structures of many lookups in memory
+# mapped files keyed by material id, the snapshot (snapshot.py) keeps
+# its structures in one. Bulk runs append every lookup to a
+# ScratchStore instead, which keeps no ids and deletes its files once
+# the workers are done with them, and only send a StructureRef to the
+# worker, which maps its part of the files without copying it.
+#
+# Imported as src.data.structureStore everywhere so there is one
+# PackedStructures class per process.
+
+atomicNumbers = {el: z for z, el in enumerate(elementsByNumber, 1)}
+
+# Raw files of a store, one record per structure (lattices) or site
+storeArrays = {
+    "lattices": (np.float64, (3, 3)),
+    "fracCoords": (np.float64, (3,)),
+    "atomicNumbers": (np.uint8, ()),
+}
+
+# A ScratchStore starts new files once the current ones hold this
+# many bytes
+scratchSegmentSize = 64 * 1024 * 1024
+
+def getStoreFilePath(path, name, segment=None):
+    if segment is None:
+        return os.path.join(path, f"{name}.bin")
+    return os.path.join(path, f"{name}.{segment}.bin")
+
+def getRecordSize(name):
+    dtype, shape = storeArrays[name]
+    return np.dtype(dtype).itemsize * int(np.prod(shape))
+
+def mapRecords(filePath, name, start, end):
+    # Memory map of records start:end of a raw file
+    dtype, shape = storeArrays[name]
+
+    if end <= start:
+        return np.zeros((0, *shape), dtype=dtype)
+
+    return np.memmap(filePath, dtype=dtype, mode='r', offset=start * getRecordSize(name), shape=(end - start, *shape))
+
+def encodeStructure(structure):
+    # Lattice, fractional coordinates and atomic numbers of an
+    # ordered structure, None for anything that can't be stored that
+    # way (no structure, partial occupancies)
+    if structure is None or not structure.is_ordered:
+        return None
+
+    return (np.asarray(structure.lattice.matrix, dtype=float),
+            np.asarray(structure.frac_coords, dtype=float),
+            np.asarray(structure.atomic_numbers, dtype=np.uint8))
+
+def encodeMpStructure(structureDict):
+    # Same from a Structure.as_dict(), None for sites with more than
+    # one species, partial occupancies or oxidation states (matching
+    # compares those, so they have to go through pymatgen)
+    numbers = []
+
+    for site in structureDict["sites"]:
+        species = site["species"]
+
+        if len(species) != 1 or species[0].get("occu", 1) != 1 or species[0].get("oxidation_state"):
+            return None
+        if species[0].get("element") not in atomicNumbers:
+            return None
+
+        numbers.append(atomicNumbers[species[0]["element"]])
+
+    lattice = np.array(structureDict["lattice"]["matrix"], dtype=float).reshape(3, 3)
+    coords = np.array([site["abc"] for site in structureDict["sites"]], dtype=float).reshape(-1, 3)
+
+    return lattice, coords, np.array(numbers, dtype=np.uint8)
+
+def encodeOptimadeStructure(attributes):
+    # Same from OPTIMADE attributes. The cartesian positions are
+    # converted the way pymatgen does it (positions times the inverse
+    # lattice), so the coordinates are exactly the ones Structure(...,
+    # coords_are_cartesian=True) would end up with.
+    species = attributes["species_at_sites"]
+
+    if any(s not in atomicNumbers for s in species):
+        return None
+
+    lattice = np.array(attributes["lattice_vectors"], dtype=float).reshape(3, 3)
+    cartesian = np.array(attributes["cartesian_site_positions"], dtype=float).reshape(-1, 3)
+
+    return lattice, np.dot(cartesian, np.linalg.inv(lattice)), np.array([atomicNumbers[s] for s in species], dtype=np.uint8)
+
+class StructureEntry:
+    # One structure of a PackedStructures as duplicate grouping hands
+    # it out. Candidate selection only reads the label, the Structure
+    # is built on first access.
+    __slots__ = ("structures", "index", "label")
+
+    def __init__(self, structures, index):
+        self.structures = structures
+        self.index = index
+        self.label = structures.labels[index]
+
+    @property
+    def structure(self):
+        return self.structures.getStructure(self.index)
+
+class PackedStructures:
+    def __init__(self, labels, lattices, siteOffsets, fracCoords, atomicNumbers):
+        self.labels = list(labels)
+        self.lattices = lattices
+        self.siteOffsets = siteOffsets
+        self.fracCoords = fracCoords
+        self.atomicNumbers = atomicNumbers
+        self.built = {}
+
+    @classmethod
+    def fromEncoded(cls, labels, encoded):
+        # From (lattice, fracCoords, atomicNumbers) tuples, None if any
+        # of them couldn't be encoded
+        if any(e is None for e in encoded):
+            return None
+
+        siteOffsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e[2]) for e in encoded], out=siteOffsets[1:])
+
+        if not encoded:
+            return cls(labels, np.zeros((0, 3, 3)), siteOffsets, np.zeros((0, 3)), np.zeros(0, dtype=np.uint8))
+
+        return cls(labels,
+                   np.array([e[0] for e in encoded], dtype=float),
+                   siteOffsets,
+                   np.concatenate([e[1] for e in encoded]).astype(float, copy=False),
+                   np.concatenate([e[2] for e in encoded]).astype(np.uint8, copy=False))
+
+    @classmethod
+    def fromStructures(cls, structures):
+        structures = list(structures)
+        return cls.fromEncoded([s.label for s in structures], [encodeStructure(s) for s in structures])
+
+    @classmethod
+    def fromMpData(cls, data):
+        # Structures of MP data points (skipping deprecated ones like
+        # mpCleaner.buildStructures), labelled with their ids
+        data = [d for d in data if not d.get("deprecated")]
+
+        try:
+            encoded = [encodeMpStructure(d["structure"]) for d in data]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        return cls.fromEncoded([d.get("mpId") for d in data], encoded)
+
+    @classmethod
+    def fromOqmdData(cls, data):
+        # Structures of OQMD data points from their OPTIMADE structure
+        # data, labelled with their ids like oqmdCleaner.buildStructures
+        try:
+            encoded = [encodeOptimadeStructure(d["structureData"]["data"][0]["attributes"]) for d in data]
+        except (KeyError, TypeError, ValueError, IndexError, np.linalg.LinAlgError):
+            return None
+
+        return cls.fromEncoded([d.get("oqmdId") for d in data], encoded)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        # Built Structures stay behind, the receiving process builds
+        # the ones it needs itself
+        state = dict(self.__dict__)
+        state["built"] = {}
+        return state
+
+    def getSites(self, i):
+        start, end = int(self.siteOffsets[i]), int(self.siteOffsets[i + 1])
+        return self.fracCoords[start:end], self.atomicNumbers[start:end]
+
+    def getStructure(self, i):
+        from pymatgen.core import Structure
+
+        if i not in self.built:
+            coords, numbers = self.getSites(i)
+            structure = Structure(np.array(self.lattices[i]), [elementsByNumber[z - 1] for z in numbers.tolist()], np.array(coords))
+            structure.label = self.labels[i]
+            self.built[i] = structure
+
+        return self.built[i]
+
+    def toStructures(self):
+        return [self.getStructure(i) for i in range(len(self))]
+
+    def getEntries(self):
+        return [StructureEntry(self, i) for i in range(len(self))]
+
+class StructureRef:
+    # Picklable pointer to structures appended to a StructureStore or
+    # one segment of a ScratchStore, what bulk runs send to the
+    # matching processes
+    __slots__ = ("path", "labels", "start", "siteOffsets", "segment")
+
+    def __init__(self, path, labels, start, siteOffsets, segment=None):
+        self.path = path
+        self.labels = labels
+        self.start = start
+        self.siteOffsets = siteOffsets
+        self.segment = segment
+
+    def __getstate__(self):
+        return (self.path, self.labels, self.start, self.siteOffsets, self.segment)
+
+    def __setstate__(self, state):
+        self.path, self.labels, self.start, self.siteOffsets, self.segment = state
+
+    def load(self):
+        # Maps only the records of these structures, the maps go away
+        # with the PackedStructures
+        def getArray(name, start, end):
+            return mapRecords(getStoreFilePath(self.path, name, self.segment), name, start, end)
+
+        siteStart, siteEnd = self.siteOffsets[0], self.siteOffsets[-1]
+
+        return PackedStructures(self.labels,
+                                getArray("lattices", self.start, self.start + len(self.labels)),
+                                np.asarray(self.siteOffsets, dtype=np.int64) - siteStart,
+                                getArray("fracCoords", siteStart, siteEnd),
+                                getArray("atomicNumbers", siteStart, siteEnd))
+
+def appendArrays(packed, getFilePath):
+    # Appends the arrays of packed structures to the raw files,
+    # returns the number of bytes written
+    written = 0
+
+    for name, array in (("lattices", packed.lattices), ("fracCoords", packed.fracCoords), ("atomicNumbers", packed.atomicNumbers)):
+        data = np.ascontiguousarray(array, dtype=storeArrays[name][0]).tobytes()
+
+        with open(getFilePath(name), 'ab') as f:
+            f.write(data)
+
+        written += len(data)
+
+    return written
+
+class StructureStore:
+    # A directory with one raw file per array of storeArrays, written
+    # by appending, plus an id index (ids.npy for every stored
+    # structure, siteOffsets.npy, and sortedIds.npy / sortedRows.npy
+    # to find ids) written by flush. Readers map the raw files, any
+    # number of processes can read while one appends.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.maps = {}
+
+        os.makedirs(path, exist_ok=True)
+
+        for name in storeArrays:
+            if not os.path.exists(self.getFilePath(name)):
+                open(self.getFilePath(name), 'ab').close()
+
+        self.ids = self.loadIndex("ids", str).tolist()
+        self.siteOffsets = self.loadIndex("siteOffsets", np.int64).tolist() or [0]
+        self.sortedIds = None
+
+    def getFilePath(self, name):
+        return getStoreFilePath(self.path, name)
+
+    def loadIndex(self, name, dtype):
+        indexPath = os.path.join(self.path, f"{name}.npy")
+
+        if not os.path.exists(indexPath):
+            return np.zeros(0, dtype=dtype)
+
+        return np.load(indexPath)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, packed, ids=None):
+        # Appends packed structures under ids (their labels by
+        # default), returns a StructureRef to them
+        ids = [str(i) for i in (packed.labels if ids is None else ids)]
+
+        with self.lock:
+            start = len(self.ids)
+            siteStart = self.siteOffsets[-1]
+
+            appendArrays(packed, self.getFilePath)
+
+            self.ids.extend(ids)
+            self.siteOffsets.extend((siteStart + np.asarray(packed.siteOffsets[1:], dtype=np.int64)).tolist())
+            self.sortedIds = None
+
+        siteOffsets = [siteStart + int(offset) for offset in packed.siteOffsets]
+        return StructureRef(self.path, list(packed.labels), start, siteOffsets)
+
+    def flush(self):
+        # Writes the id index so the store can be opened again later
+        with self.lock:
+            ids = np.array(self.ids, dtype=str)
+            order = np.argsort(ids, kind="stable")
+
+            np.save(os.path.join(self.path, "ids.npy"), ids)
+            np.save(os.path.join(self.path, "siteOffsets.npy"), np.array(self.siteOffsets, dtype=np.int64))
+            np.save(os.path.join(self.path, "sortedIds.npy"), ids[order])
+            np.save(os.path.join(self.path, "sortedRows.npy"), order.astype(np.int64))
+
+    def getArray(self, name, end):
+        # Memory map of a raw file holding at least end records, mapped
+        # again when the file has grown past the current map
+        dtype, shape = storeArrays[name]
+
+        if end == 0:
+            return np.zeros((0, *shape), dtype=dtype)
+
+        mapped = self.maps.get(name)
+
+        if mapped is None or len(mapped) < end:
+            count = os.path.getsize(self.getFilePath(name)) // getRecordSize(name)
+            mapped = np.memmap(self.getFilePath(name), dtype=dtype, mode='r', shape=(count, *shape))
+            self.maps[name] = mapped
+
+        return mapped
+
+    def getSlice(self, labels, start, siteOffsets):
+        # Consecutive structures as views into the mapped files
+        siteStart, siteEnd = siteOffsets[0], siteOffsets[-1]
+        end = start + len(labels)
+
+        return PackedStructures(labels,
+                                self.getArray("lattices", end)[start:end],
+                                np.asarray(siteOffsets, dtype=np.int64) - siteStart,
+                                self.getArray("fracCoords", siteEnd)[siteStart:siteEnd],
+                                self.getArray("atomicNumbers", siteEnd)[siteStart:siteEnd])
+
+    def findRows(self, ids):
+        # Rows of the given ids, -1 for ids that aren't stored
+        with self.lock:
+            if self.sortedIds is None:
+                idArray = np.array(self.ids, dtype=str)
+                order = np.argsort(idArray, kind="stable")
+                self.sortedIds, self.sortedRows = idArray[order], order
+
+        ids = np.array([str(i) for i in ids], dtype=str)
+        if len(self.sortedIds) == 0 or len(ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.sortedIds, ids), len(self.sortedIds) - 1)
+        return np.where(self.sortedIds[positions] == ids, self.sortedRows[positions], -1)
+
+    def get(self, ids, labels=None):
+        # Structures of the given ids, labelled with labels (the ids by
+        # default). Ids that aren't stored are left out. Consecutive
+        # rows, like the entries of one composition in a snapshot,
+        # come back as views into the mapped files.
+        labels = list(ids) if labels is None else list(labels)
+        rows = self.findRows(ids)
+        found = rows >= 0
+        rows = rows[found]
+        labels = [label for label, f in zip(labels, found) if f]
+
+        if len(rows) == 0 or np.all(np.diff(rows) == 1):
+            start = int(rows[0]) if len(rows) else 0
+            return self.getSlice(labels, start, self.siteOffsets[start:start + len(rows) + 1])
+
+        lattices = self.getArray("lattices", len(self))[rows]
+        siteOffsets = np.asarray(self.siteOffsets, dtype=np.int64)
+        counts = siteOffsets[rows + 1] - siteOffsets[rows]
+        sites = np.concatenate([np.arange(siteOffsets[r], siteOffsets[r + 1]) for r in rows])
+        packedOffsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=packedOffsets[1:])
+
+        return PackedStructures(labels, lattices, packedOffsets,
+                                self.getArray("fracCoords", self.siteOffsets[-1])[sites],
+                                self.getArray("atomicNumbers", self.siteOffsets[-1])[sites])
+
+class ScratchStore:
+    # Structures on their way to the matching processes of a bulk run.
+    # Nothing is looked up by id, so only the structure and site
+    # counts of the segment being written are kept. Appends go to
+    # numbered segments of raw files, a new one is started once the
+    # current one holds segmentSize bytes, and the files of a segment
+    # are deleted as soon as every StructureRef into it is released.
+    def __init__(self, path, segmentSize=scratchSegmentSize):
+        self.path = path
+        self.segmentSize = segmentSize
+        self.lock = threading.Lock()
+
+        self.segment = 0
+        self.segmentBytes = 0
+        self.count = 0
+        self.siteCount = 0
+
+        # Refs handed out and not released yet, per segment
+        self.liveRefs = {}
+
+        os.makedirs(path, exist_ok=True)
+
+    def getFilePath(self, name, segment):
+        return getStoreFilePath(self.path, name, segment)
+
+    def add(self, packed):
+        with self.lock:
+            if self.segmentBytes >= self.segmentSize:
+                finished = self.segment
+                self.segment += 1
+                self.segmentBytes = self.count = self.siteCount = 0
+                self.removeIfUnused(finished)
+
+            segment, start, siteStart = self.segment, self.count, self.siteCount
+
+            self.segmentBytes += appendArrays(packed, lambda name: self.getFilePath(name, segment))
+            self.count += len(packed)
+            self.siteCount += int(packed.siteOffsets[-1])
+            self.liveRefs[segment] = self.liveRefs.get(segment, 0) + 1
+
+        siteOffsets = [siteStart + int(offset) for offset in packed.siteOffsets]
+        return StructureRef(self.path, list(packed.labels), start, siteOffsets, segment)
+
+    def release(self, ref):
+        # Called once a worker is done with ref
+        with self.lock:
+            self.liveRefs[ref.segment] -= 1
+            self.removeIfUnused(ref.segment)
+
+    def removeIfUnused(self, segment):
+        # The segment being written stays until it is full
+        if segment == self.segment or self.liveRefs.get(segment, 0) > 0:
+            return
+
+        self.liveRefs.pop(segment, None)
+
+        for name in storeArrays:
+            try:
+                os.remove(self.getFilePath(name, segment))
+            except FileNotFoundError:
+                pass
+
+_openStores = {}
+_openStoresLock = threading.Lock()
+
+def openStructureStore(path):
+    with _openStoresLock:
+        if path not in _openStores:
+            _openStores[path] = StructureStore(path)
+        return _openStores[path]
+
+def closeStructureStore(path):
+    with _openStoresLock:
+        _openStores.pop(path, None)
@@ -1,3 +1,5 @@
+import importlib
+
 from utils.debug import logDebug
 from .subscores import getBandGapSubscore
 from .subscores import getStabilitySubscore
@@ -5,6 +7,19 @@ from .subscores import getFormationEnergySubscore
 from .subscores import getMagneticNoiseSubscore
 from .subscores import getSymmetrySubscore
 from .subscores import getTotalIndex
-from .calculator import calculateQsi
+from .subscores import getQsiUpperBound
+
+# Imported on first use so scoring doesn't have to load the
+# database clients
+lazyNames = {
+    "getTotalIndices": ".batchScores",
+    "calculateQsi": ".calculator",
+    "calculateQsiAsync": ".calculator",
+}
+
+def __getattr__(name):
+    if name in lazyNames:
+        return getattr(importlib.import_module(lazyNames[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-logDebug("Successfully imported math module")
\ No newline at end of file
+logDebug("Successfully imported math module")
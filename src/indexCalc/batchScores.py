@@ -0,0 +1,73 @@
+import numpy as np
+
+from src.indexCalc.subscores import weightsDefault, getFormulaNuclearSpin
+
+# Same order as the subScores list returned by getTotalIndex
+subscoreNames = ["stability", "bandGap", "formationEnergy", "magneticNoise", "symmetry"]
+
+# Array versions of the functions in subscores.py. Each takes one
+# column of values for N materials and returns N subscores, using
+# the same default parameters as the scalar versions.
+
+def getMagneticNoiseSubscores(avgNuclearSpins, penaltyFactor=1):
+    return np.exp(-penaltyFactor * np.asarray(avgNuclearSpins, dtype=float))
+
+def getStabilitySubscores(stabilities, decayConstant=50):
+    return np.exp(-np.asarray(stabilities, dtype=float) / decayConstant)
+
+def getSymmetrySubscores(symmetries, curvature=0.5):
+    return (np.asarray(symmetries, dtype=float) / 230) ** curvature
+
+def getBandGapSubscores(bandGaps, idealGapVisible=2.4, idealGapUV=4.7, visibleTolerance=0.6, uvTolerance=1.5, uvCutoff=3.1):
+    bandGaps = np.asarray(bandGaps, dtype=float)
+    isUv = bandGaps > uvCutoff
+
+    idealGap = np.where(isUv, idealGapUV, idealGapVisible)
+    tolerance = np.where(isUv, uvTolerance, visibleTolerance)
+
+    return np.exp(-1 * ((bandGaps - idealGap) ** 2) / (2 * (tolerance ** 2)))
+
+def getFormationEnergySubscores(formationEnergies, cutoff=0, steepness=2):
+    return 1 / (1 + np.exp(steepness * (np.asarray(formationEnergies, dtype=float) - cutoff)))
+
+def getFormulaNuclearSpins(formulas):
+    return np.array([getFormulaNuclearSpin(formula) for formula in formulas], dtype=float)
+
+def getSubscoreMatrix(bandGaps, hullDistances, formationEnergies, symmetries, avgNuclearSpins):
+    # N x 5 matrix, columns ordered like subscoreNames
+    return np.column_stack([
+        getStabilitySubscores(hullDistances),
+        getBandGapSubscores(bandGaps),
+        getFormationEnergySubscores(formationEnergies),
+        getMagneticNoiseSubscores(avgNuclearSpins),
+        getSymmetrySubscores(symmetries),
+    ])
+
+def getIndicesFromSubscores(subScores, weights=weightsDefault):
+    subScores = np.asarray(subScores, dtype=float)
+    index = np.ones(subScores.shape[0])
+
+    # Multiplied in the same order as getTotalIndex
+    for name in ["bandGap", "stability", "formationEnergy", "magneticNoise", "symmetry"]:
+        index *= subScores[:, subscoreNames.index(name)] ** weights.get(name)
+
+    return index
+
+def getTotalIndices(bandGaps, hullDistances, formationEnergies, symmetries, avgNuclearSpins, weights=weightsDefault):
+    # Vectorized getTotalIndex for N materials at once. Returns the
+    # N indices and the N x 5 subscore matrix.
+    subScores = getSubscoreMatrix(bandGaps, hullDistances, formationEnergies, symmetries, avgNuclearSpins)
+
+    return {'index': getIndicesFromSubscores(subScores, weights), 'subScores': subScores}
+
+def weightsToVector(weights):
+    return np.array([weights.get(name) for name in subscoreNames], dtype=float)
+
+def getIndexSweep(subScores, weightVectors):
+    # Scores every material under every weight vector at once.
+    # weightVectors is M x 5 (columns ordered like subscoreNames),
+    # the result is M x N. Zero subscores are clipped to the
+    # smallest float so that a zero weight still gives 0 ** 0 = 1.
+    logSubScores = np.log(np.maximum(np.asarray(subScores, dtype=float), np.finfo(float).tiny))
+
+    return np.exp(np.atleast_2d(weightVectors) @ logSubScores.T)
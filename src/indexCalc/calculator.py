@@ -1,29 +1,288 @@
 import sys
 import os
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from src.data.mp import mpRetriever as mp
 from src.data.oqmd import oqmdRetriever as oqmd
-from src.data.mp import mpCleaner
-from src.data.oqmd import oqmdCleaner
 from src.indexCalc import subscores as ic
 from utils.debug import logDebug
+from utils.profiling import span, profiled
 from src.data.matDataObj import matDataObj
+from src.data.requestPolicy import TransientRetrievalError, getErrorType, errorTransient
+from src.data.asyncPool import runLimited
+from src.data.formulas import getFormulaKey
+from src.data.retrievalCache import memoryCacheSize
+from src.data import snapshot
+from src.data.structureStore import PackedStructures, StructureRef
 
-def calculateQsi(formula, forceOqmd=False, weights=ic.weightsDefault):
-    logDebug(f"Calculating QSI for {formula}...")
-    dataMP = mp.retrieveMpData(formula) if not forceOqmd else [{"dataFound": False}]
-    finalCandidate = None
-
-    if dataMP[0].get("dataFound") and not forceOqmd:
-        finalCandidate = mpCleaner.filter(dataMP)
-    else:
-        dataOQMD = oqmd.retrieveOqmdData(formula)
-        finalCandidate = oqmdCleaner.filter(dataOQMD)
-    
+# With speculative fetching OQMD is queried at the same time as MP
+# instead of only after MP came back empty, which saves one of the
+# three round trips (MP, OQMD phases, OQMD structures) for materials
+# that are only in OQMD, about a third of the wait in
+# benchmarks/fallbackLatency.py. It costs an extra OQMD
+# request for every material MP does have (the answer is kept in the
+# retrieval caches), so it is off by default. Only applies when MP is
+# queried per formula; bulk runs already get MP in batches.
+speculativeFetch = os.getenv("QSI_SPECULATIVE_FETCH", "").lower() in ("1", "true", "yes")
+speculativeWorkers = int(os.getenv("QSI_SPECULATIVE_WORKERS", 4))
+
+_speculativePool = None
+_speculativePoolLock = threading.Lock()
+
+def setSpeculativeFetch(status: bool):
+    global speculativeFetch
+    speculativeFetch = status
+
+def getSpeculativePool():
+    global _speculativePool
+
+    with _speculativePoolLock:
+        if _speculativePool is None:
+            _speculativePool = ThreadPoolExecutor(max_workers=speculativeWorkers, thread_name_prefix="oqmdPrefetch")
+        return _speculativePool
+
+def raiseIfTransient(data):
+    if getErrorType(data) == errorTransient:
+        raise TransientRetrievalError(data[0].get("message"))
+
+def gatherCandidates(formula, forceOqmd=False, dataMP=None, speculative=None):
+    # Network bound part of the calculation. Everything that
+    # has to wait on MP or OQMD happens here so it can run in
+    # a thread pool during bulk runs. dataMP can be passed in
+    # when it was already fetched as part of a batch.
+    #
+    # Raises TransientRetrievalError when a lookup failed for reasons
+    # unrelated to the formula, so a rate limit or timeout on MP
+    # doesn't fall through to OQMD or count as not found.
+    from src.data.mp import mpCleaner
+
+    snapshotPath = snapshot.getSnapshotPath()
+    if snapshotPath is not None:
+        return gatherFromSnapshot(snapshotPath, formula, forceOqmd)
+
+    if speculative is None:
+        speculative = speculativeFetch
+
+    oqmdFuture = None
+
+    with span("retrieval"):
+        if forceOqmd:
+            dataMP = [{"dataFound": False}]
+        elif dataMP is None:
+            if speculative:
+                oqmdFuture = getSpeculativePool().submit(oqmd.retrieveOqmdData, formula)
+            dataMP = mp.retrieveMpData(formula)
+
+        try:
+            raiseIfTransient(dataMP)
+        except TransientRetrievalError:
+            # No OQMD lookups during an MP outage or rate limit
+            if oqmdFuture is not None:
+                oqmdFuture.cancel()
+            raise
+
+        if dataMP[0].get("dataFound") and not forceOqmd:
+            if oqmdFuture is not None:
+                # Only stops a lookup that hasn't started yet, one that
+                # is already running finishes into the caches
+                oqmdFuture.cancel()
+
+            # Structures that came with the search results are built
+            # later in the CPU stage, only missing ones are fetched here
+            structures = None if mpCleaner.hasStructures(dataMP) else mpCleaner.fetchStructures(dataMP)
+            return {'source': "mp", 'data': dataMP, 'structures': structures}
+
+        dataOQMD = oqmdFuture.result() if oqmdFuture is not None else oqmd.retrieveOqmdData(formula)
+
+        raiseIfTransient(dataOQMD)
+
+        return {'source': "oqmd", 'data': dataOQMD, 'structures': None}
+
+def gatherFromSnapshot(snapshotPath, formula, forceOqmd=False):
+    # Offline version of gatherCandidates, reads the data from the
+    # local snapshot (see snapshot.py). Structures are only built in
+    # selectFinalCandidate, which gets the path along so a worker
+    # process can open the snapshot itself.
+    store = snapshot.openSnapshot(snapshotPath)
+
+    with span("retrieval"):
+        dataMP = [{"dataFound": False}] if forceOqmd else store.getData(formula, "mp")
+
+        if dataMP[0].get("dataFound"):
+            return {'source': "mp", 'data': dataMP, 'structures': None, 'snapshot': snapshotPath}
+
+        return {'source': "oqmd", 'data': store.getData(formula, "oqmd"), 'structures': None, 'snapshot': snapshotPath}
+
+def hasFoundData(data):
+    return isinstance(data, list) and len(data) > 0 and isinstance(data[0], dict) and bool(data[0].get("dataFound"))
+
+def packStructures(gathered, store=None):
+    # Replaces the structures of gathered data (MP structure dicts,
+    # fetched Structures or OQMD's OPTIMADE attributes) by
+    # PackedStructures and drops the dicts from the data points, so
+    # handing it to a process pickles a few arrays instead of nested
+    # dicts. With a store (a ScratchStore in bulk runs) the arrays are
+    # appended to it and only a StructureRef is sent along. Data that
+    # can't be packed (disordered structures, or anything that isn't a
+    # list of found data points) is returned as it is.
+    if gathered.get('snapshot') is not None or 'packed' in gathered or not hasFoundData(gathered['data']):
+        return gathered
+
+    with span("structurePacking"):
+        if gathered['source'] == "mp":
+            dropped = "structure"
+            if gathered['structures'] is not None:
+                packed = PackedStructures.fromStructures(gathered['structures'])
+            else:
+                packed = PackedStructures.fromMpData(gathered['data'])
+        else:
+            dropped = "structureData"
+            packed = PackedStructures.fromOqmdData(gathered['data'])
+
+        if packed is None:
+            return gathered
+
+        if store is not None:
+            packed = store.add(packed)
+
+    data = [{key: value for key, value in d.items() if key != dropped} for d in gathered['data']]
+    return {**gathered, 'data': data, 'structures': None, 'packed': packed}
+
+def selectFinalCandidate(gathered):
+    # CPU bound part of the calculation (structure building and
+    # duplicate grouping). Only takes picklable input so it can
+    # be sent to a process pool. The cleaners (and with them
+    # pymatgen's structure matching) are only imported here.
+    from src.data.mp import mpCleaner
+    from src.data.oqmd import oqmdCleaner
+
+    cleaner = mpCleaner if gathered['source'] == "mp" else oqmdCleaner
+
+    if gathered.get('snapshot') is not None and gathered['data'][0].get("dataFound"):
+        structures = snapshot.openSnapshot(gathered['snapshot']).getStructures(gathered['data'])
+
+        # Rows that were stored without a structure can't be grouped
+        if len(structures) == 0:
+            return matDataObj.materialNotFound()
+
+        return cleaner.selectCandidate(gathered['data'], structures)
+
+    gathered = packStructures(gathered)
+    packed = gathered.get('packed')
+
+    if packed is not None:
+        # Structures are only built if grouping has to match them
+        if isinstance(packed, StructureRef):
+            packed = packed.load()
+
+        return cleaner.selectCandidate(gathered['data'], packed)
+
+    if gathered['source'] == "mp":
+        logDebug("Filtering...")
+        structures = gathered['structures']
+        if structures is None:
+            with span("structureBuilding"):
+                structures = mpCleaner.buildStructures(gathered['data'])
+
+        return mpCleaner.selectCandidate(gathered['data'], structures)
+
+    return oqmdCleaner.filter(gathered['data'])
+
+def scoreCandidate(finalCandidate, weights=ic.weightsDefault):
     if finalCandidate.formula is None:
-        return {'index': None, 'subScores': None, 'error': "No valid material candidate found in MP or OQMD databases."}
-    
+        return {'index': None, 'subScores': None, 'candidate': None, 'error': "No valid material candidate found in MP or OQMD databases."}
+
     logDebug(finalCandidate)
 
-    result = ic.getTotalIndex(finalCandidate, weights)
-    return {'index': result['index'], 'subScores': result['subScores'], 'error': None}
+    with span("scoring"):
+        result = ic.getTotalIndex(finalCandidate, weights)
+    return {'index': result['index'], 'subScores': result['subScores'], 'candidate': finalCandidate.toDict(), 'error': None}
+
+def transientErrorResult(error):
+    return {'index': None, 'subScores': None, 'candidate': None, 'error': str(error), 'errorType': errorTransient}
+
+@functools.lru_cache(maxsize=memoryCacheSize)
+def getFinalCandidate(formula, forceOqmd=False, snapshotPath=None):
+    # The selected candidate doesn't depend on the weights, so it
+    # is kept around and changing the weights only rescores it. Only
+    # the last memoryCacheSize lookups are kept, like the retrievers'
+    # memory caches, so long sessions don't keep growing.
+    # snapshotPath is only part of the key, so switching between the
+    # live databases and a snapshot doesn't reuse the other's answers.
+    return selectFinalCandidate(gatherCandidates(formula, forceOqmd))
+
+def calculateQsi(formula, forceOqmd=False, weights=ic.weightsDefault):
+    logDebug("Calculating QSI for %s...", formula)
+
+    with profiled("calculateQsi"), span("calculateQsi"):
+        try:
+            # Equivalent spellings share the cached candidate
+            finalCandidate = getFinalCandidate(getFormulaKey(formula), forceOqmd, snapshot.getSnapshotPath())
+        except TransientRetrievalError as e:
+            # Not cached, the next call tries again
+            return transientErrorResult(e)
+
+        return scoreCandidate(finalCandidate, weights)
+
+async def gatherCandidatesAsync(formula, forceOqmd=False, dataMP=None, speculative=None):
+    # Same as gatherCandidates with the lookups awaited instead of
+    # blocking, so many formulas can be gathered on one event loop
+    import asyncio
+    from src.data.mp import mpCleaner
+
+    snapshotPath = snapshot.getSnapshotPath()
+    if snapshotPath is not None:
+        # Local reads, nothing to await
+        return gatherFromSnapshot(snapshotPath, formula, forceOqmd)
+
+    if speculative is None:
+        speculative = speculativeFetch
+
+    oqmdTask = None
+
+    with span("retrieval"):
+        if forceOqmd:
+            dataMP = [{"dataFound": False}]
+        elif dataMP is None:
+            if speculative:
+                oqmdTask = asyncio.ensure_future(oqmd.retrieveOqmdDataAsync(formula))
+            dataMP = await mp.retrieveMpDataAsync(formula)
+
+        try:
+            raiseIfTransient(dataMP)
+        except TransientRetrievalError:
+            if oqmdTask is not None:
+                oqmdTask.cancel()
+            raise
+
+        if dataMP[0].get("dataFound") and not forceOqmd:
+            if oqmdTask is not None:
+                oqmdTask.cancel()
+
+            structures = None
+            if not mpCleaner.hasStructures(dataMP):
+                structures = await runLimited("mp", mpCleaner.fetchStructures, dataMP)
+
+            return {'source': "mp", 'data': dataMP, 'structures': structures}
+
+        dataOQMD = await (oqmdTask if oqmdTask is not None else oqmd.retrieveOqmdDataAsync(formula))
+        raiseIfTransient(dataOQMD)
+
+        return {'source': "oqmd", 'data': dataOQMD, 'structures': None}
+
+async def calculateQsiAsync(formula, forceOqmd=False, weights=ic.weightsDefault, speculative=None):
+    # Awaitable calculateQsi. The structure matching runs on the
+    # shared thread pool too (bounded by QSI_ASYNC_CPU_CONCURRENCY) so
+    # the event loop stays responsive.
+    logDebug("Calculating QSI for %s...", formula)
+
+    with span("calculateQsi"):
+        try:
+            gathered = await gatherCandidatesAsync(formula, forceOqmd, speculative=speculative)
+        except TransientRetrievalError as e:
+            return transientErrorResult(e)
+
+        finalCandidate = await runLimited("cpu", selectFinalCandidate, gathered)
+        return scoreCandidate(finalCandidate, weights)
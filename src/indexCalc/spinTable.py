@@ -0,0 +1,91 @@
+import os
+import json
+import functools
+from fractions import Fraction
+
+# Abundance weighted nuclear spin of every element, computed once
+# from mendeleev and shipped with the package so that scoring never
+# has to hit mendeleev's database. Regenerate it with:
+#
+#     python -m src.indexCalc.spinTable
+spinTablePath = os.path.join(os.path.dirname(__file__), "nuclearSpins.json")
+spinTableVersion = 1
+
+def parseSpin(spin):
+    # Newer mendeleev releases give spins as strings like "3/2"
+    # (sometimes with a parity sign or brackets) instead of floats
+    if spin is None:
+        return 0
+
+    if isinstance(spin, str):
+        try:
+            return float(Fraction(spin.strip("()+- ")))
+        except (ValueError, ZeroDivisionError):
+            return 0
+
+    return spin
+
+def computeAverageNuclearSpin(el):
+    import mendeleev as md
+
+    element = md.element(el)
+    isotopes = [(parseSpin(iso.spin), iso.abundance if iso.abundance is not None else 0) for iso in element.isotopes]
+
+    # Abundances are fractions in older mendeleev releases and
+    # percentages in newer ones, the score expects fractions
+    totalAbundance = sum(abundance for _, abundance in isotopes)
+    scale = 100 if totalAbundance > 1.5 else 1
+
+    avgNuclearSpin = 0
+
+    for spin, abundance in isotopes:
+        avgNuclearSpin += spin * abundance / scale
+
+    return avgNuclearSpin
+
+@functools.cache
+def loadSpinTable(path=spinTablePath):
+    with open(path, 'r') as f:
+        table = json.load(f)
+
+    if table.get("version") != spinTableVersion:
+        raise ValueError(f"Nuclear spin table at {path} is version {table.get('version')}, expected {spinTableVersion}. Regenerate it with 'python -m src.indexCalc.spinTable'.")
+
+    return table["spins"]
+
+def getAverageNuclearSpin(el):
+    spins = loadSpinTable()
+
+    if el in spins:
+        return spins[el]
+
+    # Only reached for symbols that aren't in the table, which
+    # means the table is out of date with mendeleev
+    return computeAverageNuclearSpin(el)
+
+def regenerateSpinTable(path=spinTablePath):
+    import mendeleev as md
+
+    spins = {}
+
+    for atomicNumber in range(1, 119):
+        symbol = md.element(atomicNumber).symbol
+        spins[symbol] = computeAverageNuclearSpin(symbol)
+
+    table = {
+        "version": spinTableVersion,
+        "source": f"mendeleev {md.__version__}",
+        "spins": spins
+    }
+
+    with open(path, 'w') as f:
+        json.dump(table, f, indent=4)
+        f.write("\n")
+
+    loadSpinTable.cache_clear()
+
+    return table
+
+if __name__ == "__main__":
+    table = regenerateSpinTable()
+    print(f"Wrote {len(table['spins'])} elements to {spinTablePath}")
@@ -2,8 +2,8 @@ from utils.debug import logDebug
 from src.data import matDataObj
 
 from math import e
-import chemparse
-import mendeleev as md
+from src.data.formulas import getElementCounts, getCanonicalFormula
+from src.indexCalc.spinTable import getAverageNuclearSpin
 
 weightsDefault = {
     "magneticNoise": 0.45,
@@ -20,28 +20,24 @@ def getMagneticNoiseSubscore(formula, penaltyFactor=1):
     # 
     # This is a steep exponential decay that penalizes 
     # magnetic noise values even slightly above 0.  
-    elementCounts = chemparse.parse_formula(formula)
+    avgNuclearSpin = getFormulaNuclearSpin(formula)
 
+    return e ** (-penaltyFactor * avgNuclearSpin)
+
+def getFormulaNuclearSpin(formula):
+    # Average nuclear spin per atom of the whole formula
     numerator = 0
     denominator = 0
 
-    for el, number in elementCounts.items():
-        element = md.element(el)
-        avgNuclearSpin = 0
-
-        for iso in element.isotopes:
-            spin = iso.spin if iso.spin is not None else 0
-            abundance = iso.abundance if iso.abundance is not None else 0
-
-            avgNuclearSpin += spin * abundance
-            logDebug(f"{avgNuclearSpin}")
+    # Parsed once per formula, see formulas.py
+    for el, number in getElementCounts(formula):
+        # Precomputed per element, see spinTable.py
+        avgNuclearSpin = getAverageNuclearSpin(el)
 
         numerator += avgNuclearSpin * number
         denominator += number
     
-    avgNuclearSpin = numerator / denominator
-
-    return e ** (-penaltyFactor * avgNuclearSpin)
+    return numerator / denominator
 
 def getStabilitySubscore(stability, decayConstant=50):
     # Stability (hull distance) ideally is 0 eV/atom so
@@ -116,11 +112,11 @@ def getTotalIndex(data:matDataObj, weights:dict=weightsDefault):
     mnSubscore = getMagneticNoiseSubscore(formula)
     sySubscore = getSymmetrySubscore(symmetry)
 
-    logDebug(f"Band Gap Subscore: {bgSubscore} (Weight: {bgWeight})")
-    logDebug(f"Stability Subscore: {stSubscore} (Weight: {stWeight})")
-    logDebug(f"Formation Energy Subscore: {feSubscore} (Weight: {feWeight})")
-    logDebug(f"Magnetic Noise Subscore: {mnSubscore} (Weight: {mnWeight})")
-    logDebug(f"Symmetry Subscore: {sySubscore} (Weight: {syWeight})")
+    logDebug("Band Gap Subscore: %s (Weight: %s)", bgSubscore, bgWeight)
+    logDebug("Stability Subscore: %s (Weight: %s)", stSubscore, stWeight)
+    logDebug("Formation Energy Subscore: %s (Weight: %s)", feSubscore, feWeight)
+    logDebug("Magnetic Noise Subscore: %s (Weight: %s)", mnSubscore, mnWeight)
+    logDebug("Symmetry Subscore: %s (Weight: %s)", sySubscore, syWeight)
 
     subScores = [stSubscore, bgSubscore, feSubscore, mnSubscore, sySubscore]
 
@@ -137,4 +133,26 @@ def getTotalIndex(data:matDataObj, weights:dict=weightsDefault):
     for i in indexInfo:
         index *= (i[0] ** i[1])
 
-    return {'index': index, 'subScores': subScores}
\ No newline at end of file
+    return {'index': index, 'subScores': subScores}
+
+def getQsiUpperBound(formula, weights:dict=weightsDefault, minHullDistance=-1):
+    # Highest index any material with this formula can reach, worked
+    # out from the formula alone (no retrieval). The magnetic noise
+    # subscore only depends on the formula, and the band gap,
+    # formation energy and symmetry subscores are at most 1. The
+    # stability subscore is too for MP, but OQMD reports phases below
+    # the hull with negative stabilities, which push it slightly
+    # above 1, so hull distances down to minHullDistance are allowed
+    # for.
+    #
+    # Returns None when there is no bound: formulas that don't parse,
+    # or negative weights (a subscore near 0 would then blow up).
+    if getCanonicalFormula(formula) is None or any(w < 0 for w in weights.values()):
+        return None
+
+    try:
+        mnSubscore = getMagneticNoiseSubscore(formula)
+    except Exception:
+        return None
+
+    return (mnSubscore ** weights.get("magneticNoise")) * (getStabilitySubscore(minHullDistance) ** weights.get("stability"))
@@ -1,29 +1,18 @@
 import sys
 import math
-import numpy as np
 import logging
 import os
-import subprocess
 
 sys.path.insert(0, '.')
 
-from PyQt6.QtCore import pyqtSignal, QObject, QThread, Qt
+from PyQt6.QtCore import pyqtSignal, QObject, QThread, QTimer, Qt
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLineEdit, QPushButton, QLabel, QCheckBox, QGroupBox, QFormLayout, QDoubleSpinBox,
+    QLineEdit, QPushButton, QLabel, QCheckBox, QGroupBox, QFormLayout, QDoubleSpinBox, QSpinBox,
     QTextEdit, QStatusBar, QStackedWidget, QProgressBar, QFileDialog, QMessageBox
 )
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
-
-from src.data.mp import mpRetriever as mp
-from src.data.oqmd import oqmdRetriever as oqmd
-from src.data.mp import mpCleaner
-from src.data.oqmd import oqmdCleaner
-from src.indexCalc import subscores as ic
-from utils.debug import logDebug
-from src.data.matDataObj import matDataObj
+
+from utils.debug import logDebug, clearScreen
 from src.indexCalc.calculator import calculateQsi
 from src.bulkTest import runBulkTest, ConfusionMatrixWindow
 
@@ -64,93 +53,24 @@ class CalculationWorker(QObject):
     def run(self):
         logDebug("Worker thread started.")
         result = calculateQsi(self.formula, self.forceOqmd, self.weights)
-        logDebug("Index Calculated: " + str(result.get('index')))
+        logDebug("Index Calculated: %s", result.get('index'))
         self.finished.emit(result)
 
 class BulkCalculationWorker(QObject):
     finished = pyqtSignal(object)
     progress = pyqtSignal(int, int, str)
 
-    def __init__(self, inputFile, outputDir):
+    def __init__(self, inputFile, outputDir, maxWorkers=1):
         super().__init__()
         self.inputFile = inputFile
         self.outputDir = outputDir
+        self.maxWorkers = maxWorkers
 
     def run(self):
         logDebug("Bulk worker thread started.")
-        results = runBulkTest(self.inputFile, self.outputDir, progressCallback=self.progress.emit)
+        results = runBulkTest(self.inputFile, self.outputDir, progressCallback=self.progress.emit, maxWorkers=self.maxWorkers)
         self.finished.emit(results)
 
-class RadarChart(FigureCanvas):
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        fig.patch.set_alpha(0)
-        self.axes = fig.add_subplot(111, polar=True)
-        self.axes.patch.set_alpha(0)
-        super(RadarChart, self).__init__(fig)
-        self.setParent(parent)
-        self.setStyleSheet("background-color:transparent;")
-
-    def plot(self, data, labels):
-        self.axes.clear()
-        self.axes.patch.set_alpha(0)
-        
-        self.axes.tick_params(axis='x', colors='white', labelsize=10)
-        self.axes.tick_params(axis='y', colors='white', labelsize=8)
-        self.axes.yaxis.grid(color='white', linestyle='dashed', alpha=0.2)
-        self.axes.xaxis.grid(color='white', linestyle='dashed', alpha=0.2)
-        self.axes.spines['polar'].set_visible(False) 
-
-        angles = np.linspace(0, 2 * np.pi, len(labels), endpoint=False).tolist()
-        dataWithLoop = data + data[:1]
-        anglesWithLoop = angles + angles[:1]
-
-        self.axes.plot(anglesWithLoop, dataWithLoop, 'o-', color='#00d1b2', linewidth=2, markersize=5)
-        self.axes.fill(anglesWithLoop, dataWithLoop, color='#00d1b2', alpha=0.25)
-        self.axes.set_thetagrids(np.degrees(angles), labels)
-        self.axes.set_ylim(0, 1)
-        
-        self.axes.set_axisbelow(True)
-        
-        self.figure.canvas.draw()
-
-class DonutChart(FigureCanvas):
-    def __init__(self, parent=None, width=4, height=4, dpi=100):
-        fig = Figure(figsize=(width, height), dpi=dpi)
-        fig.patch.set_alpha(0)
-        self.axes = fig.add_subplot(111)
-        self.axes.patch.set_alpha(0)
-        super(DonutChart, self).__init__(fig)
-        self.setParent(parent)
-        self.setStyleSheet("background-color:transparent;")
-
-    def plot(self, value):
-        self.axes.clear()
-        self.axes.axis('off')
-        
-        value = max(0, min(1, value))
-
-        if value < 0.33:
-            color = '#ff3860' 
-        elif value < 0.66:
-            color = '#ffdd57' 
-        else:
-            color = '#23d160' 
-
-        values = [value, 1 - value]
-        colors = [color, '#2d2d2d'] 
-        
-        self.axes.pie(values, colors=colors, startangle=90, wedgeprops=dict(width=0.25, edgecolor='#1e1e1e'))
-
-        centerCircle = plt.Circle((0,0), 0.75, fc='none')
-        self.axes.add_artist(centerCircle)
-
-        self.axes.text(0, 0, f'{value:.2f}', ha='center', va='center', fontsize=24, weight='bold', color='white', fontname='Arial')
-        
-        self.axes.axis('equal')
-        self.figure.canvas.draw()
-
-
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -182,7 +102,7 @@ class MainWindow(QMainWindow):
                 padding: 0 10px;
                 background-color: #1e1e1e;
             }
-            QLineEdit, QDoubleSpinBox {
+            QLineEdit, QDoubleSpinBox, QSpinBox {
                 background-color: #2d2d2d;
                 border: 1px solid #3e3e3e;
                 border-radius: 4px;
@@ -273,6 +193,13 @@ class MainWindow(QMainWindow):
         self.oqmdCheckbox = QCheckBox("Force OQMD Data")
         leftLayout.addWidget(self.oqmdCheckbox)
 
+        workersLayout = QFormLayout()
+        self.workersInput = QSpinBox()
+        self.workersInput.setRange(1, 64)
+        self.workersInput.setValue(min(8, os.cpu_count() or 1))
+        workersLayout.addRow("Bulk Workers", self.workersInput)
+        leftLayout.addLayout(workersLayout)
+
         self.calculateButton = QPushButton("Calculate QSI")
         self.calculateButton.clicked.connect(self.startCalculation)
         leftLayout.addWidget(self.calculateButton)
@@ -297,11 +224,7 @@ class MainWindow(QMainWindow):
         right_layout.addWidget(self.stackedWidget)
 
         self.chartsView = QWidget()
-        chartsLayout = QHBoxLayout(self.chartsView)
-        self.radarChart = RadarChart(self.chartsView)
-        self.donutChart = DonutChart(self.chartsView)
-        chartsLayout.addWidget(self.radarChart)
-        chartsLayout.addWidget(self.donutChart)
+        self.chartsLayout = QHBoxLayout(self.chartsView)
         self.stackedWidget.addWidget(self.chartsView)
 
         self.loadingView = QWidget()
@@ -338,9 +261,9 @@ class MainWindow(QMainWindow):
         loadingLayout.addStretch()
         self.stackedWidget.addWidget(self.loadingView)
 
-        initialLabels = [propertyDisplayNames.get(k, k) for k in self.weightsInputs.keys()]
-        self.radarChart.plot([0, 0, 0, 0, 0], initialLabels)
-        self.donutChart.plot(0)
+        # The charts (and matplotlib) are set up right after the
+        # window is first shown, so it opens without waiting on them
+        QTimer.singleShot(0, self.createCharts)
 
         self.setStatusBar(QStatusBar(self))
 
@@ -366,7 +289,7 @@ class MainWindow(QMainWindow):
 
         totalWeight = sum(weights.values())
         if not math.isclose(totalWeight, 1.0):
-            logDebug(f"Error: Weights must sum to 1.0 (current sum: {totalWeight:.2f})")
+            logDebug("Error: Weights must sum to 1.0 (current sum: %.2f)", totalWeight)
             return
         
         self.loadingText.setText("Calculating Quantum Suitability Index...")
@@ -404,15 +327,27 @@ class MainWindow(QMainWindow):
         
         logDebug("QSI calculation finished.")
 
+    def createCharts(self):
+        from src.ui.charts import RadarChart, DonutChart
+
+        self.radarChart = RadarChart(self.chartsView)
+        self.donutChart = DonutChart(self.chartsView)
+        self.chartsLayout.addWidget(self.radarChart)
+        self.chartsLayout.addWidget(self.donutChart)
+
+        initialLabels = [propertyDisplayNames.get(k, k) for k in self.weightsInputs.keys()]
+        self.radarChart.plot([0, 0, 0, 0, 0], initialLabels)
+        self.donutChart.plot(0)
+
     def startBulkCalculation(self):
         logDebug("Opening file dialog for bulk test...")
         inputFileDialog = QFileDialog(self)
         inputFileDialog.setFileMode(QFileDialog.FileMode.ExistingFile)
-        inputFileDialog.setNameFilter("JSON files (*.json)")
+        inputFileDialog.setNameFilter("Bulk input files (*.json *.jsonl *.ndjson *.csv)")
         
         if inputFileDialog.exec():
             inputFilePath = inputFileDialog.selectedFiles()[0]
-            logDebug(f"Starting bulk test with file: {inputFilePath}")
+            logDebug("Starting bulk test with file: %s", inputFilePath)
 
             outputDir = QFileDialog.getExistingDirectory(None, "Select Output Directory")
 
@@ -428,7 +363,7 @@ class MainWindow(QMainWindow):
             self.stackedWidget.setCurrentIndex(1)
 
             self.thread = QThread()
-            self.worker = BulkCalculationWorker(inputFilePath, outputDir)
+            self.worker = BulkCalculationWorker(inputFilePath, outputDir, self.workersInput.value())
             self.worker.moveToThread(self.thread)
 
             self.worker.progress.connect(self.onBulkProgress)
@@ -441,9 +376,15 @@ class MainWindow(QMainWindow):
             self.thread.start()
 
     def onBulkProgress(self, processed, total, formula):
-        progress = int((processed / total) * 100)
-        self.progressBar.setValue(progress)
-        self.progressLabel.setText(f"Processing {formula} ({processed}/{total})")
+        # The total is 0 when the input couldn't be counted, the bar
+        # then just shows activity
+        if total:
+            self.progressBar.setRange(0, 100)
+            self.progressBar.setValue(int((processed / total) * 100))
+            self.progressLabel.setText(f"Processing {formula} ({processed}/{total})")
+        else:
+            self.progressBar.setRange(0, 0)
+            self.progressLabel.setText(f"Processing {formula} ({processed} done)")
 
     def onBulkFinished(self, results):
         self.calculateButton.setEnabled(True)
@@ -471,11 +412,11 @@ class MainWindow(QMainWindow):
                 msgBox.setStandardButtons(QMessageBox.StandardButton.Ok)
                 msgBox.exec()
                 
-                logDebug(f"Validation finished with {inconclusiveCount} inconclusive results.")
+                logDebug("Validation finished with %d inconclusive results.", inconclusiveCount)
             
             elif mode == 'prediction':
                 calculatedCount, inconclusiveCount = resultData
-                logDebug(f"Calculation finished. Results saved to output directory.")
+                logDebug("Calculation finished. Results saved to output directory.")
                 
                 msgBox = QMessageBox()
                 msgBox.setIcon(QMessageBox.Icon.Information)
@@ -494,6 +435,7 @@ class MainWindow(QMainWindow):
 
 
 if __name__ == "__main__":
+    clearScreen()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -0,0 +1,76 @@
+import numpy as np
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.figure import Figure
+import matplotlib.pyplot as plt
+
+# Kept out of the main UI module because matplotlib takes a while to
+# import, the main window only loads it once it is already on screen
+
+class RadarChart(FigureCanvas):
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        fig.patch.set_alpha(0)
+        self.axes = fig.add_subplot(111, polar=True)
+        self.axes.patch.set_alpha(0)
+        super(RadarChart, self).__init__(fig)
+        self.setParent(parent)
+        self.setStyleSheet("background-color:transparent;")
+
+    def plot(self, data, labels):
+        self.axes.clear()
+        self.axes.patch.set_alpha(0)
+        
+        self.axes.tick_params(axis='x', colors='white', labelsize=10)
+        self.axes.tick_params(axis='y', colors='white', labelsize=8)
+        self.axes.yaxis.grid(color='white', linestyle='dashed', alpha=0.2)
+        self.axes.xaxis.grid(color='white', linestyle='dashed', alpha=0.2)
+        self.axes.spines['polar'].set_visible(False) 
+
+        angles = np.linspace(0, 2 * np.pi, len(labels), endpoint=False).tolist()
+        dataWithLoop = data + data[:1]
+        anglesWithLoop = angles + angles[:1]
+
+        self.axes.plot(anglesWithLoop, dataWithLoop, 'o-', color='#00d1b2', linewidth=2, markersize=5)
+        self.axes.fill(anglesWithLoop, dataWithLoop, color='#00d1b2', alpha=0.25)
+        self.axes.set_thetagrids(np.degrees(angles), labels)
+        self.axes.set_ylim(0, 1)
+        
+        self.axes.set_axisbelow(True)
+        
+        self.figure.canvas.draw()
+
+class DonutChart(FigureCanvas):
+    def __init__(self, parent=None, width=4, height=4, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        fig.patch.set_alpha(0)
+        self.axes = fig.add_subplot(111)
+        self.axes.patch.set_alpha(0)
+        super(DonutChart, self).__init__(fig)
+        self.setParent(parent)
+        self.setStyleSheet("background-color:transparent;")
+
+    def plot(self, value):
+        self.axes.clear()
+        self.axes.axis('off')
+        
+        value = max(0, min(1, value))
+
+        if value < 0.33:
+            color = '#ff3860' 
+        elif value < 0.66:
+            color = '#ffdd57' 
+        else:
+            color = '#23d160' 
+
+        values = [value, 1 - value]
+        colors = [color, '#2d2d2d'] 
+        
+        self.axes.pie(values, colors=colors, startangle=90, wedgeprops=dict(width=0.25, edgecolor='#1e1e1e'))
+
+        centerCircle = plt.Circle((0,0), 0.75, fc='none')
+        self.axes.add_artist(centerCircle)
+
+        self.axes.text(0, 0, f'{value:.2f}', ha='center', va='center', fontsize=24, weight='bold', color='white', fontname='Arial')
+        
+        self.axes.axis('equal')
+        self.figure.canvas.draw()
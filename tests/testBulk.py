@@ -0,0 +1,654 @@
+import unittest
+import sys
+import os
+import json
+import time
+import random
+import tempfile
+from unittest import mock
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+validationSet = {
+    "MoS2": True,
+    "WSe2": True,
+    "NaCl": False,
+    "FeS2": False,
+    "BN": True,
+    "GaAs": False,
+}
+
+fakeIndices = {
+    "MoS2": 0.91,
+    "WSe2": 0.42,
+    "NaCl": 0.35,
+    "FeS2": 0.88,
+    "BN": 0.77,
+    "GaAs": None,
+}
+
+def fakeGather(formula, forceOqmd=False, dataMP=None):
+    # Finish in a random order to make sure results are still
+    # reported in input order
+    time.sleep(random.random() / 50)
+    return {'source': "mp", 'data': formula, 'structures': None}
+
+def fakeSelect(gathered):
+    return gathered['data']
+
+def fakeScore(formula, weights=None):
+    index = fakeIndices[formula]
+    if index is None:
+        return {'index': None, 'subScores': None, 'error': "No valid material candidate found in MP or OQMD databases."}
+    return {'index': index, 'subScores': [1, 1, 1, 1, 1], 'candidate': None, 'error': None}
+
+fakeCandidates = {
+    "MoS2": {"formula": "MoS2", "bandGap": 1.2, "hullDistance": 0.0, "formationEnergy": -0.9, "symmetry": 194},
+    "WSe2": {"formula": "WSe2", "bandGap": 1.3, "hullDistance": 0.0, "formationEnergy": -0.6, "symmetry": 194},
+    "NaCl": {"formula": "NaCl", "bandGap": 5.0, "hullDistance": 0.0, "formationEnergy": -2.1, "symmetry": 225},
+    "FeS2": {"formula": "FeS2", "bandGap": 0.9, "hullDistance": 0.01, "formationEnergy": -0.6, "symmetry": 205},
+    "BN": {"formula": "BN", "bandGap": 4.5, "hullDistance": 0.0, "formationEnergy": -1.4, "symmetry": 194},
+    "GaAs": None,
+}
+
+def fakeSelectCandidate(gathered):
+    from data.matDataObj import matDataObj
+
+    candidate = fakeCandidates[gathered['data']]
+    return matDataObj.fromDict(candidate) if candidate else matDataObj.materialNotFound()
+
+def fakeTimedSelect(gathered):
+    from utils.profiling import span
+
+    with span("grouping"):
+        return gathered['data']
+
+def fakeBatch(formulas):
+    return {formula: [{"dataFound": False}] for formula in formulas}
+
+class TestBulk(unittest.TestCase):
+    def runFakeBulkTest(self, maxWorkers):
+        from src.bulkTest.bulkTester import runBulkTest
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", fakeGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            progress = []
+            summary = runBulkTest(inputPath, tempDir, threshold=0.7,
+                                  progressCallback=lambda done, total, formula: progress.append((done, total, formula)),
+                                  maxWorkers=maxWorkers)
+
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                indices = json.load(f)
+            with open(os.path.join(tempDir, "inconclusive.json")) as f:
+                inconclusive = json.load(f)
+
+        return summary, progress, indices, inconclusive
+
+    def testSerialBulkTest(self):
+        summary, progress, indices, inconclusive = self.runFakeBulkTest(1)
+
+        self.assertEqual(summary, ('validation', (2, 1, 1, 1, 5, 1)))
+        self.assertEqual([p[2] for p in progress], list(validationSet))
+        self.assertEqual(inconclusive, ["GaAs"])
+        self.assertEqual(list(indices), ["MoS2", "WSe2", "NaCl", "FeS2", "BN"])
+
+    def testParallelMatchesSerial(self):
+        serial = self.runFakeBulkTest(1)
+        parallel = self.runFakeBulkTest(4)
+
+        self.assertEqual(serial, parallel)
+
+    def testRescoreFromStoredCandidates(self):
+        from src.bulkTest.bulkTester import runBulkTest
+        from src.bulkTest.rescorer import rescoreBulkTest
+        from indexCalc import getTotalIndex
+        from data.matDataObj import matDataObj
+
+        newWeights = {"magneticNoise": 0.2, "stability": 0.2, "symmetry": 0.2, "bandGap": 0.2, "formationEnergy": 0.2}
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", fakeGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelectCandidate), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            summary = runBulkTest(inputPath, tempDir, threshold=0.7)
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                indices = json.load(f)
+
+            self.assertEqual(rescoreBulkTest(tempDir, threshold=0.7), summary)
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                rescoredIndices = json.load(f)
+            self.assertEqual(list(rescoredIndices), list(indices))
+            for formula in indices:
+                self.assertAlmostEqual(rescoredIndices[formula], indices[formula], places=12)
+
+            rescoreBulkTest(tempDir, weights=newWeights, threshold=0.5)
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                reweightedIndices = json.load(f)
+            with open(os.path.join(tempDir, "inconclusive.json")) as f:
+                inconclusive = json.load(f)
+
+        self.assertEqual(inconclusive, ["GaAs"])
+        for formula, qsi in reweightedIndices.items():
+            expected = getTotalIndex(matDataObj.fromDict(fakeCandidates[formula]), newWeights)['index']
+            self.assertAlmostEqual(qsi, expected, places=12)
+
+    def testResumeFromCheckpoint(self):
+        from src.bulkTest.bulkTester import runBulkTest
+
+        gathered = []
+
+        def failingGather(formula, forceOqmd=False, dataMP=None):
+            if formula == "FeS2":
+                raise RuntimeError("Connection lost")
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        def countingGather(formula, forceOqmd=False, dataMP=None):
+            gathered.append(formula)
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", failingGather):
+                with self.assertRaises(RuntimeError):
+                    runBulkTest(inputPath, tempDir, threshold=0.7)
+
+            self.assertFalse(os.path.exists(os.path.join(tempDir, "indices.json")))
+
+            # Simulate a write cut off by the crash
+            with open(os.path.join(tempDir, "results.jsonl"), 'a') as f:
+                f.write('{"formula": "Fe')
+
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", countingGather):
+                summary = runBulkTest(inputPath, tempDir, threshold=0.7)
+
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                indices = json.load(f)
+            with open(os.path.join(tempDir, "results.jsonl")) as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(gathered, ["FeS2", "BN", "GaAs"])
+        self.assertEqual(summary, ('validation', (2, 1, 1, 1, 5, 1)))
+        self.assertEqual(list(indices), ["MoS2", "WSe2", "NaCl", "FeS2", "BN"])
+        # Header, one record per material and the finished marker
+        self.assertEqual(len(lines), 2 + len(validationSet))
+        self.assertEqual(json.loads(lines[-1]), {"finished": True})
+
+    def testRerunStartsOverUnlessResumed(self):
+        from src.bulkTest.bulkTester import runBulkTest
+
+        gathered = []
+
+        def countingGather(formula, forceOqmd=False, dataMP=None):
+            gathered.append(formula)
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", countingGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(["MoS2", "WSe2"], f)
+
+            runBulkTest(inputPath, tempDir)
+
+            # A finished run is done again, unless asked to resume
+            runBulkTest(inputPath, tempDir)
+            self.assertEqual(gathered, ["MoS2", "WSe2"] * 2)
+            runBulkTest(inputPath, tempDir, resume=True)
+            self.assertEqual(len(gathered), 4)
+
+            # So is an unfinished one when the input changed
+            with open(os.path.join(tempDir, "results.jsonl")) as f:
+                lines = f.read().splitlines()
+            with open(os.path.join(tempDir, "results.jsonl"), 'w') as f:
+                f.write("\n".join(lines[:2]) + "\n")
+            with open(inputPath, 'w') as f:
+                json.dump(["MoS2", "BN"], f)
+
+            summary = runBulkTest(inputPath, tempDir)
+
+        self.assertEqual(gathered[4:], ["MoS2", "BN"])
+        self.assertEqual(summary, ('prediction', (2, 0)))
+
+    def testTransientFailuresAreRetried(self):
+        from src.bulkTest.bulkTester import runBulkTest
+        from src.data.requestPolicy import TransientRetrievalError
+
+        gathered = []
+
+        def rateLimitedGather(formula, forceOqmd=False, dataMP=None):
+            if formula in ("WSe2", "BN"):
+                raise TransientRetrievalError("MP request failed 5 times: 429 Too Many Requests")
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        def countingGather(formula, forceOqmd=False, dataMP=None):
+            gathered.append(formula)
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", rateLimitedGather):
+                firstSummary = runBulkTest(inputPath, tempDir, threshold=0.7, maxWorkers=2)
+
+            with open(os.path.join(tempDir, "inconclusive.json")) as f:
+                firstInconclusive = json.load(f)
+
+            # Rerunning only redoes the materials that hit the rate limit
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", countingGather):
+                summary = runBulkTest(inputPath, tempDir, threshold=0.7)
+
+            with open(os.path.join(tempDir, "inconclusive.json")) as f:
+                inconclusive = json.load(f)
+            with open(os.path.join(tempDir, "candidates.json")) as f:
+                candidates = json.load(f)
+
+        self.assertEqual(firstSummary, ('validation', (1, 1, 1, 0, 3, 3)))
+        self.assertEqual(firstInconclusive, ["WSe2", "BN", "GaAs"])
+        self.assertEqual(gathered, ["WSe2", "BN"])
+        self.assertEqual(summary, ('validation', (2, 1, 1, 1, 5, 1)))
+        self.assertEqual(inconclusive, ["GaAs"])
+        self.assertEqual(len(candidates["materials"]), len(validationSet))
+
+    def testEquivalentFormulasAreProcessedOnce(self):
+        from src.bulkTest.bulkTester import runBulkTest
+
+        gathered = []
+
+        def countingGather(formula, forceOqmd=False, dataMP=None):
+            gathered.append(formula)
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", countingGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(["MoS2", "S2Mo", "FeS2", "Mo2S4", "Fe2S4", "BN"], f)
+
+            summary = runBulkTest(inputPath, tempDir)
+
+            # A resumed run with another spelling finds it in the checkpoint
+            with open(inputPath, 'w') as f:
+                json.dump(["S2Fe", "NaCl"], f)
+
+            runBulkTest(inputPath, tempDir, resume=True)
+
+            with open(os.path.join(tempDir, "indices.json")) as f:
+                indices = json.load(f)
+
+        self.assertEqual(summary, ('prediction', (3, 0)))
+        self.assertEqual(gathered, ["MoS2", "FeS2", "BN", "NaCl"])
+        # The summary only covers the second input
+        self.assertEqual(list(indices), ["FeS2", "NaCl"])
+
+    def testRetryUnderAnotherSpellingReplacesFailure(self):
+        from src.bulkTest.bulkTester import runBulkTest
+        from src.data.requestPolicy import TransientRetrievalError
+
+        def rateLimitedGather(formula, forceOqmd=False, dataMP=None):
+            if formula == "S2Mo":
+                raise TransientRetrievalError("MP request failed 5 times: 429 Too Many Requests")
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(["S2Mo", "NaCl"], f)
+
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", rateLimitedGather):
+                runBulkTest(inputPath, tempDir)
+
+            with open(inputPath, 'w') as f:
+                json.dump(["MoS2", "NaCl"], f)
+
+            with mock.patch("src.bulkTest.pipeline.gatherCandidates", fakeGather):
+                summary = runBulkTest(inputPath, tempDir, resume=True)
+
+            with open(os.path.join(tempDir, "inconclusive.json")) as f:
+                inconclusive = json.load(f)
+
+        # The failed S2Mo record is replaced by the redone MoS2
+        self.assertEqual(summary, ('prediction', (2, 0)))
+        self.assertEqual(inconclusive, [])
+
+    def testPruningSkipsUnreachableFormulas(self):
+        from src.bulkTest.bulkTester import runBulkTest
+        from indexCalc import getTotalIndex, getQsiUpperBound
+        from data.matDataObj import matDataObj
+
+        # The bound holds for any properties the databases could return
+        for formula in ["MoS2", "NaCl", "BN", "C"]:
+            best = max(getTotalIndex(matDataObj(formula, bandGap, hullDistance, -5, 230))['index']
+                       for bandGap in (2.4, 4.7) for hullDistance in (0, -1))
+            self.assertLessEqual(best, getQsiUpperBound(formula) + 1e-12)
+        self.assertIsNone(getQsiUpperBound("Graphene"))
+
+        gathered = []
+
+        def countingGather(formula, forceOqmd=False, dataMP=None):
+            gathered.append(formula)
+            return fakeGather(formula, forceOqmd, dataMP)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", countingGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            summary = runBulkTest(inputPath, tempDir, threshold=0.7, prune=True)
+
+            with open(os.path.join(tempDir, "pruned.json")) as f:
+                pruned = json.load(f)
+            with open(os.path.join(tempDir, "falseNegatives.json")) as f:
+                falseNegatives = json.load(f)
+            with open(os.path.join(tempDir, "results.jsonl")) as f:
+                header = json.loads(f.readline())
+
+            # At a lower threshold only the materials whose bound now
+            # reaches it are looked up
+            firstGathered = list(gathered)
+            del gathered[:]
+            rerunSummary = runBulkTest(inputPath, tempDir, threshold=0.52, resume=True, prune=True)
+
+            with open(os.path.join(tempDir, "pruned.json")) as f:
+                rerunPruned = json.load(f)
+
+        # NaCl, BN and GaAs can't reach 0.7 and are never looked up,
+        # they count as predicted unsuitable
+        self.assertEqual(firstGathered, ["MoS2", "WSe2", "FeS2"])
+        self.assertEqual(sorted(pruned), ["BN", "GaAs", "NaCl"])
+        self.assertEqual(summary, ('validation', (1, 2, 1, 2, 3, 0)))
+        self.assertEqual(falseNegatives, {"WSe2": 0.42, "BN": None})
+        self.assertAlmostEqual(pruned["NaCl"], getQsiUpperBound("NaCl"))
+        self.assertEqual((header["threshold"], header["prune"]), (0.7, True))
+
+        # BN's bound is about 0.536, NaCl's and GaAs' about 0.512
+        self.assertEqual(gathered, ["BN"])
+        self.assertEqual(sorted(rerunPruned), ["GaAs", "NaCl"])
+        self.assertEqual(rerunSummary, ('validation', (2, 2, 1, 1, 4, 0)))
+
+    def testOfflineSnapshotMatchesLive(self):
+        from pymatgen.core import Structure, Lattice
+        from src.bulkTest.bulkTester import runBulkTest
+        from src.data import replay, snapshot
+        from src.data.mp import mpRetriever
+        from src.data.oqmd import oqmdRetriever
+        from src.indexCalc import calculator
+
+        mos2 = Structure(Lattice.hexagonal(3.16, 12.3), ["Mo", "S", "S"], [[1/3, 2/3, 0.25], [2/3, 1/3, 0.62], [2/3, 1/3, 0.88]])
+        cubic = Structure(Lattice.cubic(5.1), ["Mo", "S", "S"], [[0, 0, 0], [0.25, 0.25, 0.25], [0.75, 0.75, 0.75]])
+        wse2 = Structure(Lattice.hexagonal(3.28, 12.96), ["W", "Se", "Se"], [[1/3, 2/3, 0.25], [2/3, 1/3, 0.62], [2/3, 1/3, 0.88]])
+
+        def mpDoc(materialId, structure, bandGap, hullDistance, deprecated=False):
+            return {
+                "material_id": materialId, "deprecated": deprecated, "formula_pretty": "MoS2",
+                "band_gap": bandGap, "energy_above_hull": hullDistance, "formation_energy_per_atom": -0.9,
+                "symmetry": {"number": 194}, "structure": structure.as_dict()
+            }
+
+        dataset = {
+            "version": 1,
+            "mp": {"MoS2": [mpDoc("mp-1", mos2, 1.2, 0.05), mpDoc("mp-2", cubic, 1.0, 0.1), mpDoc("mp-3", mos2, 1.0, 0.0, True)]},
+            "oqmd": {
+                "phases": {"WSe2": {"data": [{"entry_id": 7, "name": "WSe2", "band_gap": 1.4, "stability": 0.0,
+                                              "delta_e": -0.5, "unit_cell": None, "spacegroup": "P6_3/mmc"}]}},
+                "structures": {"Se2W": [{"id": 70, "attributes": {
+                    "_oqmd_entry_id": 7, "lattice_vectors": wse2.lattice.matrix.tolist(),
+                    "species_at_sites": ["W", "Se", "Se"], "cartesian_site_positions": wse2.cart_coords.tolist()}}]}
+            }
+        }
+        formulas = ["MoS2", "WSe2", "NaCl"]
+
+        def clearCaches():
+            mpRetriever.retrieveMpData.cache_clear()
+            oqmdRetriever.retrieveOqmdData.cache_clear()
+            calculator.getFinalCandidate.cache_clear()
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.data.retrievalCache.cacheEnabled", False):
+            replayPath = os.path.join(tempDir, "replay.json.gz")
+            snapshotPath = os.path.join(tempDir, "snapshot")
+            replay.saveReplayDataset(dataset, replayPath)
+
+            try:
+                replay.configureReplay(replayPath)
+                clearCaches()
+                live = [calculator.calculateQsi(formula) for formula in formulas]
+                meta = snapshot.buildSnapshot(["S2Mo", *formulas], snapshotPath)
+            finally:
+                replay.disableReplay()
+                clearCaches()
+
+            # Nothing may reach the clients once the snapshot is used
+            offlineClient = mock.Mock(side_effect=AssertionError("network access in snapshot mode"))
+
+            with mock.patch.object(mpRetriever, "MPRester", offlineClient), \
+                    mock.patch.object(oqmdRetriever, "QMPYRester", offlineClient), \
+                    mock.patch.object(snapshot, "dataSource", "snapshot"), \
+                    mock.patch.object(snapshot, "snapshotPath", snapshotPath):
+                offline = [calculator.calculateQsi(formula) for formula in formulas]
+
+                inputPath = os.path.join(tempDir, "input.json")
+                outputDir = os.path.join(tempDir, "results")
+                os.makedirs(outputDir)
+                with open(inputPath, 'w') as f:
+                    json.dump(["S2Mo", "WSe2", "NaCl"], f)
+
+                summary = runBulkTest(inputPath, outputDir, maxWorkers=2)
+
+                with open(os.path.join(outputDir, "indices.json")) as f:
+                    indices = json.load(f)
+
+            calculator.getFinalCandidate.cache_clear()
+
+        # Deprecated MP entries are left out, NaCl is in neither source
+        self.assertEqual((meta["materials"], meta["compositions"], meta["failed"]), (3, 2, []))
+        self.assertEqual(offline, live)
+        self.assertIsNotNone(live[0]["index"])
+        self.assertEqual(live[1]["candidate"]["symmetry"], 194)
+        self.assertIsNone(live[2]["index"])
+        self.assertEqual(summary, ('prediction', (2, 1)))
+        self.assertEqual(indices, {"S2Mo": live[0]["index"], "WSe2": live[1]["index"]})
+
+    def testSnapshotKeepsDisorderedStructures(self):
+        from pymatgen.core import Structure, Lattice
+        from src.data import replay, snapshot
+        from src.data.mp import mpRetriever
+        from src.indexCalc import calculator
+
+        # Partial occupancies, so it can't be packed
+        alloy = Structure(Lattice.cubic(3.8), [{"Au": 0.5, "Cu": 0.5}], [[0, 0, 0]])
+
+        dataset = {"version": 1, "mp": {"AuCu": [{
+            "material_id": "mp-1", "deprecated": False, "formula_pretty": "AuCu",
+            "band_gap": 0.5, "energy_above_hull": 0.0, "formation_energy_per_atom": -0.2,
+            "symmetry": {"number": 221}, "structure": alloy.as_dict()
+        }]}}
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.data.retrievalCache.cacheEnabled", False):
+            replayPath = os.path.join(tempDir, "replay.json.gz")
+            snapshotPath = os.path.join(tempDir, "snapshot")
+            replay.saveReplayDataset(dataset, replayPath)
+
+            # Only a previous snapshot or an empty directory is replaced
+            otherPath = os.path.join(tempDir, "other")
+            os.makedirs(otherPath)
+            with open(os.path.join(otherPath, "notes.txt"), 'w') as f:
+                f.write("keep me")
+
+            try:
+                replay.configureReplay(replayPath)
+                mpRetriever.retrieveMpData.cache_clear()
+                calculator.getFinalCandidate.cache_clear()
+                live = calculator.calculateQsi("AuCu")
+
+                with self.assertRaises(FileExistsError):
+                    snapshot.buildSnapshot(["AuCu"], otherPath)
+
+                snapshot.buildSnapshot(["AuCu"], snapshotPath)
+                meta = snapshot.buildSnapshot(["AuCu"], snapshotPath)
+            finally:
+                replay.disableReplay()
+                mpRetriever.retrieveMpData.cache_clear()
+                calculator.getFinalCandidate.cache_clear()
+
+            with mock.patch.object(snapshot, "dataSource", "snapshot"), \
+                    mock.patch.object(snapshot, "snapshotPath", snapshotPath):
+                offline = calculator.calculateQsi("AuCu")
+
+            calculator.getFinalCandidate.cache_clear()
+
+            self.assertEqual(os.listdir(otherPath), ["notes.txt"])
+
+        self.assertEqual(meta["materials"], 1)
+        self.assertIsNotNone(live["index"])
+        self.assertEqual(offline, live)
+
+    def testStreamingInputFormats(self):
+        from src.bulkTest import inputReader
+
+        expected = [(formula, isTrulySuitable, True) for formula, isTrulySuitable in validationSet.items()]
+        expected.append(("Graphene", None, False))
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            paths = {name: os.path.join(tempDir, name) for name in ["input.json", "input.jsonl", "input.csv"]}
+
+            with open(paths["input.json"], 'w') as f:
+                json.dump({**validationSet, "Graphene": "maybe"}, f, indent=4)
+            with open(paths["input.jsonl"], 'w') as f:
+                for formula, isTrulySuitable in validationSet.items():
+                    f.write(json.dumps({"formula": formula, "isTrulySuitable": isTrulySuitable}) + "\n")
+                f.write('{"Graphene": null}\n')
+            with open(paths["input.csv"], 'w') as f:
+                f.write("formula,isTrulySuitable\n")
+                for formula, isTrulySuitable in validationSet.items():
+                    f.write(f"{formula},{str(isTrulySuitable).lower()}\n")
+                f.write("Graphene,maybe\n")
+
+            # A tiny read window makes sure values split across chunks
+            # are put back together
+            with mock.patch.object(inputReader, "readChunkSize", 3):
+                for path in paths.values():
+                    mode, items = inputReader.readInput(path)
+                    self.assertEqual(mode, 'validation')
+                    self.assertEqual(list(items), expected)
+
+            predictionPath = os.path.join(tempDir, "prediction.json")
+            with open(predictionPath, 'w') as f:
+                json.dump(["MoS2", 12, "BN"], f)
+            mode, items = inputReader.readInput(predictionPath)
+            self.assertEqual(mode, 'prediction')
+            self.assertEqual(list(items), [("MoS2", None, True), ("12", None, False), ("BN", None, True)])
+
+            brokenPath = os.path.join(tempDir, "broken.json")
+            with open(brokenPath, 'w') as f:
+                f.write('["MoS2", "BN" "WSe2"]')
+            mode, items = inputReader.readInput(brokenPath)
+            self.assertEqual(next(items), ("MoS2", None, True))
+            with self.assertRaises(inputReader.InputFileError):
+                list(items)
+
+    def testStreamedBulkTestReportsFirstResultEarly(self):
+        from src.bulkTest.bulkTester import runBulkTest
+
+        read = []
+
+        def trackingBatch(formulas):
+            read.append(list(formulas))
+            return fakeBatch(formulas)
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", fakeGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", lambda formula, weights=None: {'index': 0.5, 'candidate': None, 'error': None}), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", trackingBatch):
+            inputPath = os.path.join(tempDir, "input.jsonl")
+            with open(inputPath, 'w') as f:
+                for i in range(250):
+                    f.write(json.dumps(f"SiC{i + 1}") + "\n")
+
+            progress = []
+            summary = runBulkTest(inputPath, tempDir,
+                                  progressCallback=lambda done, total, formula: progress.append((done, total, formula, len(read))))
+
+        self.assertEqual(summary, ('prediction', (250, 0)))
+        # The first result comes out after only the first batch was read
+        self.assertEqual(progress[0], (1, 250, "SiC1", 1))
+        self.assertEqual(progress[-1][:3], (250, 250, "SiC250"))
+        self.assertEqual([len(batch) for batch in read], [100, 100, 50])
+
+    def testProfilingTimings(self):
+        from src.bulkTest.bulkTester import runBulkTest
+        from utils import profiling
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch("src.bulkTest.pipeline.gatherCandidates", fakeGather), \
+                mock.patch("src.bulkTest.pipeline.selectFinalCandidate", fakeTimedSelect), \
+                mock.patch("src.bulkTest.pipeline.scoreCandidate", fakeScore), \
+                mock.patch("src.bulkTest.pipeline.retrieveMpDataBatch", fakeBatch), \
+                mock.patch.object(profiling, "profilingEnabled", True):
+            inputPath = os.path.join(tempDir, "input.json")
+            with open(inputPath, 'w') as f:
+                json.dump(validationSet, f)
+
+            runBulkTest(inputPath, tempDir, maxWorkers=4)
+
+            with open(os.path.join(tempDir, "timings.json")) as f:
+                timings = json.load(f)
+
+        # Spans from the worker processes are included
+        self.assertEqual(timings["grouping"]["count"], len(validationSet))
+        self.assertEqual(timings["outputWriting"]["count"], len(validationSet))
+        self.assertEqual(timings["retrievalBatch"]["count"], 1)
+        self.assertLessEqual(timings["outputWriting"]["p50Seconds"], timings["outputWriting"]["p95Seconds"])
+
+        profiling.resetStageStats()
+        for seconds in [4, 1, 3, 2, 5]:
+            profiling.addSample("stage", seconds)
+
+        stats = profiling.getStageStats()["stage"]
+        self.assertEqual((stats["p50Seconds"], stats["p95Seconds"], stats["maxSeconds"]), (3, 4.8, 5))
+        profiling.resetStageStats()
+
+        # Disabled spans record nothing
+        with profiling.span("stage"):
+            pass
+        self.assertEqual(profiling.getStageStats(), {})
+
+if __name__ == '__main__':
+    unittest.main()
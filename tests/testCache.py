@@ -0,0 +1,152 @@
+import unittest
+import sys
+import os
+import tempfile
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+sampleData = [{
+    "mpId": "mp-2815",
+    "formula": "MoS2",
+    "bandGap": 1.23,
+    "hullDistance": 0.0,
+    "formationEnergy": -0.96,
+    "symmetry": 194,
+    "dataFound": True
+}]
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempDir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def testRoundTrip(self):
+        from src.data.retrievalCache import RetrievalCache
+
+        cache = RetrievalCache(self.path, ttl=60, maxEntries=10)
+        cache.put("mp", "MoS2", ["band_gap"], sampleData)
+
+        self.assertEqual(cache.get("mp", " MoS2 ", ["band_gap"]), sampleData)
+        self.assertIsNone(cache.get("oqmd", "MoS2", ["band_gap"]))
+        self.assertIsNone(cache.get("mp", "MoS2", ["structure"]))
+        cache.close()
+
+    def testPersistsAcrossInstances(self):
+        from src.data.retrievalCache import RetrievalCache
+
+        cache = RetrievalCache(self.path, ttl=60, maxEntries=10)
+        cache.put("mp", "MoS2", ["band_gap"], sampleData)
+        cache.close()
+
+        reopened = RetrievalCache(self.path, ttl=60, maxEntries=10)
+        self.assertEqual(reopened.get("mp", "MoS2", ["band_gap"]), sampleData)
+        reopened.close()
+
+    def testExpiryAndVersion(self):
+        from src.data.retrievalCache import RetrievalCache
+
+        cache = RetrievalCache(self.path, ttl=-1, maxEntries=10)
+        cache.put("mp", "MoS2", ["band_gap"], sampleData)
+        self.assertIsNone(cache.get("mp", "MoS2", ["band_gap"]))
+        cache.close()
+
+        cache = RetrievalCache(self.path, ttl=60, maxEntries=10, version=1)
+        cache.put("mp", "MoS2", ["band_gap"], sampleData)
+        cache.close()
+
+        newer = RetrievalCache(self.path, ttl=60, maxEntries=10, version=2)
+        self.assertIsNone(newer.get("mp", "MoS2", ["band_gap"]))
+        newer.close()
+
+    def testEviction(self):
+        from src.data.retrievalCache import RetrievalCache
+
+        cache = RetrievalCache(self.path, ttl=60, maxEntries=3)
+        for formula in ["A", "B", "C", "D", "E"]:
+            cache.put("mp", formula, [], sampleData)
+
+        self.assertEqual(len(cache), 3)
+        self.assertIsNotNone(cache.get("mp", "E", []))
+        cache.close()
+
+    def testEquivalentFormulasShareEntries(self):
+        from src.data.formulas import getCanonicalFormula, getFormulaKey, getElementCounts
+        from src.data.retrievalCache import RetrievalCache, memoryCached
+        from unittest import mock
+
+        for formula in ["FeS2", "S2Fe", "Fe2S4", " Fe S2 "]:
+            self.assertEqual(getCanonicalFormula(formula), "FeS2")
+        self.assertEqual(getCanonicalFormula("S6S10"), "S")
+        self.assertEqual(getCanonicalFormula("Ca(OH)2"), "CaH2O2")
+        self.assertEqual(getCanonicalFormula("Fe0.5S"), "Fe0.5S")
+        self.assertEqual(dict(getElementCounts("S6S10")), {"S": 16})
+
+        # Strings that aren't formulas are left for the retrievers to
+        # reject
+        self.assertIsNone(getCanonicalFormula("Graphene"))
+        self.assertIsNone(getCanonicalFormula("mos2"))
+        self.assertEqual(getFormulaKey(" mos2 "), "mos2")
+
+        cache = RetrievalCache(self.path, ttl=60, maxEntries=10)
+        cache.put("mp", "S2Mo", ["band_gap"], sampleData)
+        self.assertEqual(cache.get("mp", "Mo2S4", ["band_gap"]), sampleData)
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+        retrieve = mock.Mock(return_value=sampleData)
+        memoized = memoryCached(4)(lambda formula: retrieve(formula))
+        for formula in ["MoS2", "S2Mo", "Mo2S4", "S6S10", "S8"]:
+            memoized(formula)
+
+        self.assertEqual([c.args[0] for c in retrieve.call_args_list], ["MoS2", "S"])
+
+    def testSelectedCandidatesAreBounded(self):
+        from src.data.retrievalCache import memoryCacheSize
+        from src.indexCalc import calculator
+
+        self.assertEqual(calculator.getFinalCandidate.cache_info().maxsize, memoryCacheSize)
+
+    def testBrokenCacheDoesNotStopBatch(self):
+        import sqlite3
+        from types import SimpleNamespace
+        from unittest import mock
+        import src.data.mp.mpRetriever as mpRetriever
+
+        brokenCache = mock.Mock()
+        brokenCache.get.side_effect = sqlite3.OperationalError("database is locked")
+        brokenCache.put.side_effect = sqlite3.OperationalError("database is locked")
+        searches = []
+
+        def search(formula=None, fields=None, **kwargs):
+            searches.append(formula)
+            return [SimpleNamespace(material_id="mp-2815", deprecated=False, formula_pretty="MoS2",
+                                    band_gap=1.2, energy_above_hull=0.0, formation_energy_per_atom=-1.0,
+                                    symmetry=SimpleNamespace(number=194), structure=None)]
+
+        class FakeRester:
+            def __init__(self, *args, **kwargs):
+                self.materials = SimpleNamespace(summary=SimpleNamespace(search=search))
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        with mock.patch.object(mpRetriever, "MPRester", FakeRester), \
+                mock.patch.object(mpRetriever, "getCache", lambda: brokenCache), \
+                mock.patch("src.data.retrievalCache.logError"):
+            results = mpRetriever.retrieveMpDataBatch(["MoS2", "WSe2"])
+
+        # Failed reads are misses and failed writes don't redo the batch
+        self.assertEqual(searches, [["MoS2", "Se2W"]])
+        self.assertEqual(results["MoS2"][0]["mpId"], "mp-2815")
+        self.assertFalse(results["WSe2"][0]["dataFound"])
+        self.assertEqual(brokenCache.put.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,5 +7,151 @@ class TestMath(unittest.TestCase):
 
         logDebug(str(getBandGapSubscore(2)))
 
+    def testMagneticNoiseWithoutMendeleev(self):
+        import sys
+        from unittest import mock
+        from math import e
+        from indexCalc import getMagneticNoiseSubscore
+
+        with mock.patch.dict(sys.modules, {"mendeleev": None}):
+            self.assertAlmostEqual(getMagneticNoiseSubscore("S"), e ** -0.011445)
+            self.assertAlmostEqual(getMagneticNoiseSubscore("MoS2"), e ** (-(0.636375 + 2 * 0.011445) / 3))
+
+    def testSpinTableMatchesMendeleev(self):
+        from indexCalc.spinTable import loadSpinTable, computeAverageNuclearSpin
+
+        spins = loadSpinTable()
+        for el in ["H", "C", "O", "Si", "S", "Mo", "Se", "W"]:
+            self.assertAlmostEqual(spins[el], computeAverageNuclearSpin(el))
+
+    def testBatchScoresMatchScalar(self):
+        import random
+        import numpy as np
+        from indexCalc import getTotalIndex, getTotalIndices
+        from indexCalc.batchScores import getFormulaNuclearSpins, getIndexSweep, weightsToVector
+        from data.matDataObj import matDataObj
+
+        random.seed(0)
+        formulas = ["MoS2", "WSe2", "C", "SiC", "GaAs", "BN", "FeS2", "ZnO"]
+        materials = [matDataObj(
+            formula=random.choice(formulas),
+            bandGap=random.uniform(0, 7),
+            hullDistance=random.uniform(0, 0.5),
+            formationEnergy=random.uniform(-3, 1),
+            symmetry=random.randint(1, 230)
+        ) for _ in range(200)]
+
+        weights = {"magneticNoise": 0.3, "stability": 0.3, "symmetry": 0.2, "bandGap": 0.15, "formationEnergy": 0.05}
+        batch = getTotalIndices(
+            [m.bandGap for m in materials],
+            [m.hullDistance for m in materials],
+            [m.formationEnergy for m in materials],
+            [m.symmetry for m in materials],
+            getFormulaNuclearSpins([m.formula for m in materials]),
+            weights
+        )
+
+        for i, material in enumerate(materials):
+            scalar = getTotalIndex(material, weights)
+            self.assertAlmostEqual(batch['index'][i], scalar['index'], places=12)
+            np.testing.assert_allclose(batch['subScores'][i], scalar['subScores'], rtol=1e-12)
+
+        sweep = getIndexSweep(batch['subScores'], [weightsToVector(weights)])
+        np.testing.assert_allclose(sweep[0], batch['index'], rtol=1e-12)
+
+    def testMaterialTable(self):
+        import os
+        import random
+        import tempfile
+        from indexCalc import getTotalIndex
+        from data import MaterialTable
+        from data.matDataObj import matDataObj
+
+        random.seed(1)
+        formulas = ["MoS2", "WSe2", "C", "SiC", "BN"]
+        materials = [matDataObj(
+            formula=random.choice(formulas),
+            bandGap=random.uniform(0, 7),
+            hullDistance=random.uniform(0, 0.5),
+            formationEnergy=random.uniform(-3, 1),
+            symmetry=random.randint(1, 230)
+        ) for _ in range(3000)]
+        materials.append(matDataObj.materialNotFound())
+
+        self.assertFalse(hasattr(materials[0], "__dict__"))
+
+        table = MaterialTable(capacity=16)
+        table.extend(materials[:10])
+        table.extend(m.toDict() for m in materials[10:])
+
+        self.assertEqual(len(table), len(materials))
+        self.assertEqual(table.formulas, list(dict.fromkeys(m.formula for m in materials[:-1])))
+        self.assertLess(table.nbytes() / len(table), 64)
+        self.assertEqual(table[5].toDict(), materials[5].toDict())
+        self.assertIsNone(table[-1].formula)
+
+        indices = table.getTotalIndices()['index']
+        for row in range(0, len(materials) - 1, 97):
+            self.assertAlmostEqual(indices[row], getTotalIndex(materials[row])['index'], places=12)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "table.npz")
+            table.save(path)
+            loaded = MaterialTable.load(path)
+
+        self.assertEqual([m.toDict() for m in loaded], [m.toDict() for m in table])
+
+    def testMaterialIndexQueries(self):
+        import random
+        import chemparse
+        from indexCalc import getTotalIndex
+        from indexCalc.spinTable import getAverageNuclearSpin
+        from data.matDataObj import matDataObj
+        from src.data.materialIndex import MaterialIndex
+
+        random.seed(2)
+        formulas = ["Si", "SiC", "SiO2", "C", "CO2", "Si3N4", "SiC2O", "MoS2", "WSe2", "ZnO", "ZnS", "BN", "C2H4"]
+        materials = [matDataObj(
+            formula=random.choice(formulas),
+            bandGap=random.uniform(0, 7),
+            hullDistance=random.uniform(0, 0.2),
+            formationEnergy=random.uniform(-3, 1),
+            symmetry=random.randint(1, 230)
+        ) for _ in range(2000)]
+        materials.append(matDataObj.materialNotFound())
+
+        index = MaterialIndex.fromMaterials(materials, ids=[f"id-{i}" for i in range(len(materials))])
+        qsi = [getTotalIndex(m)['index'] if m.formula else None for m in materials]
+
+        def elements(m):
+            return set(chemparse.parse_formula(m.formula))
+
+        def bruteForce(condition):
+            rows = [i for i, m in enumerate(materials) if m.formula and condition(m, qsi[i])]
+            return sorted(rows, key=lambda i: -qsi[i])
+
+        spinFree = {el for f in formulas for el in chemparse.parse_formula(f) if getAverageNuclearSpin(el) <= 0.05}
+
+        cases = [
+            ({"within": {"Si", "C", "O"}}, lambda m, q: elements(m) <= {"Si", "C", "O"}),
+            ({"containing": {"Si", "O"}}, lambda m, q: {"Si", "O"} <= elements(m)),
+            ({"excluding": {"C"}, "minQsi": 0.3}, lambda m, q: "C" not in elements(m) and q >= 0.3),
+            ({"maxElementSpin": 0.05, "maxHullDistance": 0.05}, lambda m, q: elements(m) <= spinFree and m.hullDistance <= 0.05),
+            ({"within": {"Zn", "O", "S"}, "minBandGap": 1, "maxBandGap": 3}, lambda m, q: elements(m) <= {"Zn", "O", "S"} and 1 <= m.bandGap <= 3),
+            ({"within": {"Fe"}}, lambda m, q: False),
+        ]
+
+        for conditions, condition in cases:
+            self.assertEqual(index.queryRows(**conditions).tolist(), bruteForce(condition), conditions)
+
+        best = index.query(within={"Si", "C", "O"}, onePerFormula=True)
+        self.assertEqual(sorted(r["formula"] for r in best), ["C", "CO2", "Si", "SiC", "SiC2O", "SiO2"])
+        for record in best:
+            rows = [i for i, m in enumerate(materials) if m.formula == record["formula"]]
+            self.assertAlmostEqual(record["qsi"], max(qsi[i] for i in rows), places=12)
+
+        top = index.query(limit=1, containing={"Mo"})[0]
+        self.assertEqual(top["id"], f"id-{bruteForce(lambda m, q: 'Mo' in elements(m))[0]}")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
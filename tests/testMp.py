@@ -8,6 +8,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
 formula = "MoS2"
 
 class TestMP(unittest.TestCase):
+    def setUp(self):
+        # Fresh rate limits and circuit breakers, earlier tests may
+        # have tripped them without network access
+        from src.data import requestPolicy
+        requestPolicy.policies.clear()
+
     def testMpRetrieval(self):
         import src.data.mp as mp
         import json
@@ -24,5 +30,317 @@ class TestMP(unittest.TestCase):
 
         print(str(filteredData))
 
+    def testMpBatchSplitting(self):
+        import src.data.mp.mpRetriever as mpRetriever
+        from types import SimpleNamespace
+        from unittest import mock
+
+        def fakeDoc(materialId, formulaPretty):
+            return SimpleNamespace(
+                material_id=materialId, deprecated=False, formula_pretty=formulaPretty,
+                band_gap=1.0, energy_above_hull=0.0, formation_energy_per_atom=-1.0,
+                symmetry=SimpleNamespace(number=194), structure=None
+            )
+
+        class FakeSummary:
+            calls = []
+
+            def search(self, formula=None, fields=None, **kwargs):
+                self.calls.append(formula)
+                return [fakeDoc("mp-2815", "MoS2"), fakeDoc("mp-1202", "MoS2"), fakeDoc("mp-96", "S")]
+
+        class FakeRester:
+            def __init__(self, *args, **kwargs):
+                self.materials = SimpleNamespace(summary=FakeSummary())
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        with mock.patch.object(mpRetriever, "MPRester", FakeRester), \
+                mock.patch.object(mpRetriever, "getCache", lambda: None):
+            results = mpRetriever.retrieveMpDataBatch(["MoS2", "S2Mo", "S8", "WSe2", "Graphene"])
+
+        # Spellings of the same composition are only requested once
+        self.assertEqual(FakeSummary.calls, [["MoS2", "S", "Se2W"]])
+        self.assertEqual([d["mpId"] for d in results["MoS2"]], ["mp-2815", "mp-1202"])
+        self.assertEqual([d["mpId"] for d in results["S2Mo"]], ["mp-2815", "mp-1202"])
+        self.assertEqual([d["mpId"] for d in results["S8"]], ["mp-96"])
+        self.assertFalse(results["WSe2"][0]["dataFound"])
+        self.assertTrue(results["Graphene"][0]["error"])
+
+    def testGroupingMatchesStructureMatcher(self):
+        import numpy as np
+        from pymatgen.core import Structure, Lattice
+        from pymatgen.analysis.structure_matcher import StructureMatcher
+        from data.structureGrouping import groupStructures
+
+        # Polymorphs with different numbers of sites per cell, some as
+        # supercells and some slightly distorted
+        bases = [
+            Structure(Lattice.cubic(5.43), ["Si"] * 2, [[0, 0, 0], [0.25, 0.25, 0.25]]),
+            Structure(Lattice.cubic(2.7), ["Si"], [[0, 0, 0]]),
+            Structure(Lattice.cubic(3.1), ["Si"] * 2, [[0, 0, 0], [0.5, 0.5, 0.5]]),
+            Structure(Lattice.hexagonal(3.8, 6.2), ["Si"] * 2, [[1/3, 2/3, 0.25], [2/3, 1/3, 0.75]]),
+            Structure(Lattice.orthorhombic(3.2, 5.1, 6.7), ["Si"] * 4, [[0, 0, 0], [0.5, 0.3, 0.2], [0.1, 0.5, 0.5], [0.6, 0.8, 0.7]]),
+        ]
+
+        rng = np.random.default_rng(0)
+        structures = []
+        for i in range(30):
+            struct = bases[rng.integers(len(bases))].copy()
+            if rng.random() < 0.3:
+                struct.make_supercell([1, 1, 2])
+            if rng.random() < 0.5:
+                struct.perturb(float(rng.random() * 0.15))
+            struct.scale_lattice(struct.volume * float(0.9 + rng.random() * 0.2))
+            struct.label = f"mp-{i}"
+            structures.append(struct)
+
+        expected = [[s.label for s in group] for group in StructureMatcher().group_structures(structures)]
+
+        self.assertEqual([[s.label for s in group] for group in groupStructures(structures, "Si")], expected)
+        # Second call comes from the cache
+        self.assertEqual([[s.label for s in group] for group in groupStructures(structures, "Si")], expected)
+
+        # Without the matcher internals it falls back to group_structures
+        from unittest import mock
+        from data import structureGrouping
+
+        def renamedInternals(structures):
+            raise AttributeError("'StructureMatcher' object has no attribute '_comparator'")
+
+        with mock.patch.object(structureGrouping, "groupStructureIndices", renamedInternals), \
+                mock.patch.object(structureGrouping, "canBucket", True), \
+                mock.patch.object(structureGrouping, "logError"):
+            self.assertEqual([[s.label for s in group] for group in groupStructures(structures)], expected)
+            self.assertFalse(structureGrouping.canBucket)
+
+    def testPackedStructures(self):
+        import pickle
+        import tempfile
+        import numpy as np
+        from pymatgen.core import Structure, Lattice
+        from data.structureGrouping import groupStructures
+        from src.data.structureStore import PackedStructures, StructureStore, ScratchStore
+        import data.mp.mpCleaner as mpCleaner
+        import data.oqmd.oqmdCleaner as oqmdCleaner
+
+        rng = np.random.default_rng(1)
+        structures = []
+        for i in range(12):
+            struct = Structure(Lattice.cubic(5.43), ["Si", "C"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+            if i % 3 == 0:
+                struct.make_supercell([1, 1, 2])
+            struct.perturb(float(rng.random() * 0.3))
+            struct.label = f"mp-{i}"
+            structures.append(struct)
+
+        mpData = [{"mpId": s.label, "deprecated": False, "structure": s.as_dict()} for s in structures]
+        mpData.append({"mpId": "mp-99", "deprecated": True, "structure": None})
+        oqmdData = [{"oqmdId": s.label, "structureData": {"data": [{"attributes": {
+            "lattice_vectors": s.lattice.matrix.tolist(),
+            "species_at_sites": [str(el) for el in s.species],
+            "cartesian_site_positions": s.cart_coords.tolist()
+        }}]}} for s in structures]
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            store = StructureStore(tempDir)
+
+            for data, cleaner, packed in ((mpData, mpCleaner, PackedStructures.fromMpData(mpData)),
+                                          (oqmdData, oqmdCleaner, PackedStructures.fromOqmdData(oqmdData))):
+                # What a worker process gets: a reference to the mapped arrays
+                loaded = pickle.loads(pickle.dumps(store.add(packed))).load()
+                expected = cleaner.buildStructures(data)
+
+                self.assertIsInstance(loaded.lattices, np.memmap)
+                for built, original in zip(loaded.toStructures(), expected):
+                    self.assertEqual(built.label, original.label)
+                    self.assertEqual(built.species, original.species)
+                    self.assertTrue(np.array_equal(built.lattice.matrix, original.lattice.matrix))
+                    self.assertTrue(np.array_equal(built.frac_coords, original.frac_coords))
+
+                # Both sets use the same labels, keep their cached groups apart
+                formula = "SiC" if cleaner is mpCleaner else "CSi"
+                groups = [[s.label for s in group] for group in groupStructures(expected, formula)]
+                self.assertEqual([[e.label for e in group] for group in groupStructures(loaded, formula)], groups)
+
+                # Cached groups don't need the structures
+                packed = PackedStructures.fromStructures(expected)
+                self.assertEqual([[e.label for e in group] for group in groupStructures(packed, formula)], groups)
+                self.assertEqual(packed.built, {})
+
+            store.flush()
+            found = StructureStore(tempDir).get(["mp-5", "mp-missing", "mp-2"], ["a", "b", "c"])
+
+            # A scratch store starts new files once a segment is full
+            # and deletes them once every ref into them is released
+            scratchPath = os.path.join(tempDir, "scratch")
+            scratch = ScratchStore(scratchPath, segmentSize=1)
+            refs = [scratch.add(PackedStructures.fromMpData(mpData[i:i + 4])) for i in range(0, 12, 4)]
+
+            self.assertEqual([ref.segment for ref in refs], [0, 1, 2])
+            for ref, i in zip(refs, range(0, 12, 4)):
+                loaded = pickle.loads(pickle.dumps(ref)).load()
+                self.assertEqual(loaded.labels, [s.label for s in structures[i:i + 4]])
+                self.assertTrue(np.array_equal(loaded.fracCoords, np.concatenate([s.frac_coords for s in structures[i:i + 4]])))
+                del loaded
+
+            scratch.release(refs[1])
+            scratch.release(refs[0])
+            scratch.release(refs[2])
+            remaining = sorted(os.listdir(scratchPath))
+
+        self.assertEqual(remaining, ["atomicNumbers.2.bin", "fracCoords.2.bin", "lattices.2.bin"])
+        self.assertEqual(found.labels, ["a", "c"])
+        self.assertTrue(np.array_equal(found.fracCoords[found.siteOffsets[1]:], structures[2].frac_coords))
+
+    def testReplayClients(self):
+        import src.data.mp.mpRetriever as mpRetriever
+        import data.mp.mpCleaner as mpCleaner
+        from pymatgen.core import Structure, Lattice
+        from src.data.replay import ReplayMPRester
+        from unittest import mock
+
+        structure = Structure(Lattice.hexagonal(3.16, 12.3), ["Mo", "S", "S"], [[1/3, 2/3, 0.25], [2/3, 1/3, 0.62], [2/3, 1/3, 0.88]])
+
+        def doc(materialId, bandGap, hullDistance, deprecated=False):
+            return {
+                "material_id": materialId, "deprecated": deprecated, "formula_pretty": "MoS2",
+                "band_gap": bandGap, "energy_above_hull": hullDistance, "formation_energy_per_atom": -0.9,
+                "symmetry": {"number": 194}, "structure": structure.as_dict()
+            }
+
+        dataset = {"version": 1, "mp": {"MoS2": [doc("mp-1", 1.2, 0.05), doc("mp-2", 1.0, 0.0), doc("mp-3", 1.0, 0.0, True)]}}
+        replay = lambda *args, **kwargs: ReplayMPRester(dataset)
+
+        with mock.patch.object(mpRetriever, "MPRester", replay), \
+                mock.patch.object(mpCleaner, "MPRester", replay), \
+                mock.patch("src.data.retrievalCache.cacheEnabled", False):
+            mpRetriever.retrieveMpData.cache_clear()
+            data = mpRetriever.retrieveMpData("MoS2")
+            missing = mpRetriever.retrieveMpData("WSe2")
+            final = mpCleaner.filter(data)
+            mpRetriever.retrieveMpData.cache_clear()
+
+        self.assertEqual([d["mpId"] for d in data], ["mp-1", "mp-2", "mp-3"])
+        self.assertFalse(missing[0]["dataFound"])
+        # All entries are the same structure, the stable one that isn't
+        # deprecated wins
+        self.assertEqual(final.hullDistance, 0.0)
+        self.assertEqual(final.symmetry, 194)
+
+    def testReplayTransport(self):
+        import tempfile
+        import src.data.mp.mpRetriever as mpRetriever
+        from src.data import replay, requestPolicy
+        from src.data.retrievalCache import getCache
+        from unittest import mock
+
+        doc = {
+            "material_id": "mp-1", "deprecated": False, "formula_pretty": "MoS2", "band_gap": 1.2,
+            "energy_above_hull": 0.0, "formation_energy_per_atom": -0.9, "symmetry": {"number": 194}, "structure": None
+        }
+
+        with tempfile.TemporaryDirectory() as tempDir, \
+                mock.patch.dict(requestPolicy.policies, clear=True), \
+                mock.patch.object(requestPolicy.RequestPolicy, "getDelay", lambda self, attempt: 1.0):
+            path = os.path.join(tempDir, "replay.json.gz")
+            replay.saveReplayDataset({"version": 1, "mp": {"MoS2": [doc]}}, path)
+
+            try:
+                transport = replay.configureReplay(path, rateLimit=2)
+                mpRetriever.retrieveMpData.cache_clear()
+
+                # Replayed data never goes into the default cache
+                self.assertIsNone(getCache())
+
+                first = mpRetriever.retrieveMpData("MoS2")
+                second = mpRetriever.retrieveMpData("WSe2")
+                # Third request within a second is over the rate limit
+                # and goes through when it is retried a second later
+                third = mpRetriever.retrieveMpData("S8")
+            finally:
+                replay.disableReplay()
+                mpRetriever.retrieveMpData.cache_clear()
+
+        self.assertEqual(first[0]["mpId"], "mp-1")
+        self.assertFalse(second[0]["dataFound"])
+        self.assertFalse(third[0]["dataFound"])
+        self.assertNotIn("error", third[0])
+        self.assertEqual(transport.stats()["requests"], 4)
+        self.assertEqual(transport.stats()["rateLimited"], 1)
+        self.assertIsNone(replay.getReplayTransport())
+
+    def testTransientErrors(self):
+        import src.data.mp.mpRetriever as mpRetriever
+        from src.data import requestPolicy
+        from src.data.replay import ReplayApiError
+        from src.data.retrievalCache import memoryCached
+        from src.indexCalc import calculator
+        from unittest import mock
+
+        policy = requestPolicy.RequestPolicy("mp", rate=0, burst=1, attempts=3, baseDelay=0,
+                                             breaker=requestPolicy.CircuitBreaker(threshold=4, resetTime=60))
+        calls = []
+
+        def flaky(failures, error):
+            def request():
+                calls.append(1)
+                if len(calls) <= failures:
+                    raise error
+                return "ok"
+            return request
+
+        # Retried until it goes through
+        self.assertEqual(policy.call(flaky(2, ReplayApiError(503, "Service Unavailable"))), "ok")
+        self.assertEqual(len(calls), 3)
+
+        # Errors that aren't transient are raised right away
+        calls.clear()
+        with self.assertRaises(ValueError):
+            policy.call(flaky(5, ValueError("bad formula")))
+        self.assertEqual(len(calls), 1)
+
+        # Numbers in a message don't make an error transient, an
+        # actual status does
+        self.assertFalse(requestPolicy.isTransientError(ValueError("Could not parse mp-504")))
+        self.assertFalse(requestPolicy.isTransientError(RuntimeError("Query returned 500 results")))
+        self.assertTrue(requestPolicy.isTransientError(RuntimeError("REST query returned with error status code 503 on URL")))
+        self.assertTrue(requestPolicy.isTransientError(RuntimeError("429 Too Many Requests")))
+
+        # Used up retries count towards the circuit breaker, once it
+        # is open requests fail without being sent
+        calls.clear()
+        with self.assertRaises(requestPolicy.TransientRetrievalError):
+            policy.call(flaky(10, TimeoutError("read timed out")))
+        with self.assertRaises(requestPolicy.TransientRetrievalError):
+            policy.call(flaky(10, TimeoutError("read timed out")))
+        self.assertTrue(policy.breaker.isOpen())
+        self.assertEqual(len(calls), 4)
+
+        # A transient MP failure is neither cached nor a reason to
+        # fall back to OQMD
+        transient = requestPolicy.transientErrorData("MP", "429 Too Many Requests")
+
+        with mock.patch.object(calculator.oqmd, "retrieveOqmdData") as retrieveOqmd:
+            with self.assertRaises(requestPolicy.TransientRetrievalError):
+                calculator.gatherCandidates("MoS2", dataMP=transient)
+            retrieveOqmd.assert_not_called()
+
+        with mock.patch.object(calculator, "getFinalCandidate", side_effect=requestPolicy.TransientRetrievalError("429")):
+            result = calculator.calculateQsi("MoS2")
+        self.assertEqual(result["errorType"], requestPolicy.errorTransient)
+
+        # Only the successful lookup is kept in memory
+        retrieve = mock.Mock(side_effect=[transient, [{"dataFound": False}]])
+        memoized = memoryCached(4)(lambda formula: retrieve(formula))
+        memoized("MoS2")
+        memoized("MoS2")
+        memoized("MoS2")
+        self.assertEqual(retrieve.call_count, 2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
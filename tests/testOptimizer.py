@@ -0,0 +1,84 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+
+# Add project root to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+class TestOptimizer(unittest.TestCase):
+    def testBestThresholdMatchesBruteForce(self):
+        import numpy as np
+        from src.bulkTest.optimizer import getBestThresholds
+
+        rng = np.random.default_rng(1)
+        truths = rng.random(60) > 0.4
+        indices = np.round(rng.random((20, 60)), 2)
+
+        thresholds, values = getBestThresholds(truths, indices, "accuracy")
+
+        for row, threshold, value in zip(indices, thresholds, values):
+            bruteForce = max(np.mean((row >= t) == truths) for t in [*np.unique(row), np.inf])
+            self.assertAlmostEqual(value, bruteForce)
+            self.assertAlmostEqual(np.mean((row >= threshold) == truths), value)
+
+        # With no suitable materials the best threshold is above every
+        # score, so nothing is predicted suitable
+        thresholds, values = getBestThresholds(np.zeros(60, dtype=bool), indices[:1], "accuracy")
+        self.assertEqual(values[0], 1.0)
+        self.assertGreater(thresholds[0], indices[0].max())
+
+    def testRocCurve(self):
+        from src.bulkTest.optimizer import getRocCurve
+
+        roc = getRocCurve([True, True, False, False], [0.9, 0.8, 0.3, 0.1])
+
+        self.assertEqual(roc['auc'], 1.0)
+        self.assertEqual(roc['thresholds'], [1.9, 0.9, 0.8, 0.3, 0.1])
+        self.assertEqual(roc['truePositiveRate'], [0.0, 0.5, 1.0, 1.0, 1.0])
+        self.assertEqual(roc['falsePositiveRate'], [0.0, 0.0, 0.0, 0.5, 1.0])
+        self.assertEqual(roc['accuracy'][0], 0.5)
+
+    def testGridCoversSimplex(self):
+        import numpy as np
+        from src.bulkTest.optimizer import getGridWeightVectors
+
+        vectors = getGridWeightVectors(0.25)
+
+        self.assertEqual(len(vectors), 70)
+        np.testing.assert_allclose(vectors.sum(axis=1), 1)
+        self.assertTrue((vectors >= 0).all())
+
+    def testOptimizeStoredRun(self):
+        from src.bulkTest.optimizer import optimizeBulkTest
+
+        # Suitable materials have low nuclear spin, which the default
+        # weights already reward, so the optimizer should separate
+        # them perfectly
+        materials = {}
+        for i, formula in enumerate(["C", "Si", "SiC", "CS2", "SiO2", "CO2", "Se", "S"]):
+            materials[formula] = {"isTrulySuitable": True, "candidate": {
+                "formula": formula, "bandGap": 2.0 + i / 10, "hullDistance": 0.0, "formationEnergy": -1.0, "symmetry": 200}}
+        for i, formula in enumerate(["NaCl", "LiF", "CuBr", "AlP", "Co", "Mn", "VN", "NbN"]):
+            materials[formula] = {"isTrulySuitable": False, "candidate": {
+                "formula": formula, "bandGap": 2.0 + i / 10, "hullDistance": 0.0, "formationEnergy": -1.0, "symmetry": 200}}
+        materials["Graphene"] = {"isTrulySuitable": None, "candidate": None}
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            with open(os.path.join(tempDir, "candidates.json"), 'w') as f:
+                json.dump({"mode": "validation", "materials": materials}, f)
+
+            report = optimizeBulkTest(tempDir, metric="f1", method="refine", samples=2000)
+
+            self.assertTrue(os.path.exists(os.path.join(tempDir, "optimization.json")))
+
+        self.assertEqual(report['materials'], 16)
+        self.assertEqual(report['inconclusive'], 1)
+        self.assertEqual(report['best']['f1'], 1.0)
+        self.assertEqual(report['best']['accuracy'], 1.0)
+        self.assertAlmostEqual(sum(report['best']['weights'].values()), 1.0)
+        self.assertGreaterEqual(report['best']['f1'], report['default']['f1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
 formula = "InP"
 
 class TestOQMD(unittest.TestCase):
+    def setUp(self):
+        # Fresh rate limits and circuit breakers, earlier tests may
+        # have tripped them without network access
+        from src.data import requestPolicy
+        requestPolicy.policies.clear()
+
     def testOqmdRetrieval(self):
         import src.data.oqmd as oqmd
         from utils.debug import logDebug
@@ -24,5 +30,183 @@ class TestOQMD(unittest.TestCase):
 
         logDebug(str(filteredData))
 
+    def testOqmdStructureJoin(self):
+        import src.data.oqmd.oqmdRetriever as oqmdRetriever
+        from unittest import mock
+
+        phases = [{"entry_id": entryId, "name": "InP", "band_gap": 1.0, "stability": 0.0,
+                   "delta_e": -0.3, "unit_cell": None, "spacegroup": "F-43m"} for entryId in range(1, 6)]
+
+        def structureItem(entryId):
+            return {"id": entryId * 10, "attributes": {"_oqmd_entry_id": entryId}}
+
+        class FakeRester:
+            structureCalls = []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def get_oqmd_phases(self, verbose=True, **kwargs):
+                return {"data": phases}
+
+            def get_optimade_structures(self, verbose=True, **kwargs):
+                self.structureCalls.append(kwargs)
+
+                if "filter" not in kwargs:
+                    return {"data": [structureItem(5)], "meta": {}}
+
+                # Entry 5 is missing from the composition query so it
+                # has to fall back to the per phase lookup
+                items = [structureItem(entryId) for entryId in range(1, 5)]
+                offset = kwargs["offset"]
+                page = items[offset:offset + kwargs["limit"]]
+                return {"data": page, "meta": {"data_returned": len(items), "more_data_available": offset + len(page) < len(items)}}
+
+        with mock.patch.object(oqmdRetriever, "QMPYRester", FakeRester), \
+                mock.patch.object(oqmdRetriever, "structurePageSize", 2), \
+                mock.patch("src.data.retrievalCache.cacheEnabled", False):
+            data = oqmdRetriever.retrieveOqmdData.__wrapped__("InP")
+
+        self.assertEqual([d["oqmdId"] for d in data], [1, 2, 3, 4, 5])
+        for d in data:
+            self.assertEqual(d["structureData"]["data"][0]["attributes"]["_oqmd_entry_id"], d["oqmdId"])
+
+        self.assertEqual(sorted(c.get("offset", -1) for c in FakeRester.structureCalls), [-1, 0, 2])
+        self.assertEqual(FakeRester.structureCalls[0]["filter"], 'chemical_formula_reduced="InP"')
+
+    def testBestOfGroupsMatchesSortedSelection(self):
+        import random
+        from types import SimpleNamespace
+        from data.candidateSelection import selectBestOfGroups
+
+        def sortedSelection(data, groups):
+            # Selection as the cleaners used to do it
+            finalized = []
+            for group in groups:
+                subgroup = [[d for d in data if d.get("oqmdId") == entry.label] for entry in group]
+                finalized.append(sorted(subgroup, key=lambda x: (x[0]['hullDistance'], abs(x[0]['bandGap'] - 1)))[0])
+            return sorted(finalized, key=lambda x: (x[0]['hullDistance'], abs(x[0]['bandGap'] - 1)))[0][0]
+
+        rng = random.Random(3)
+        for _ in range(50):
+            # Few distinct values so there are plenty of ties
+            data = [{"oqmdId": i, "hullDistance": rng.choice([0, 0.01, 0.05]), "bandGap": rng.choice([0.5, 1.5, 2.0])} for i in range(20)]
+            labels = [SimpleNamespace(label=d["oqmdId"]) for d in data]
+            rng.shuffle(labels)
+            cuts = sorted(rng.sample(range(1, 20), 5))
+            groups = [labels[a:b] for a, b in zip([0] + cuts, cuts + [20])]
+
+            self.assertIs(selectBestOfGroups(data, groups, "oqmdId"), sortedSelection(data, groups))
+
+    def testSpeculativeFallback(self):
+        import threading
+        from src.indexCalc import calculator
+        from unittest import mock
+
+        oqmdData = [{"oqmdId": 1, "dataFound": True}]
+        mpData = [{"mpId": "mp-1", "structure": {}, "dataFound": True}]
+        oqmdCalls = []
+        overlapped = []
+        oqmdStarted = threading.Event()
+
+        def mpLookup(formula):
+            # Only returns once OQMD is in flight, a sequential lookup
+            # would wait here until the timeout
+            overlapped.append(oqmdStarted.wait(5))
+            return [{"dataFound": False}]
+
+        def oqmdLookup(formula):
+            oqmdCalls.append(formula)
+            oqmdStarted.set()
+            return oqmdData
+
+        # Missing from MP: OQMD was already in flight while MP was
+        # being asked
+        with mock.patch.object(calculator.mp, "retrieveMpData", mpLookup), \
+                mock.patch.object(calculator.oqmd, "retrieveOqmdData", oqmdLookup):
+            gathered = calculator.gatherCandidates("InP", speculative=True)
+
+        self.assertEqual(gathered["source"], "oqmd")
+        self.assertIs(gathered["data"], oqmdData)
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(oqmdCalls, ["InP"])
+
+        # Found in MP: MP wins without waiting for OQMD, which is held
+        # up until gatherCandidates has returned
+        release = threading.Event()
+        oqmdFinished = threading.Event()
+
+        def blockedOqmdLookup(formula):
+            release.wait(5)
+            oqmdFinished.set()
+            return oqmdData
+
+        with mock.patch.object(calculator.mp, "retrieveMpData", lambda formula: mpData), \
+                mock.patch.object(calculator.oqmd, "retrieveOqmdData", blockedOqmdLookup):
+            gathered = calculator.gatherCandidates("MoS2", speculative=True)
+            returnedFirst = not oqmdFinished.is_set()
+            release.set()
+
+        self.assertEqual(gathered["source"], "mp")
+        self.assertTrue(returnedFirst)
+
+        # A rate limit on MP calls the queued OQMD lookup off
+        from src.data.requestPolicy import TransientRetrievalError, transientErrorData
+
+        pool = mock.Mock()
+        with mock.patch.object(calculator.mp, "retrieveMpData", lambda formula: transientErrorData("MP", "429 Too Many Requests")), \
+                mock.patch.object(calculator, "getSpeculativePool", lambda: pool):
+            with self.assertRaises(TransientRetrievalError):
+                calculator.gatherCandidates("GaN", speculative=True)
+
+        pool.submit.return_value.cancel.assert_called_once()
+
+    def testAsyncCalculation(self):
+        import asyncio
+        import threading
+        from src.data import asyncPool, requestPolicy
+        from src.indexCalc import calculator
+        # Imported up front so their import time isn't measured
+        from src.data.mp import mpCleaner
+        from src.data.oqmd import oqmdCleaner
+        from unittest import mock
+
+        running = []
+        peak = []
+        lock = threading.Lock()
+        # Lookups only finish four at a time, so this only gets
+        # through if four of them really run at once
+        barrier = threading.Barrier(4, timeout=5)
+
+        def slowMpLookup(formula):
+            with lock:
+                running.append(formula)
+                peak.append(len(running))
+            barrier.wait()
+            with lock:
+                running.remove(formula)
+
+            if formula == "WSe2":
+                return requestPolicy.transientErrorData("MP", "429 Too Many Requests")
+            return [{"dataFound": False}]
+
+        async def calculateAll(formulas):
+            return await asyncio.gather(*(calculator.calculateQsiAsync(formula) for formula in formulas))
+
+        formulas = ["MoS2", "WSe2", "NaCl", "FeS2", "BN", "GaAs", "InP", "GaN"]
+
+        with mock.patch.object(calculator.mp, "retrieveMpData", slowMpLookup), \
+                mock.patch.object(calculator.oqmd, "retrieveOqmdData", lambda formula: [{"dataFound": False}]), \
+                mock.patch.dict(asyncPool.asyncLimits, {"mp": 4}):
+            results = asyncio.run(calculateAll(formulas))
+
+        # Four lookups at a time, never more
+        self.assertEqual(max(peak), 4)
+        self.assertEqual(results[1]["errorType"], requestPolicy.errorTransient)
+        self.assertTrue(all(result["index"] is None and result["error"] for result in results))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
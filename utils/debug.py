@@ -5,10 +5,11 @@ import os
 logger = logging.getLogger(__name__)
 debugMode = False
 
-if os.name == 'nt':
-    _ = os.system('cls')
-else:
-    _ = os.system('clear')
+def clearScreen():
+    if os.name == 'nt':
+        _ = os.system('cls')
+    else:
+        _ = os.system('clear')
 
 def setDebugMode(status: bool):
     global debugMode
@@ -17,8 +18,17 @@ def setDebugMode(status: bool):
 def isDebugMode():
     return debugMode
 
-def logDebug(message: str):
-    if isDebugMode():
+def logDebug(message: str, *args):
+    # Arguments are %-formatted into the message only when it is
+    # actually printed or logged, so hot paths can pass values
+    # instead of building an f-string that is thrown away
+    if not debugMode and not logger.isEnabledFor(logging.INFO):
+        return
+
+    if args:
+        message = message % args
+
+    if debugMode:
         print(f"[DEBUG] {message}")
     logger.info(message)
 
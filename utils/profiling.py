@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+from utils.debug import logDebug
+
+# Lightweight timing of the pipeline stages. Code marks a stage with
+#
+#     with span("grouping"):
+#         ...
+#
+# and every finished span adds its duration to that stage's samples.
+# Spans are off unless QSI_PROFILE is set (or setProfiling(True) is
+# called); a disabled span is one flag check and a shared no-op
+# context manager, so the calls can stay in the hot paths.
+#
+# QSI_PROFILER=cprofile|pyinstrument additionally runs the code inside
+# profiled() under that profiler and writes the report to
+# QSI_PROFILE_DIR (default: the working directory).
+
+profilingEnabled = os.getenv("QSI_PROFILE", "").lower() in ("1", "true", "yes")
+profilerName = os.getenv("QSI_PROFILER", "").lower()
+profileDir = os.getenv("QSI_PROFILE_DIR", ".")
+
+samples = {}
+samplesLock = threading.Lock()
+
+noSpan = contextlib.nullcontext()
+
+def setProfiling(status: bool):
+    global profilingEnabled
+    profilingEnabled = status
+
+def isProfiling():
+    return profilingEnabled
+
+class Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        addSample(self.name, time.perf_counter() - self.start)
+        return False
+
+def span(name):
+    if not profilingEnabled:
+        return noSpan
+    return Span(name)
+
+def addSample(name, seconds):
+    with samplesLock:
+        samples.setdefault(name, []).append(seconds)
+
+def addSamples(newSamples):
+    with samplesLock:
+        for name, values in newSamples.items():
+            samples.setdefault(name, []).extend(values)
+
+def drainSamples():
+    global samples
+
+    with samplesLock:
+        drained = samples
+        samples = {}
+
+    return drained
+
+def resetStageStats():
+    drainSamples()
+
+def runWithSpans(function, *args):
+    # For work sent to a process pool: times the spans in the worker
+    # and hands them back with the result, the caller passes them to
+    # addSamples so the stats cover every process
+    setProfiling(True)
+    drainSamples()
+
+    result = function(*args)
+    return result, drainSamples()
+
+def percentile(sortedValues, q):
+    # Linear interpolation between the closest ranks
+    position = (len(sortedValues) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sortedValues) - 1)
+
+    return sortedValues[lower] + (sortedValues[upper] - sortedValues[lower]) * (position - lower)
+
+def getStageStats():
+    with samplesLock:
+        current = {name: sorted(values) for name, values in samples.items()}
+
+    stats = {}
+
+    for name, values in current.items():
+        if not values:
+            continue
+
+        stats[name] = {
+            "count": len(values),
+            "totalSeconds": sum(values),
+            "meanSeconds": sum(values) / len(values),
+            "p50Seconds": percentile(values, 0.5),
+            "p95Seconds": percentile(values, 0.95),
+            "maxSeconds": values[-1],
+        }
+
+    return stats
+
+def writeStageStats(path):
+    stats = getStageStats()
+
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=4)
+
+    return stats
+
+_activeProfiler = None
+_profilerLock = threading.Lock()
+
+@contextlib.contextmanager
+def profiled(name):
+    # Runs the block under the profiler picked with QSI_PROFILER.
+    # Nested or concurrent blocks run unprofiled, only one profiler
+    # can be active at a time.
+    global _activeProfiler
+
+    if not profilerName:
+        yield
+        return
+
+    with _profilerLock:
+        if _activeProfiler is not None:
+            owner = False
+        else:
+            _activeProfiler = startProfiler()
+            owner = _activeProfiler is not None
+
+    if not owner:
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        with _profilerLock:
+            profiler, _activeProfiler = _activeProfiler, None
+
+        writeProfile(profiler, name)
+
+def startProfiler():
+    if profilerName == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logDebug("pyinstrument is not installed, falling back to cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler (a debugger or coverage tool) is active
+        logDebug("Could not start cProfile, another profiler is active")
+        return None
+
+    return profiler
+
+def writeProfile(profiler, name):
+    os.makedirs(profileDir, exist_ok=True)
+
+    if hasattr(profiler, "output_html"):
+        profiler.stop()
+        path = os.path.join(profileDir, f"{name}.html")
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        path = os.path.join(profileDir, f"{name}.prof")
+        profiler.dump_stats(path)
+
+    logDebug("Wrote profile to %s", path)